@@ -0,0 +1,532 @@
+"""
+The archives: one file per mote and day, data/<kind>/<source_addr>/<YYYYMMDD>,
+with a JSON message per line. Written by wsn_raw_archive and wsn_data_archive.
+
+The days before today are compressed in the background, to <YYYYMMDD>.gz. Use
+read_lines to read a day, compressed or not.
+
+Every day has an index, <YYYYMMDD>.idx, with the time received and the
+position of every line, written along with the lines. Use query to read the
+lines received in a time range, without reading the others, see query.py.
+"""
+
+# Standard Library
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+import functools
+import gzip
+import io
+import json
+import logging
+import mmap
+import os
+import re
+import shutil
+import struct
+import threading
+
+# Project
+from mq import MQ
+import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+class Writer:
+    """
+    Appends lines to the daily files. The lines are buffered until flush,
+    which writes them and syncs the files to disk. The files are kept open, at
+    most max_open of them, the least recently used is closed first.
+
+    Lines may be written from other threads (see MQ.threads).
+    """
+
+    def __init__(self, datadir, max_open=32, fsync=True):
+        self.datadir = datadir
+        self.max_open = max_open
+        self.fsync = fsync
+        self.files = collections.OrderedDict() # (dirname, filename) -> (file, index file)
+        self.pending = {} # (dirname, filename) -> [(line, time), ...]
+        self.ends = {} # (dirname, filename) -> end of the day, in the index
+        self.lock = threading.Lock()
+
+    def write(self, dirname, filename, line, time):
+        """
+        Append the line, with the time it was received for the index.
+        """
+        with self.lock:
+            self.pending.setdefault((dirname, filename), []).append((line + '\n', time))
+
+    def open(self, key):
+        files = self.files.pop(key, None)
+        if files is None:
+            if len(self.files) >= self.max_open:
+                for file in self.files.popitem(last=False)[1]:
+                    file.close()
+
+            dirpath = os.path.join(self.datadir, key[0])
+            os.makedirs(dirpath, exist_ok=True)
+            path = os.path.join(dirpath, key[1])
+            if key not in self.ends:
+                self.ends[key] = open_index(path)
+            files = open(path, 'a'), open(path + INDEX, 'ab')
+
+        self.files[key] = files # Most recently used last
+        return files
+
+    def detach(self, dirname, filename, new_filename):
+        """
+        Close the file and rename it, unless there are lines waiting to be
+        written to it, or the new file exists (e.g. a .closed file not
+        compressed yet). Then new lines go to a new file. Return True if the
+        file has been renamed.
+        """
+        key = (dirname, filename)
+        dirpath = os.path.join(self.datadir, dirname)
+        with self.lock:
+            if key in self.pending or os.path.exists(os.path.join(dirpath, new_filename)):
+                return False
+
+            for file in self.files.pop(key, ()):
+                file.close()
+            self.ends.pop(key, None) # A new file starts, see open_index
+
+            os.rename(os.path.join(dirpath, filename), os.path.join(dirpath, new_filename))
+            return True
+
+    def flush(self):
+        """
+        Write the lines waiting, a day at a time. The lines of the days that
+        fail are kept for the next flush, then the first error is raised.
+        """
+        error = None
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            for key, lines in pending.items():
+                try:
+                    self.flush_day(key, lines)
+                except Exception as exc:
+                    self.pending[key] = lines
+                    error = error or exc
+
+        if error is not None:
+            raise error
+
+    def flush_day(self, key, lines):
+        file, index = self.open(key)
+        file.write(''.join(line for line, time in lines))
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+
+        # The index after the lines, if the program is killed in between it is
+        # built again
+        self.ends[key] = append_index(index, self.ends[key], lines)
+        index.flush()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            for files in self.files.values():
+                for file in files:
+                    file.close()
+            self.files.clear()
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+DAY = re.compile(r'\d{8}$')
+CLOSED = '.closed' # Suffix of the files to compress
+
+
+def compress(path):
+    """
+    Compress <path>.closed and append it to <path>.gz, as a new gzip member,
+    then remove it. The .gz file is replaced at once, so it is never left
+    half written.
+    """
+    closed = path + CLOSED
+    gz = path + '.gz'
+    tmp = gz + '.tmp'
+    with open(closed, 'rb') as src, open(tmp, 'wb') as dst:
+        if os.path.exists(gz):
+            with open(gz, 'rb') as file:
+                shutil.copyfileobj(file, dst)
+
+        with gzip.GzipFile(filename='', mode='wb', fileobj=dst) as gzfile:
+            shutil.copyfileobj(src, gzfile)
+        dst.flush()
+        os.fsync(dst.fileno())
+
+    os.replace(tmp, gz)
+    os.remove(closed)
+
+
+def get_day(path):
+    """
+    Return the path of the day, without the .gz extension.
+    """
+    for suffix in ('.gz', CLOSED):
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+
+    return path
+
+
+def get_paths(path):
+    """
+    Return the files of the day, given by its path with or without the .gz
+    extension, in the order they were written: the compressed part first.
+    """
+    day = get_day(path)
+    return [day + suffix for suffix in ('.gz', CLOSED, '') if os.path.exists(day + suffix)]
+
+
+def open_file(path):
+    """
+    Open an archive file for reading, as text, compressed or not.
+    """
+    file = open(path, 'rb')
+    if file.read(2) == GZIP_MAGIC:
+        file.seek(0)
+        return gzip.open(file, 'rt')
+
+    file.seek(0)
+    return io.TextIOWrapper(file)
+
+
+def read_lines(path):
+    """
+    Return an iterator over the lines of the day, streamed from its files,
+    compressed or not.
+    """
+    for path in get_paths(path):
+        with open_file(path) as file:
+            yield from file
+
+
+# The index of a day: a record per line, in the order they were written, with
+# the time received, the offset in the day (as read by read_lines) and the
+# length. A record of length 0 marks the start of a file.
+INDEX = '.idx'
+RECORD = struct.Struct('<qqi')
+
+
+def load_index(path):
+    """
+    Return the records of the index of the day, an empty list if there is no
+    index.
+    """
+    try:
+        with open(get_day(path) + INDEX, 'rb') as file:
+            data = file.read()
+    except FileNotFoundError:
+        return []
+
+    # A record left half written is ignored
+    data = data[:len(data) - len(data) % RECORD.size]
+    return list(RECORD.iter_unpack(data))
+
+
+def build_index(path):
+    """
+    Build the index of the day from its files, e.g. for the days archived
+    before there was an index. Return the records.
+
+    A line left half written at the end of the plain file (the program was
+    killed) is truncated, so new lines can be appended. Other lines that
+    cannot be loaded are left out of the index.
+    """
+    day = get_day(path)
+    records = []
+    offset = 0
+    for part in get_paths(day):
+        records.append((0, offset, 0))
+        torn = None
+        with open_file(part) as file:
+            position = 0 # In the part
+            for line in file:
+                length = len(line.encode())
+                if part == day and not line.endswith('\n'):
+                    torn = position
+                    break
+
+                try:
+                    records.append((int(json.loads(line)['received']), offset, length))
+                except (ValueError, KeyError, TypeError):
+                    logger.warning('%s: skip line at offset %d, not valid', part, position)
+                offset += length
+                position += length
+
+        if torn is not None:
+            logger.warning('%s: truncate line left half written at offset %d', part, torn)
+            with open(part, 'r+b') as file:
+                file.truncate(torn)
+
+    tmp = day + INDEX + '.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(b''.join(RECORD.pack(*record) for record in records))
+    os.replace(tmp, day + INDEX)
+    return records
+
+
+def open_index(path):
+    """
+    Return the end of the day, where the next line appended to the plain file
+    goes. The index is built again if it does not match the files.
+    """
+    records = load_index(path)
+    if not records and (os.path.exists(path + '.gz') or os.path.exists(path + CLOSED)):
+        records = build_index(path)
+
+    # Plain file: the last marker is where it starts
+    end = records[-1][1] + records[-1][2] if records else 0
+    if os.path.exists(path):
+        starts = [offset for time, offset, length in records if length == 0]
+        if not starts or end - starts[-1] != os.path.getsize(path):
+            records = build_index(path)
+            end = records[-1][1] + records[-1][2]
+        return end
+
+    # A new plain file
+    with open(path + INDEX, 'ab') as index:
+        append_index(index, end, [])
+    return end
+
+
+def append_index(index, end, lines):
+    """
+    Append to the index file the records of the given lines, (line, time)
+    pairs, written from the given offset; an empty list to mark the start of
+    a file. Return the end of the day.
+    """
+    records = []
+    if not lines:
+        records.append(RECORD.pack(0, end, 0))
+    for line, time in lines:
+        length = len(line.encode())
+        records.append(RECORD.pack(int(time), end, length))
+        end += length
+
+    index.write(b''.join(records))
+    return end
+
+
+def query(path, start=None, end=None):
+    """
+    Return an iterator over the lines of the day received in the time range
+    [start, end), in the order they were written. With the index only those
+    lines are read, the plain files through mmap; without it every line is
+    read.
+    """
+    day = get_day(path)
+    records = load_index(day)
+    if not records:
+        for line in read_lines(day):
+            received = json.loads(line)['received']
+            if (start is None or received >= start) and (end is None or received < end):
+                yield line
+        return
+
+    # Where every file starts: the compressed one at 0, the others at their
+    # marker
+    starts = [offset for time, offset, length in records if length == 0]
+    parts = get_paths(day)
+    bases = [0] * len(parts)
+    i = len(starts)
+    for j in reversed(range(len(parts))):
+        if not parts[j].endswith('.gz') and i > 0:
+            i -= 1
+            bases[j] = starts[i]
+
+    # The lines in the range, a part at a time
+    selected = [
+        (offset, length) for time, offset, length in records
+        if length and (start is None or time >= start) and (end is None or time < end)
+    ]
+    for j, part in enumerate(parts):
+        base = bases[j]
+        limit = bases[j + 1] if j + 1 < len(parts) else None
+        lines = [(offset - base, length) for offset, length in selected if offset >= base and (limit is None or offset < limit)]
+        if not lines:
+            continue
+
+        if part.endswith('.gz'):
+            # Decompressed up to the lines, but not decoded
+            with gzip.open(part, 'rb') as file:
+                for offset, length in lines:
+                    file.seek(offset)
+                    yield file.read(length).decode()
+        else:
+            with open(part, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for offset, length in lines:
+                    yield data[offset:offset + length].decode()
+
+
+def search(dirpath, start=None, end=None):
+    """
+    Return an iterator over the lines received in the time range, from the
+    days of the given directory, e.g. data/raw/<source_addr>.
+    """
+    first = None if start is None else date.fromtimestamp(start).strftime('%Y%m%d')
+    last = None if end is None else date.fromtimestamp(end).strftime('%Y%m%d')
+    days = sorted({filename[:8] for filename in os.listdir(dirpath) if DAY.match(filename[:8])})
+    for day in days:
+        if (first is None or day >= first) and (last is None or day <= last):
+            yield from query(os.path.join(dirpath, day), start, end)
+
+
+def init_worker():
+    os.nice(19) # Lowest priority
+
+
+class Consumer(MQ):
+    """
+    Base class of the archive consumers. The messages are acknowledged once
+    written to disk, by flush: every flush_interval seconds, or as soon as
+    flush_size messages are waiting.
+    """
+
+    flush_interval = 1 # Seconds, 0 to write every message right away
+    flush_size = 500 # Max number of messages waiting to be written
+    max_open = 32 # Max number of files kept open
+    fsync = True
+
+    # Compression of the days before today, in a separate process
+    compress = True
+    compress_interval = 600 # Seconds between looking for days to compress
+    compress_workers = 1
+
+    def __init__(self):
+        super().__init__()
+        self.flush_interval = float(self.config.get('flush_interval', self.flush_interval))
+        self.flush_size = int(self.config.get('flush_size', self.flush_size))
+        self.max_open = int(self.config.get('max_open', self.max_open))
+        self.fsync = utils.get_bool(self.config, 'fsync', self.fsync)
+        self.compress = utils.get_bool(self.config, 'compress', self.compress)
+        self.compress_interval = float(self.config.get('compress_interval', self.compress_interval))
+        self.compress_workers = int(self.config.get('compress_workers', self.compress_workers))
+
+        # The broker stops delivering once prefetch_count messages are not
+        # acknowledged, do not wait for more
+        if self.prefetch_count:
+            self.flush_size = min(self.flush_size, self.prefetch_count)
+
+        self.writer = None # Set by setup
+        self.held = [] # (channel, delivery tag), acknowledged by flush
+        self.flush_timer = None
+        self.compress_pool = None
+        self.compressing = set() # Paths being compressed
+
+    def get_dirname(self, body):
+        return body['source_addr']
+
+    def write(self, body, line):
+        """
+        Append the line to the file of the mote and day the message was
+        received.
+        """
+        dirname = self.get_dirname(body)
+        received = body['received']
+        filename = date.fromtimestamp(received).strftime('%Y%m%d')
+        self.writer.write(dirname, filename, line, received)
+
+    def ack(self, channel, delivery_tag):
+        self.held.append((channel, delivery_tag))
+        if not self.flush_interval or len(self.held) >= self.flush_size:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = self.ioloop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        if self.flush_timer is not None:
+            self.ioloop.remove_timeout(self.flush_timer)
+            self.flush_timer = None
+
+        held, self.held = self.held, []
+        try:
+            self.writer.flush()
+        except Exception:
+            # The lines not written are kept by the writer, and the messages
+            # held until they are, tried again later
+            self.exception('Archive write failed, hold %d messages', len(held))
+            self.held = held + self.held
+            if self.flush_timer is None:
+                self.flush_timer = self.ioloop.call_later(self.flush_interval or 1, self.flush)
+            return
+
+        # If the channel has been closed the messages will be delivered again
+        for channel, delivery_tag in held:
+            if channel.is_open:
+                channel.basic_ack(delivery_tag=delivery_tag)
+
+    def bg_task(self):
+        if self.compress:
+            self.compress_days()
+
+        return self.compress_interval
+
+    def compress_days(self):
+        """
+        Compress the days before today, in the process pool.
+        """
+        datadir = self.writer.datadir
+        if not os.path.isdir(datadir):
+            return
+
+        today = date.today().strftime('%Y%m%d')
+        for dirname in sorted(os.listdir(datadir)):
+            dirpath = os.path.join(datadir, dirname)
+            if not os.path.isdir(dirpath):
+                continue
+
+            for filename in sorted(os.listdir(dirpath)):
+                path = os.path.join(dirpath, get_day(filename))
+                if path in self.compressing:
+                    continue
+
+                # Files renamed before, not compressed yet (the program exited).
+                # The plain file of the same day, if any, waits for the next
+                # time, see Writer.detach
+                if filename.endswith(CLOSED):
+                    pass
+                elif not (DAY.match(filename) and filename < today):
+                    continue
+                elif not self.writer.detach(dirname, filename, filename + CLOSED):
+                    continue
+
+                self.submit(compress, path)
+
+    def submit(self, function, path):
+        """
+        Call function(path) in the process pool.
+        """
+        if self.compress_pool is None:
+            self.compress_pool = ProcessPoolExecutor(self.compress_workers, initializer=init_worker)
+
+        self.compressing.add(path)
+        future = self.compress_pool.submit(function, path)
+        future.add_done_callback(functools.partial(self.on_compressed, path))
+
+    def on_compressed(self, path, future):
+        # Called from a thread of the pool
+        def callback():
+            self.compressing.discard(path) # Tried again next time if failed
+            try:
+                future.result()
+            except Exception:
+                self.exception('Failed to compress %s', path)
+            else:
+                self.debug('Compressed %s', path)
+
+        self.ioloop.add_callback_threadsafe(callback)
+
+    def stop(self, signum=None, frame=None):
+        if self.writer is not None:
+            self.flush()
+        if self.compress_pool is not None:
+            # The files not compressed yet are compressed when started again
+            self.compress_pool.shutdown(wait=False, cancel_futures=True)
+            self.compress_pool = None
+        super().stop(signum, frame)
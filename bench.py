@@ -0,0 +1,555 @@
+"""
+Micro benchmarks, to be run on the target hardware (a Raspberry Pi):
+
+    python bench.py outbox
+    python bench.py pipeline
+    python bench.py memory
+    python bench.py startup
+    python bench.py state
+    python bench.py archive
+    python bench.py series
+"""
+
+# Standard Library
+import argparse
+import base64
+import contextlib
+import copy
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Project
+import archive
+from archive import Writer
+from broker import Broker
+from mq import MQ
+from outbox import Outbox
+import pipeline
+import series
+from state import State
+
+
+def bench_outbox(args):
+    """
+    Throughput of the outbox: one commit per published message, confirmed
+    messages removed in batches of the given sizes (see MQ.confirm_batch).
+    """
+    body = json.dumps({'source_addr': '0013A200416A0723', 'data': 'x' * 100, 'received': 0})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for batch in args.batch:
+            path = os.path.join(tmpdir, f'{batch}.outbox')
+            outbox = Outbox(path)
+            confirmed = []
+            t0 = time.perf_counter()
+            for i in range(args.n):
+                confirmed.append(outbox.put('wsn_raw', '', 'application/json', body))
+                if len(confirmed) >= batch:
+                    outbox.remove(confirmed)
+                    confirmed = []
+            outbox.remove(confirmed)
+            dt = time.perf_counter() - t0
+            outbox.close()
+            print(f'confirm_batch={batch:<4} {args.n / dt:8.0f} msg/s')
+
+
+class BenchStage(MQ):
+    """
+    A stage of the pipeline benchmark: source -> relay -> sink, the source
+    and the relay with an outbox, like wsn_xbee and wsn_raw_cook.
+    """
+
+    transport = 'bench'
+
+    def __init__(self, on_ready=None):
+        super().__init__()
+        self.on_ready = on_ready # Called once the setup is done
+
+    def done(self):
+        super().done()
+        if self.on_ready is not None:
+            self.on_ready()
+
+
+class BenchSource(BenchStage):
+
+    name = 'bench_source'
+    outbox_name = 'bench_source.outbox'
+    n = 1000 # Number of messages
+    interval = 0.001 # Seconds between messages
+
+    def __init__(self, on_ready=None):
+        super().__init__(on_ready)
+        self.sent = 0
+
+    def pub_to(self):
+        return ('bench_a', 'topic', '')
+
+    def done(self):
+        super().done()
+        if self.sent == 0:
+            self.ioloop.call_later(0, self.emit)
+
+    def emit(self):
+        body = {'source_addr': '0013A200416A0723', 'type': 'bench', 'data': 'x' * 100, 't': time.time()}
+        self.publish(body)
+        self.sent += 1
+        if self.sent < self.n:
+            self.ioloop.call_later(self.interval, self.emit)
+
+
+class BenchRelay(BenchStage):
+
+    name = 'bench_relay'
+    outbox_name = 'bench_relay.outbox'
+
+    def sub_to(self):
+        return ('bench_a', 'topic', self.name, self.handle_message)
+
+    def pub_to(self):
+        return ('bench_b', 'topic', '')
+
+    def handle_message(self, body):
+        self.publish(body)
+
+
+class BenchSink(BenchStage):
+
+    name = 'bench_sink'
+    n = 1000
+
+    def __init__(self, on_ready=None, on_finish=None):
+        super().__init__(on_ready)
+        self.on_finish = on_finish # Called with the latencies
+        self.latencies = []
+
+    def sub_to(self):
+        return ('bench_b', 'topic', self.name, self.handle_message)
+
+    def handle_message(self, body):
+        self.latencies.append(time.time() - body['t'])
+        if len(self.latencies) == self.n:
+            self.on_finish(self.latencies)
+
+
+def run_stage(cls, ready, results):
+    """
+    Run a stage in its own process, connected to RabbitMQ or to the SQLite
+    broker.
+    """
+    if cls is BenchSink:
+        def on_finish(latencies):
+            results.put(latencies)
+            stage.stop()
+
+        stage = cls(ready.set, on_finish)
+    else:
+        stage = cls(ready.set)
+
+    with stage:
+        stage.start()
+
+
+def bench_pipeline(args):
+    """
+    Latency of a message from a source to a sink, through a relay: in a single
+    process with the in-process broker (see pipeline.py), or one process per
+    stage with the SQLite broker or RabbitMQ.
+    """
+    BenchSource.n = BenchSink.n = args.n
+    BenchSource.interval = 1 / args.rate
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        with open('config.ini', 'w') as config:
+            for cls in (BenchSource, BenchRelay, BenchSink):
+                config.write(f'[{cls.name}]\nlog_level = warning\n\n')
+            if args.broker == 'sqlite':
+                config.write(f'[broker]\nbackend = sqlite\npath = broker.db\npoll_interval = {args.poll_interval}\n')
+
+        if args.broker != 'memory':
+            ready = {cls: multiprocessing.Event() for cls in (BenchSink, BenchRelay, BenchSource)}
+            results = multiprocessing.Queue()
+            processes = []
+            for cls, event in ready.items():
+                process = multiprocessing.Process(target=run_stage, args=(cls, event, results), daemon=True)
+                process.start()
+                processes.append(process)
+                # Wait for the consumers before starting the source
+                if not event.wait(30):
+                    sys.exit(f'{cls.name} not ready, is the broker running?')
+
+            latencies = results.get()
+            for process in processes:
+                process.terminate()
+                process.join()
+        else:
+            broker = Broker(maxsize=args.maxsize)
+            BenchStage.broker = broker
+            loop = broker.loop
+            latencies = []
+
+            def on_finish(values):
+                latencies.extend(values)
+                loop.stop()
+
+            with contextlib.ExitStack() as stack:
+                sink = stack.enter_context(BenchSink(on_finish=on_finish))
+                relay = stack.enter_context(BenchRelay())
+                pipeline.wait_ready(loop, [sink, relay])
+                stack.enter_context(BenchSource())
+                loop.run_forever()
+
+    latencies = sorted(x * 1000 for x in latencies)
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive')
+    print(f'{len(latencies)} messages at {args.rate} msg/s, latency in ms:')
+    print(f'p50={quantiles[49]:.2f} p90={quantiles[89]:.2f} p99={quantiles[98]:.2f} max={latencies[-1]:.2f}')
+
+
+def get_rss(modules):
+    """
+    Return the max resident memory, in KB, of a Python process that imports
+    the given modules.
+    """
+    code = f'import resource, {", ".join(modules)}; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)'
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+    return int(output)
+
+
+def bench_memory(args):
+    """
+    Memory of the programs once imported: one process per program (with
+    RabbitMQ, not counted), or all of them in a single process (pipeline.py).
+    """
+    total = 0
+    for name in args.programs:
+        rss = get_rss([name])
+        total += rss
+        print(f'{name:<20} {rss / 1024:6.1f} MB')
+
+    print(f'{"one per program":<20} {total / 1024:6.1f} MB')
+    rss = get_rss(['broker', 'pipeline'] + args.programs)
+    print(f'{"pipeline":<20} {rss / 1024:6.1f} MB')
+
+
+def bench_state(args):
+    """
+    Updates of the persistent state, like wsn_xbee does for every frame: the
+    JSON file rewritten on every change (as before), against the SQLite state
+    written on every change (state_flush = 0) or every --batch changes.
+    """
+    motes = [f'0013A20041{i:06X}' for i in range(args.motes)]
+    values = [base64.b64encode(os.urandom(60)).decode() for i in range(args.n)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Deep copy, compare and rewrite the JSON file, on every change
+        path = os.path.join(tmpdir, 'state.json')
+        state = {mote: {'data': '', 'cmd_time': 0} for mote in motes}
+        t0 = time.perf_counter()
+        for i, value in enumerate(values):
+            new = copy.deepcopy(state)
+            new[motes[i % len(motes)]].update(data=value)
+            if state != new:
+                state = new
+                with open(path, 'w') as file:
+                    json.dump(state, file, indent=2)
+        dt = time.perf_counter() - t0
+        print(f'{"json":<12} {args.n / dt:8.0f} updates/s')
+
+        for batch in (1, args.batch):
+            state = State(os.path.join(tmpdir, f'state.{batch}.db'))
+            state.update({mote: {'data': '', 'cmd_time': 0} for mote in motes})
+            state.flush()
+            t0 = time.perf_counter()
+            for i, value in enumerate(values):
+                state.set(motes[i % len(motes)], data=value)
+                if (i + 1) % batch == 0:
+                    state.flush()
+            state.flush()
+            dt = time.perf_counter() - t0
+            state.close()
+            print(f'{"sqlite/" + str(batch):<12} {args.n / dt:8.0f} updates/s')
+
+
+def bench_archive(args):
+    """
+    Archive writes, like wsn_raw_archive: the daily file opened, appended and
+    closed for every message (as before, without fsync), against the buffered
+    writer flushed and synced (unless --no-fsync) every --batch messages.
+    """
+    motes = [f'0013A20041{i:06X}' for i in range(args.motes)]
+    received = int(time.time())
+    lines = [
+        (motes[i % len(motes)], json.dumps({'source_addr': motes[i % len(motes)], 'data': 'x' * 100, 'received': received}))
+        for i in range(args.n)
+    ]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        day = time.strftime('%Y%m%d')
+        datadir = os.path.join(tmpdir, 'open')
+        t0 = time.perf_counter()
+        for dirname, line in lines:
+            dirpath = os.path.join(datadir, dirname)
+            os.makedirs(dirpath, exist_ok=True)
+            with open(os.path.join(dirpath, day), 'a+') as file:
+                file.write(line + '\n')
+        dt = time.perf_counter() - t0
+        print(f'{"open/close":<16} {args.n / dt:8.0f} msg/s')
+
+        for batch in args.batch:
+            writer = Writer(os.path.join(tmpdir, f'writer.{batch}'), args.max_open, args.fsync)
+            t0 = time.perf_counter()
+            for i, (dirname, line) in enumerate(lines):
+                writer.write(dirname, day, line, received)
+                if (i + 1) % batch == 0:
+                    writer.flush()
+            writer.close()
+            dt = time.perf_counter() - t0
+            print(f'{"writer/" + str(batch):<16} {args.n / dt:8.0f} msg/s')
+
+
+def get_size(path):
+    return sum(
+        os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, dirnames, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+
+def bench_series(args):
+    """
+    Load one field of one mote, over --days days: from the cooked archive,
+    parsing every line, compressed or not, against the time series.
+    """
+    fields = ['bat', 'bme_tc', 'bme_hum', 'bme_pres', 'mlx_object', 'mlx_ambient', 'sht_tc', 'sht_hum', 'ds2_speed', 'ds2_dir']
+    t0 = int(time.time()) - args.days * 86400
+    t0 -= t0 % 86400
+    rng = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cooked = Writer(os.path.join(tmpdir, 'cooked'), fsync=False)
+        store = series.Writer(os.path.join(tmpdir, 'series'), fsync=False)
+        for day in range(args.days):
+            for i in range(86400 // args.period):
+                tst = t0 + day * 86400 + i * args.period
+                frame = {'type': 0, 'serial': 1, 'frame': i % 256, 'name': 'mote', 'tst': tst,
+                         'received': tst + 2, 'source_addr': '0013A200416A0723'}
+                frame.update((field, round(rng.uniform(0, 100), 2)) for field in fields)
+                cooked.write(frame['source_addr'], series.get_day(tst), json.dumps(frame), frame['received'])
+                store.add(frame)
+            cooked.flush()
+            store.flush()
+        cooked.close()
+
+        # Roll the series, like wsn_data_series does every day
+        for dirpath, dirnames, filenames in os.walk(store.datadir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename[:-len(series.PART)])
+                os.rename(path + series.PART, path + archive.CLOSED)
+                series.roll(path)
+
+        dirpath = os.path.join(cooked.datadir, '0013A200416A0723')
+        days = sorted(filename for filename in os.listdir(dirpath) if archive.DAY.match(filename))
+
+        def load_json():
+            values = []
+            for day in days:
+                for line in archive.read_lines(os.path.join(dirpath, day)):
+                    frame = json.loads(line)
+                    values.append(frame['bme_tc'])
+            return values
+
+        def measure(name, load, path):
+            t = time.perf_counter()
+            n = len(load())
+            dt = time.perf_counter() - t
+            print(f'{name:<8} {n:8d} values {dt * 1000:8.1f} ms {get_size(path) / 1e6:8.2f} MB')
+
+        measure('json', load_json, cooked.datadir)
+
+        # Compress the archive, like wsn_data_archive does every day
+        for day in days:
+            path = os.path.join(dirpath, day)
+            os.rename(path, path + archive.CLOSED)
+            archive.compress(path)
+        measure('json.gz', load_json, cooked.datadir)
+
+        load = lambda: series.read(store.datadir, '0013A200416A0723', 'bme_tc')[1]
+        measure('series', load, store.datadir)
+
+
+# Startup budget of every program, seconds to "Setup done." and resident memory
+# in MB then. Those that need the radio to start are only imported. Set for a
+# development laptop, save the budget of the target hardware with --save.
+STARTUP_BUDGET = {
+    'wsn_xbee': (0.6, 50),
+    'wsn_lora': (0.6, 50),
+    'wsn_usb': (1.0, 80),
+    'wsn_raw_cook': (1.0, 80),
+    'wsn_raw_archive': (0.6, 50),
+    'wsn_data_archive': (0.6, 50),
+    'wsn_data_series': (0.8, 60),
+    'wsn_data_django': (1.0, 80),
+}
+IMPORT_ONLY = {'wsn_xbee', 'wsn_lora'}
+
+STARTUP_CONFIG = """
+[wsn_usb]
+port = /dev/null
+[wsn_raw_cook]
+[wsn_raw_archive]
+[wsn_data_archive]
+[wsn_data_series]
+[wsn_data_django]
+url = http://localhost/api/create/
+token =
+"""
+
+
+def get_vmrss(pid):
+    """
+    Return the resident memory of the process, in KB (Linux only).
+    """
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def measure_startup(name, cwd, timeout=30):
+    """
+    Start the program and return the seconds it took to be ready (the setup is
+    done, or imported if it needs the radio) and its resident memory in KB
+    then. None if it did not get ready.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f'{name}.py')
+    if name in IMPORT_ONLY:
+        code = f'import sys; sys.path.insert(0, {os.path.dirname(path)!r}); import {name}; print("Setup done.")\ninput()'
+        command = [sys.executable, '-c', code]
+    else:
+        command = [sys.executable, path]
+
+    t0 = time.perf_counter()
+    process = subprocess.Popen(
+        command, cwd=cwd, text=True,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+    )
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    try:
+        for line in process.stdout:
+            if 'Setup done.' in line:
+                return time.perf_counter() - t0, get_vmrss(process.pid)
+        return None
+    finally:
+        timer.cancel()
+        process.kill()
+        process.wait()
+
+
+def bench_startup(args):
+    """
+    Time to "Setup done." and resident memory of every program, checked
+    against the startup budget. Exits with 1 if a program is over budget.
+    """
+    budget = STARTUP_BUDGET
+    if os.path.exists(args.budget):
+        with open(args.budget) as file:
+            budget = json.load(file)
+
+    measured = {}
+    over = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.mkdir(os.path.join(tmpdir, 'var'))
+        with open(os.path.join(tmpdir, 'config.ini'), 'w') as config:
+            config.write(STARTUP_CONFIG)
+            if args.broker == 'sqlite':
+                config.write('[broker]\nbackend = sqlite\npath = var/broker.db\n')
+
+        for name in args.programs:
+            # The best of several runs, the first ones may compile the modules
+            results = [measure_startup(name, tmpdir) for i in range(args.runs)]
+            results = [x for x in results if x is not None]
+            if not results:
+                print(f'{name:<20} not ready')
+                over.append(name)
+                continue
+
+            seconds = min(x[0] for x in results)
+            rss = min(x[1] for x in results) / 1024
+            measured[name] = (seconds, rss)
+            max_seconds, max_rss = budget.get(name, (None, None))
+            status = 'OK'
+            if max_seconds is not None and (seconds > max_seconds or rss > max_rss):
+                status = f'OVER BUDGET ({max_seconds}s, {max_rss} MB)'
+                over.append(name)
+            print(f'{name:<20} {seconds:5.2f}s {rss:6.1f} MB  {status}')
+
+    if args.save:
+        # With some margin
+        budget = {name: (round(x[0] * 1.5, 2), round(x[1] * 1.2)) for name, x in measured.items()}
+        with open(args.budget, 'w') as file:
+            json.dump(budget, file, indent=2)
+        print(f'Budget saved to {args.budget}')
+    elif over:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparser = subparsers.add_parser('outbox', help=bench_outbox.__doc__)
+    subparser.add_argument('-n', type=int, default=5000, help='number of messages')
+    subparser.add_argument('--batch', type=int, nargs='+', default=[1, 5, 20, 100])
+    subparser.set_defaults(func=bench_outbox)
+
+    subparser = subparsers.add_parser('pipeline', help=bench_pipeline.__doc__)
+    subparser.add_argument('-n', type=int, default=1000, help='number of messages')
+    subparser.add_argument('--rate', type=float, default=200, help='messages per second')
+    subparser.add_argument('--maxsize', type=int, default=1000, help='max number of messages per queue')
+    subparser.add_argument('--broker', choices=['memory', 'sqlite', 'rabbitmq'], default='memory',
+                           help='memory runs the stages in a single process, the others one process per stage')
+    subparser.add_argument('--poll-interval', type=float, default=0.2, help='of the SQLite broker')
+    subparser.set_defaults(func=bench_pipeline)
+
+    subparser = subparsers.add_parser('memory', help=bench_memory.__doc__)
+    subparser.add_argument('programs', nargs='*', default=['wsn_xbee', 'wsn_raw_cook', 'wsn_raw_archive', 'wsn_data_archive', 'wsn_data_django'])
+    subparser.set_defaults(func=bench_memory)
+
+    subparser = subparsers.add_parser('startup', help=bench_startup.__doc__)
+    subparser.add_argument('programs', nargs='*', default=list(STARTUP_BUDGET))
+    subparser.add_argument('--broker', choices=['sqlite', 'rabbitmq'], default='sqlite')
+    subparser.add_argument('--runs', type=int, default=3, help='runs per program, the best is kept')
+    subparser.add_argument('--budget', default='var/startup.json', help='budget file, if it exists')
+    subparser.add_argument('--save', action='store_true', help='save the budget, from the measures')
+    subparser.set_defaults(func=bench_startup)
+
+    subparser = subparsers.add_parser('state', help=bench_state.__doc__)
+    subparser.add_argument('-n', type=int, default=2000, help='number of updates')
+    subparser.add_argument('--motes', type=int, default=50)
+    subparser.add_argument('--batch', type=int, default=100, help='updates per flush')
+    subparser.set_defaults(func=bench_state)
+
+    subparser = subparsers.add_parser('archive', help=bench_archive.__doc__)
+    subparser.add_argument('-n', type=int, default=5000, help='number of messages')
+    subparser.add_argument('--motes', type=int, default=50)
+    subparser.add_argument('--batch', type=int, nargs='+', default=[1, 50, 500], help='messages per flush')
+    subparser.add_argument('--max-open', type=int, default=32, help='max number of files open')
+    subparser.add_argument('--no-fsync', dest='fsync', action='store_false')
+    subparser.set_defaults(func=bench_archive)
+
+    subparser = subparsers.add_parser('series', help=bench_series.__doc__)
+    subparser.add_argument('--days', type=int, default=30)
+    subparser.add_argument('--period', type=int, default=300, help='seconds between frames')
+    subparser.set_defaults(func=bench_series)
+
+    args = parser.parse_args()
+    args.func(args)
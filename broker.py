@@ -0,0 +1,426 @@
+"""
+In-process message broker, a stand-in for RabbitMQ when all the programs run
+in a single process (see pipeline.py).
+
+It implements the subset of pika used by MQ: a connection, channels, topic,
+fanout, direct and consistent hash exchanges, exchange to exchange bindings,
+queues with TTL and dead lettering (for the retry queues), prefetch, acks,
+nacks and publisher confirms. Everything runs in an asyncio event loop.
+
+The queues are bounded, when a queue is full the message is rejected, and the
+publisher gets a nack (like RabbitMQ with x-overflow=reject-publish). The
+queues live in memory, they are lost if the process exits.
+"""
+
+# Standard Library
+import asyncio
+import collections
+import types
+import zlib
+
+# Requirements
+import pika
+
+
+Message = collections.namedtuple('Message', ['exchange', 'routing_key', 'properties', 'body'])
+
+
+def topic_match(pattern, routing_key):
+    """
+    Whether the routing key matches the binding pattern: words are separated
+    by dots, * matches one word, # zero or more words.
+    """
+    def match(pattern, words):
+        if not pattern:
+            return not words
+
+        head, tail = pattern[0], pattern[1:]
+        if head == '#':
+            return any(match(tail, words[i:]) for i in range(len(words) + 1))
+
+        if not words:
+            return False
+
+        return (head == '*' or head == words[0]) and match(tail, words[1:])
+
+    return match(pattern.split('.'), routing_key.split('.'))
+
+
+class IOLoop:
+    """
+    The subset of pika's IOLoop used by MQ, on top of an asyncio loop.
+    """
+
+    READ = 0x0001
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def call_later(self, delay, callback):
+        return self.loop.call_later(delay, callback)
+
+    def remove_timeout(self, handle):
+        handle.cancel()
+
+    def add_callback(self, callback):
+        self.loop.call_soon(callback)
+
+    def add_callback_threadsafe(self, callback):
+        self.loop.call_soon_threadsafe(callback)
+
+    def add_handler(self, fileno, handler, events):
+        self.loop.add_reader(fileno, handler, fileno, events)
+
+    def remove_handler(self, fileno):
+        self.loop.remove_reader(fileno)
+
+    def start(self):
+        self.loop.run_forever()
+
+    def stop(self):
+        # Wakes up the loop, it may be called from a signal handler
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def route(exchanges, queues, exchange, routing_key):
+    """
+    Return the names of the queues the message goes to, given the exchanges
+    (name -> Exchange) and the queue names.
+    """
+    # Default exchange, the routing key is the queue name
+    if exchange == '':
+        return [routing_key] if routing_key in queues else []
+
+    exchange = exchanges.get(exchange)
+    if exchange is None:
+        return []
+
+    bindings = exchange.bindings
+    if exchange.type == 'fanout':
+        targets = bindings
+    elif exchange.type == 'topic':
+        targets = [x for x in bindings if topic_match(x[1], routing_key)]
+    elif exchange.type == 'x-consistent-hash':
+        # The binding key is the weight
+        targets = []
+        total = sum(int(x[1]) for x in bindings)
+        if total:
+            point = zlib.crc32(routing_key.encode()) % total
+            for binding in sorted(bindings):
+                point -= int(binding[1])
+                if point < 0:
+                    targets = [binding]
+                    break
+    else:
+        targets = [x for x in bindings if x[1] == routing_key]
+
+    names = []
+    for destination, key, is_exchange in targets:
+        if is_exchange:
+            names.extend(route(exchanges, queues, destination, routing_key))
+        else:
+            names.append(destination)
+
+    return names
+
+
+class Exchange:
+
+    def __init__(self, exchange_type):
+        self.type = exchange_type
+        self.bindings = [] # (destination, routing_key, is_exchange)
+
+
+class Queue:
+
+    def __init__(self, name, arguments):
+        self.name = name
+        self.arguments = arguments or {}
+        self.messages = collections.deque()
+        self.consumer = None # (channel, callback, consumer_tag)
+        self.consumed = False # Whether it had a consumer, then it is bounded
+        self.scheduled = False
+
+
+class Broker:
+    """
+    The exchanges and queues, shared by the connections.
+
+    Only the queues that have a consumer are bounded (maxsize), not the retry
+    or dead letter queues.
+    """
+
+    def __init__(self, maxsize=1000, loop=None):
+        self.loop = loop or asyncio.new_event_loop()
+        self.ioloop = IOLoop(self.loop)
+        self.maxsize = maxsize
+        self.exchanges = {}
+        self.queues = {}
+        self.stats = {
+            'published': 0, # Messages put in a queue
+            'rejected': 0, # Messages rejected because the queue was full
+            'delivered': 0,
+        }
+
+    def connect(self, on_open_callback, on_open_error_callback, on_close_callback):
+        """
+        Same as pika.SelectConnection
+        """
+        connection = Connection(self, on_close_callback)
+        self.loop.call_soon(on_open_callback, connection)
+        return connection
+
+    def open_channel(self, connection):
+        return Channel(connection)
+
+    #
+    # Routing
+    #
+    def route(self, exchange, routing_key):
+        """
+        Return the names of the queues the message goes to.
+        """
+        return route(self.exchanges, self.queues, exchange, routing_key)
+
+    def publish(self, message):
+        """
+        Route the message to its queues. Return False if rejected by a full
+        queue.
+        """
+        queues = [self.queues[name] for name in self.route(message.exchange, message.routing_key)]
+        maxsize = self.maxsize
+        if any(queue.consumed and len(queue.messages) >= maxsize for queue in queues):
+            self.stats['rejected'] += 1
+            return False
+
+        for queue in queues:
+            self.put(queue, message)
+
+        return True
+
+    def put(self, queue, message):
+        self.stats['published'] += 1
+
+        # Queue with a TTL, the message expires and goes to the dead letter
+        # exchange (the retry queues)
+        ttl = queue.arguments.get('x-message-ttl')
+        if ttl is not None:
+            self.loop.call_later(ttl / 1000, self.dead_letter, queue, message)
+            return
+
+        queue.messages.append(message)
+        self.schedule(queue)
+
+    def dead_letter(self, queue, message):
+        arguments = queue.arguments
+        exchange = arguments.get('x-dead-letter-exchange')
+        if exchange is None:
+            return
+
+        routing_key = arguments.get('x-dead-letter-routing-key', message.routing_key)
+        message = message._replace(exchange=exchange, routing_key=routing_key)
+        for name in self.route(exchange, routing_key):
+            self.put(self.queues[name], message)
+
+    #
+    # Delivery
+    #
+    def schedule(self, queue):
+        if not queue.scheduled and queue.consumer is not None:
+            queue.scheduled = True
+            self.loop.call_soon(self.deliver, queue)
+
+    def deliver(self, queue, batch=50):
+        queue.scheduled = False
+        if queue.consumer is None:
+            return
+
+        channel, callback, consumer_tag = queue.consumer
+        for i in range(batch):
+            if not queue.messages or not channel.can_deliver():
+                return
+
+            message = queue.messages.popleft()
+            method, properties, body = channel.track(queue, message, consumer_tag)
+            self.stats['delivered'] += 1
+            callback(channel, method, properties, body)
+
+            # The consumer may have been cancelled
+            if queue.consumer is None:
+                return
+
+        # Let other events run before the next batch
+        self.schedule(queue)
+
+    def requeue(self, queue, message):
+        queue.messages.appendleft(message)
+        self.schedule(queue)
+
+
+class Connection:
+    """
+    Same interface as pika.SelectConnection, the part used by MQ.
+    """
+
+    def __init__(self, broker, on_close_callback):
+        self.broker = broker
+        self.ioloop = broker.ioloop
+        self.on_close_callback = on_close_callback
+        self.channels = []
+        self.is_open = True
+        self.is_closing = False
+        self.is_closed = False
+
+    def channel(self, on_open_callback=None):
+        channel = self.broker.open_channel(self)
+        self.channels.append(channel)
+        if on_open_callback is not None:
+            self.broker.loop.call_soon(on_open_callback, channel)
+        return channel
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        for channel in self.channels:
+            if channel.is_open:
+                channel.close()
+
+        self.is_open = False
+        self.is_closed = True
+        self.broker.loop.call_soon(self.on_close_callback, self, reply_text)
+
+
+class Channel:
+    """
+    Same interface as pika's channels, the part used by MQ.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_open = True
+        self.close_callbacks = []
+        self.prefetch_count = 0
+        self.confirm_callback = None # Publisher confirms
+        self.publish_tag = 0
+        self.delivery_tag = 0
+        self.unacked = collections.OrderedDict() # delivery tag -> (queue, message)
+
+    def ok(self, callback, method=None):
+        if callback is not None:
+            frame = types.SimpleNamespace(method=method)
+            self.broker.loop.call_soon(callback, frame)
+
+    # Setup
+    def exchange_declare(self, exchange, exchange_type='direct', durable=False, callback=None):
+        self.broker.exchanges.setdefault(exchange, Exchange(exchange_type))
+        self.ok(callback)
+
+    def exchange_bind(self, destination, source, routing_key='', callback=None):
+        bindings = self.broker.exchanges[source].bindings
+        binding = (destination, routing_key, True)
+        if binding not in bindings:
+            bindings.append(binding)
+        self.ok(callback)
+
+    def queue_declare(self, queue, durable=False, arguments=None, callback=None):
+        queues = self.broker.queues
+        if queue not in queues:
+            queues[queue] = Queue(queue, arguments)
+        self.ok(callback)
+
+    def queue_bind(self, queue, exchange, routing_key=None, callback=None):
+        bindings = self.broker.exchanges[exchange].bindings
+        binding = (queue, routing_key or queue, False)
+        if binding not in bindings:
+            bindings.append(binding)
+        self.ok(callback)
+
+    def basic_qos(self, prefetch_count=0, callback=None):
+        self.prefetch_count = prefetch_count
+        self.ok(callback)
+
+    def confirm_delivery(self, ack_nack_callback, callback=None):
+        self.confirm_callback = ack_nack_callback
+        self.ok(callback)
+
+    def add_on_close_callback(self, callback):
+        self.close_callbacks.append(callback)
+
+    # Publish
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        if isinstance(body, str):
+            body = body.encode()
+
+        message = Message(exchange, routing_key, properties, body)
+        published = self.broker.publish(message)
+        if self.confirm_callback is not None:
+            self.publish_tag += 1
+            confirm = pika.spec.Basic.Ack if published else pika.spec.Basic.Nack
+            self.ok(self.confirm_callback, confirm(delivery_tag=self.publish_tag))
+
+    # Consume
+    def basic_consume(self, queue, on_message_callback, consumer_tag=None):
+        queue = self.broker.queues[queue]
+        queue.consumer = (self, on_message_callback, consumer_tag)
+        queue.consumed = True
+        self.broker.schedule(queue)
+
+    def basic_cancel(self, consumer_tag=None, callback=None):
+        for queue in self.broker.queues.values():
+            consumer = queue.consumer
+            if consumer is not None and consumer[0] is self and consumer[2] == consumer_tag:
+                queue.consumer = None
+        self.ok(callback)
+
+    def can_deliver(self):
+        return self.is_open and (not self.prefetch_count or len(self.unacked) < self.prefetch_count)
+
+    def track(self, queue, message, consumer_tag):
+        self.delivery_tag += 1
+        self.unacked[self.delivery_tag] = (queue, message)
+        method = types.SimpleNamespace(
+            delivery_tag=self.delivery_tag,
+            consumer_tag=consumer_tag,
+            exchange=message.exchange,
+            routing_key=message.routing_key,
+            redelivered=False,
+        )
+        return method, message.properties, message.body
+
+    def settle(self, delivery_tag, multiple):
+        if multiple:
+            tags = [tag for tag in self.unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+
+        settled = [self.unacked.pop(tag) for tag in tags if tag in self.unacked]
+        # More messages may be delivered now
+        for queue in {queue for queue, message in settled}:
+            self.broker.schedule(queue)
+
+        return settled
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.settle(delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        for queue, message in reversed(self.settle(delivery_tag, multiple)):
+            if requeue:
+                self.broker.requeue(queue, message)
+            else:
+                self.broker.dead_letter(queue, message)
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        self.is_open = False
+        broker = self.broker
+
+        # Cancel the consumers, and put the messages not acknowledged back in
+        # their queues
+        for queue in broker.queues.values():
+            if queue.consumer is not None and queue.consumer[0] is self:
+                queue.consumer = None
+        for queue, message in reversed(list(self.unacked.values())):
+            broker.requeue(queue, message)
+        self.unacked.clear()
+
+        for callback in self.close_callbacks:
+            broker.loop.call_soon(callback, self, reply_text)
@@ -0,0 +1,91 @@
+"""
+Columnar output for the batch parsers (waspmote.parse_frames and
+riot.parse_frames): one NumPy array per field, one row per frame.
+"""
+
+# Requirements
+import numpy
+
+
+# Fields found in every frame, they keep an integer type
+DTYPES = {
+    'type': numpy.uint8,
+    'serial': numpy.uint64,
+    'frame': numpy.uint8,
+    'received': numpy.int64,
+}
+
+
+class Columns:
+    """
+    Collects the values row by row (add_row) or a column at a time
+    (add_column), then builds the arrays (to_arrays).
+
+    Numeric fields become float64 arrays, with NaN where a frame does not
+    have the field. Other fields (names, arrays of values) become object
+    arrays, with None for missing values.
+    """
+
+    def __init__(self, dtypes=DTYPES):
+        self.dtypes = dtypes
+        self.nrows = 0
+        self.scalars = {} # name -> ([row, ...], [value, ...])
+        self.arrays = {} # name -> [(rows, values), ...]
+
+    def add_row(self, values=None):
+        """
+        Add a row, with the values in the given dict if any. Return the index
+        of the new row.
+        """
+        row = self.nrows
+        self.nrows += 1
+        if values:
+            for name, value in values.items():
+                rows, column = self.scalars.setdefault(name, ([], []))
+                rows.append(row)
+                column.append(value)
+
+        return row
+
+    def add_column(self, name, rows, values):
+        """
+        Set the values of the given rows in one go, both are arrays.
+        """
+        self.arrays.setdefault(name, []).append((rows, values))
+
+    def to_arrays(self):
+        names = list(self.scalars)
+        names.extend(name for name in self.arrays if name not in self.scalars)
+
+        columns = {}
+        for name in names:
+            rows, values = self.scalars.get(name, ((), ()))
+            parts = self.arrays.get(name, [])
+
+            # Integer fields found in every frame, with a known type
+            dtype = self.dtypes.get(name)
+            complete = not parts and len(rows) == self.nrows
+            if dtype is not None and complete and all(type(value) is int for value in values):
+                columns[name] = numpy.array(values, dtype=dtype)
+                continue
+
+            # Numeric
+            if all(type(value) in (int, float) for value in values):
+                column = numpy.full(self.nrows, numpy.nan)
+                if rows: # Missing if the field is only in the grouped frames
+                    column[rows] = values
+                for part_rows, part_values in parts:
+                    column[part_rows] = part_values
+                columns[name] = column
+                continue
+
+            # Anything else
+            column = numpy.full(self.nrows, None, dtype=object)
+            for row, value in zip(rows, values):
+                column[row] = value
+            for part_rows, part_values in parts:
+                for row, value in zip(part_rows, part_values.tolist()):
+                    column[row] = value
+            columns[name] = column
+
+        return columns
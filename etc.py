@@ -28,18 +28,23 @@ supervisor.rpcinterface_factory = supervisor.rpcinterface:make_main_rpcinterface
 """
 
 supervisor_program = f"""[program:{{name}}]
-command={sys.executable} %(program_name)s.py
+command={sys.executable} %(program_name)s.py{{args}}
+process_name={{process_name}}
+numprocs={{numprocs}}
 directory={cwd}
 autostart={{autostart}}
 startsecs=3
 startretries=20
 priority={{priority}}
-stderr_logfile={cwd}/log/%(program_name)s.err.log
-stdout_logfile={cwd}/log/%(program_name)s.out.log
+stderr_logfile={cwd}/log/%(process_name)s.err.log
+stdout_logfile={cwd}/log/%(process_name)s.out.log
 """
 
 defaults = {
     'autostart': 'true',
+    'args': '',
+    'process_name': '%(program_name)s',
+    'numprocs': 1,
 }
 
 programs = {
@@ -50,17 +55,66 @@ programs = {
     'wsn_raw_cook': {'priority': 2},
     'wsn_data_archive': {'priority': 3},
     'wsn_data_django': {'priority': 3},
+    'wsn_data_series': {'priority': 3},
+    'pipeline': {'priority': 1},
+    'launcher': {'priority': 1},
 }
 
+# Sections of config.ini that are not for supervisor
+skip = {'broker'}
+
+def get_list(config_parser, name, option):
+    if not config_parser.has_section(name):
+        return []
+
+    value = config_parser[name].get(option, '')
+    return value.replace(',', ' ').split()
+
+
+def get_programs(config_parser):
+    """
+    Return the names of the programs to run on their own, by supervisor or by
+    launcher.py. Those run by pipeline.py are not.
+    """
+    pipelined = get_list(config_parser, 'pipeline', 'programs')
+    return [
+        name for name in config_parser.sections()
+        if name in programs and name != 'launcher' and name not in pipelined
+    ]
+
+
+def get_launched(config_parser):
+    """
+    Return the names of the programs run by launcher.py, if enabled: those
+    given in its section, all by default.
+    """
+    if not config_parser.has_section('launcher'):
+        return []
+
+    return get_list(config_parser, 'launcher', 'programs') or get_programs(config_parser)
+
+
 def write_supervisor(file):
 
+    # The programs run by pipeline.py or launcher.py are not run on their own
+    pipelined = get_list(config_parser, 'pipeline', 'programs')
+    launched = get_launched(config_parser)
+
     for name in config_parser.sections():
         section = dict(config_parser[name])
-        if name in programs:
+        if name in pipelined or name in launched or name in skip:
+            continue
+        elif name in programs:
             data = defaults.copy()
             data['name'] = name
             data.update(programs[name])
             data.update(section)
+            # Several workers, each one gets its number as argument
+            workers = int(section.get('workers', 1))
+            if workers > 1:
+                data['args'] = ' %(process_num)d'
+                data['process_name'] = '%(program_name)s_%(process_num)d'
+                data['numprocs'] = workers
             file.write(supervisor_program.format(**data))
             file.write('\n')
         else:
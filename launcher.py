@@ -0,0 +1,213 @@
+"""
+Run the programs as children of a single process, which imports the common
+modules (pika, requests, cbor2, ...) once, then forks a child per program. So
+the programs start faster, and the memory of the modules is shared between
+them (copy on write):
+
+    python launcher.py wsn_xbee wsn_raw_cook wsn_raw_archive wsn_data_archive
+
+Without arguments the programs are read from the configuration, all of them
+by default (see etc.py):
+
+    [launcher]
+    programs = wsn_xbee, wsn_raw_cook, wsn_raw_archive, wsn_data_archive
+
+Children that exit are started again, forked from the launcher, without
+importing the modules again. The output of every child goes to its own files
+in log/, like with supervisor.
+"""
+
+# Standard Library
+import argparse
+from configparser import RawConfigParser as ConfigParser
+import gc
+import importlib
+import logging
+import os
+import runpy
+import signal
+import sys
+import time
+import traceback
+
+# Project
+import etc
+
+
+# Imported by the programs, some of them only when used
+PRELOAD = ['cbor2', 'pika', 'requests', 'Crypto.Cipher.AES', 'digi.xbee.devices']
+
+logger = logging.getLogger('launcher')
+
+
+class Process:
+
+    def __init__(self, name, program, args):
+        self.name = name # Process name, e.g. wsn_raw_cook_0
+        self.program = program
+        self.args = args
+        self.pid = None
+        self.started = None # When it was last started
+        self.restart_at = None # When to start it again
+        self.restarts = 0 # Consecutive quick exits
+
+
+class Launcher:
+
+    startsecs = 3 # A child that exits before this many seconds failed to start
+    restart_delay = 0.1 # Seconds before restarting a child that failed to start
+    max_restart_delay = 60 # Doubled on every failure, up to this many seconds
+    stopwaitsecs = 10 # Seconds the children have to exit, then they are killed
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.stopping = False
+
+    def preload(self):
+        """
+        Import the modules used by the programs, and the programs themselves.
+        """
+        t0 = time.perf_counter()
+        modules = PRELOAD + sorted({process.program for process in self.processes})
+        for name in modules:
+            try:
+                importlib.import_module(name)
+            except ImportError as exc:
+                logger.warning('Failed to preload %s: %s', name, exc)
+
+        # So the garbage collector does not touch the objects, and the pages
+        # stay shared
+        gc.freeze()
+        logger.info('Preloaded %d modules in %.2fs', len(modules), time.perf_counter() - t0)
+
+    def spawn(self, process):
+        process.started = time.time()
+        process.restart_at = None
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            process.pid = pid
+            logger.info('Started %s pid=%d', process.name, pid)
+            return
+
+        # Child
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            logging.root.handlers.clear() # The program configures its own
+            for fd, suffix in [(1, 'out'), (2, 'err')]:
+                path = os.path.join('log', f'{process.name}.{suffix}.log')
+                log_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                os.dup2(log_fd, fd)
+                os.close(log_fd)
+
+            sys.argv = [f'{process.program}.py'] + process.args
+            runpy.run_module(process.program, run_name='__main__')
+            code = 0
+        except SystemExit as exc:
+            code = exc.code if isinstance(exc.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def on_exit(self, process, status):
+        process.pid = None
+        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        if self.stopping:
+            logger.info('Stopped %s (%d)', process.name, code)
+            return
+
+        # Restart right away if it ran for a while, otherwise back off
+        if time.time() - process.started >= self.startsecs:
+            process.restarts = 0
+            delay = 0
+        else:
+            delay = min(self.restart_delay * 2 ** process.restarts, self.max_restart_delay)
+            process.restarts += 1
+
+        logger.warning('%s exited (%d), restart in %.1fs', process.name, code, delay)
+        process.restart_at = time.time() + delay
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for process in self.processes:
+            if process.pid is not None:
+                os.kill(process.pid, signal.SIGTERM)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self.preload()
+        for process in self.processes:
+            self.spawn(process)
+
+        stop_time = None
+        while True:
+            by_pid = {process.pid: process for process in self.processes if process.pid is not None}
+            if not by_pid and self.stopping:
+                break
+
+            # Kill the children that do not stop
+            if self.stopping:
+                stop_time = stop_time or time.time()
+                if time.time() - stop_time > self.stopwaitsecs:
+                    for pid in by_pid:
+                        os.kill(pid, signal.SIGKILL)
+
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+
+            if pid in by_pid:
+                self.on_exit(by_pid[pid], status)
+                continue
+
+            # Restart the children that are due
+            now = time.time()
+            for process in self.processes:
+                if process.restart_at is not None and process.restart_at <= now and not self.stopping:
+                    self.spawn(process)
+
+            time.sleep(0.1)
+
+
+def get_processes(config_parser, names):
+    """
+    Return the processes of the given programs, one per worker.
+    """
+    processes = []
+    for name in names:
+        workers = int(config_parser[name].get('workers', 1)) if config_parser.has_section(name) else 1
+        if workers > 1:
+            processes.extend(Process(f'{name}_{i}', name, [str(i)]) for i in range(workers))
+        else:
+            processes.append(Process(name, name, []))
+
+    return processes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('programs', nargs='*', help=', '.join(x for x in etc.programs if x != 'launcher'))
+    args = parser.parse_args()
+
+    config_parser = ConfigParser()
+    config_parser.read('config.ini')
+    names = args.programs or etc.get_launched(config_parser)
+    if not names:
+        parser.error('no programs given')
+    unknown = set(names) - (set(etc.programs) - {'launcher'})
+    if unknown:
+        parser.error(f'unknown programs: {", ".join(sorted(unknown))}')
+
+    log_format = '%(asctime)s pid=%(process)d %(threadName)s %(name)s %(levelname)s %(message)s'
+    logging.basicConfig(format=log_format, level=logging.INFO, stream=sys.stdout)
+    os.makedirs('log', exist_ok=True)
+    Launcher(get_processes(config_parser, names)).run()
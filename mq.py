@@ -1,23 +1,138 @@
 # Standard Library
-import copy
+import base64
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import itertools
 import json
 import logging
+import queue
+import random
 import signal
 import sys
+import threading
+import time
 
 # Requirements
+import cbor2
 import pika
+from pika.adapters.select_connection import IOLoop
 
 # Project
+from outbox import Outbox
+from state import State
 import utils
 
 
+ENVELOPE = 'envelope' # Message type of the messages holding several frames
+DEAD_LETTERS = 'wsn_dead' # Exchange for the messages that failed for good
+
+# Supported encodings, the content type tells the consumer how to decode
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'cbor': 'application/cbor',
+}
+
+
+def json_default(value):
+    """
+    Bytes are not supported by JSON, they are base64 encoded.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode()
+
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def encode(body, content_type):
+    if content_type == 'application/cbor':
+        return cbor2.dumps(body)
+
+    return json.dumps(body, default=json_default)
+
+
+def decode(body, content_type):
+    if content_type == 'application/cbor':
+        return cbor2.loads(body)
+
+    return json.loads(body.decode())
+
+
+def pack(bodies, content_type):
+    """
+    Return the envelope with the given encoded frames, a list.
+    """
+    if content_type == 'application/cbor':
+        return b'\x9f' + b''.join(bodies) + b'\xff' # Indefinite length array
+
+    return '[' + ','.join(bodies) + ']'
+
+
 class Pause(Exception):
+    """
+    The consumer is not able to handle messages for some time (e.g. a remote
+    server is down): the message goes back to the queue and the consumer is
+    paused for the given number of seconds.
+    """
 
     def __init__(self, time):
         self.time = time
 
 
+class Retry(Exception):
+    """
+    Temporary error, the message will be handled again later, with
+    exponential backoff. See MQ.retry_delays
+    """
+
+
+class Reject(Exception):
+    """
+    Permanent error, the message goes to the dead letter exchange.
+    """
+
+
+def routing_key(*parts):
+    """
+    Join the given parts with dots, missing parts become 'null'.
+    """
+    parts = ['null' if part is None or part == '' else str(part).replace('.', '_') for part in parts]
+    return '.'.join(parts)
+
+
+def retry_queue(queue, delay):
+    return f'{queue}.retry.{delay}'
+
+
+brokers = {} # The brokers by path, shared by the programs of a process
+
+def get_broker():
+    """
+    Return the broker given in the [broker] section of the configuration, None
+    for RabbitMQ (the default).
+    """
+    config = utils.get_config('broker') or {}
+    backend = config.get('backend', 'rabbitmq')
+    if backend == 'rabbitmq':
+        return None
+
+    if backend == 'sqlite':
+        import sqlite_broker # Only when used
+
+        path = config.get('path', 'var/broker.db')
+        if path not in brokers:
+            lease = config.get('lease')
+            poll_interval = config.get('poll_interval')
+            brokers[path] = sqlite_broker.Broker(
+                path,
+                lease=float(lease) if lease else None,
+                poll_interval=float(poll_interval) if poll_interval else None,
+            )
+        return brokers[path]
+
+    raise ValueError(f'unexpected broker backend {backend}')
+
+
 class Consumer:
 
     def __init__(self, mq, queue, consumer):
@@ -25,61 +140,149 @@ class Consumer:
         self.queue = queue
         self.consumer = consumer
         self.paused = True
+        self.channel = None
 
     def __call__(self, channel, method, header, body):
         if self.paused:
-            self.mq.info('Paused, skip message')
+            self.mq.info('Paused, requeue message')
+            channel.basic_nack(delivery_tag=method.delivery_tag) # Requeue
             return
 
+        # Handle the message in the ioloop, or in the thread pool if any; then
+        # acknowledge it from the ioloop
+        pool = self.mq.pool
+        if pool is None:
+            result = self.handle(header, body)
+            self.finish(channel, method, header, body, result)
+        else:
+            def done(future):
+                cb = functools.partial(self.finish, channel, method, header, body, future.result())
+                self.mq.ioloop.add_callback_threadsafe(cb)
+
+            pool.submit(self.handle, header, body).add_done_callback(done)
+
+    def handle(self, header, body):
+        """
+        Decode the message and handle its frames, one by one. Return a
+        (n, retry, reject, requeue, pause) tuple: the number of frames (None if
+        the message could not be decoded), the frames that failed (by index),
+        and the seconds to pause the consumer if requested.
+        """
         consumer = self.consumer
         try:
-            body = body.decode()
-            body = json.loads(body)
-            consumer(body)
-        except Pause as exc:
-            self.mq.info('Requeue message and pause consumer')
-            channel.basic_nack(delivery_tag=method.delivery_tag) # Requeue
-            self.pause(exc.time)
-#       except Retry:
-#           # XXX For some temporary errors, we should retry after some time,
-#           # ideally with exponential backoff
-#           # See https://m.alphasights.com/exponential-backoff-with-rabbitmq-78386b9bec81
-#           #channel.basic_nack(delivery_tag=method.delivery_tag)
-#       except Reject:
-#           # TODO For permanent errors, send nack(requeue=False), they should
-#           # become "dead letters"
+            frames = decode(body, header.content_type)
         except Exception:
-            # For unexpected errors, we do nothing. The message will stay in
-            # the queue and only retried when the program is restarted.
-            self.mq.exception('Message handling failed')
+            self.mq.exception('Message decoding failed, send to dead letters')
+            return None, [], [], [], None
+
+        # An envelope holds several frames, see MQ.envelope_size
+        if header.type != ENVELOPE:
+            frames = [frames]
+
+        # The frames are handled one by one, those that fail are sent apart
+        retry = []
+        reject = []
+        for i, frame in enumerate(frames):
+            try:
+                consumer(frame)
+            except Pause as exc:
+                self.mq.info('Requeue message and pause consumer')
+                requeue = list(range(i, len(frames)))
+                return len(frames), retry, reject, requeue, exc.time
+            except Retry:
+                self.mq.warning('Message handling failed, retry later')
+                retry.append(i)
+            except Reject:
+                self.mq.exception('Message rejected')
+                reject.append(i)
+            except Exception:
+                # Unexpected errors are retried as well, if they keep failing
+                # the message becomes a dead letter
+                self.mq.exception('Message handling failed')
+                retry.append(i)
+
+        return len(frames), retry, reject, [], None
+
+    def finish(self, channel, method, header, body, result):
+        # The channel has been closed meanwhile, the message will be delivered
+        # again
+        if not channel.is_open:
+            return
+
+        n, retry, reject, requeue, pause = result
+        if n is None:
+            self.mq.send([(None, DEAD_LETTERS, self.queue, header.content_type, body)])
+            self.mq.ack(channel, method.delivery_tag)
+        elif retry or reject or requeue:
+            self.settle(channel, method, header, body, n, retry, reject, requeue)
         else:
-            channel.basic_ack(delivery_tag=method.delivery_tag)
+            self.mq.ack(channel, method.delivery_tag)
             self.mq.debug('Message received and handled')
 
-    def start(self):
-        self.paused = False
+        # With several threads, more than one may ask to pause
+        if pause is not None and not self.paused:
+            self.pause(pause)
 
-        channel = self.mq.channel
-        queue = self.queue
-        tag = self.mq.name
+    def settle(self, channel, method, header, body, n, retry=(), reject=(), requeue=()):
+        """
+        Acknowledge the message once the frames that failed, given by their
+        index, have been sent: to a retry queue, to the dead letter exchange,
+        or back to the queue.
+        """
+        # The whole message goes back to the queue
+        if len(requeue) == n:
+            channel.basic_nack(delivery_tag=method.delivery_tag) # Requeue
+            return
 
-        cb = self
-        channel.basic_consume(queue, cb, consumer_tag=tag)
-        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        # Decode again, the frames may have been modified by the consumer
+        mq = self.mq
+        content_type = header.content_type
+        frames = decode(body, content_type)
+        if header.type != ENVELOPE:
+            frames = [frames]
 
-    def pause(self, time):
-        self.paused = True
+        def messages(exchange, routing_key, indexes):
+            return [
+                (None, exchange, routing_key, content_type, encode(frames[i], content_type))
+                for i in indexes
+            ]
+
+        headers = header.headers or {}
+        retries = headers.get('x-retries', 0)
+        if retry and retries >= mq.max_retries:
+            mq.warning('Message failed %d times, send to dead letters', retries + 1)
+            reject = list(reject) + list(retry)
+            retry = []
+
+        if retry:
+            delays = mq.retry_delays
+            delay = delays[min(retries, len(delays) - 1)]
+            queue = retry_queue(self.queue, delay)
+            mq.send(messages('', queue, retry), headers={**headers, 'x-retries': retries + 1})
+
+        if reject:
+            mq.send(messages(DEAD_LETTERS, self.queue, reject), headers=headers)
+
+        if requeue:
+            mq.send(messages('', self.queue, requeue), headers=headers)
 
-        channel = self.mq.channel
-        tag = self.mq.name
+        mq.ack(channel, method.delivery_tag)
 
-        cb = self.on_cancel_ok
-        channel.basic_cancel(consumer_tag=tag, callback=cb)
-        signal.signal(signal.SIGALRM, self.resume)
-        signal.alarm(time)
+    def start(self):
+        self.paused = False
+        self.channel = self.mq.channel
+        self.channel.basic_consume(self.queue, self, consumer_tag=self.mq.name)
+
+    def pause(self, time):
+        self.paused = True
+        self.channel.basic_cancel(consumer_tag=self.mq.name, callback=self.on_cancel_ok)
+        self.mq.ioloop.call_later(time, self.resume)
 
-    def resume(self, signum, frame):
-        self.start()
+    def resume(self):
+        # If the channel has been closed meanwhile, a new consumer has been
+        # started after reconnecting
+        if self.channel is self.mq.channel:
+            self.start()
 
     def on_cancel_ok(self, *args, **kw):
         self.mq.info('CancelOK')
@@ -101,7 +304,10 @@ class MQ(object):
         with Publisher() as publisher:
             ...
 
-    Only direct and fanout exchanges are supported.
+    Exchanges are topic exchanges, the routing key of the messages is
+    <transport>.<source_addr>.<type> (see get_routing_key), and sub_to may
+    give the binding patterns. Consistent hash exchanges are supported as well
+    (see sub_from).
     """
 
     name = ''
@@ -111,50 +317,184 @@ class MQ(object):
     bg_task = None # Background task
     db_name = None
 
+    transport = None # First part of the routing key
+    # In-process (broker.py) or SQLite (sqlite_broker.py) broker. If None the
+    # one given in the configuration, RabbitMQ by default (see get_broker)
+    broker = None
+    # The exchange of sub_to may be bound to another exchange, given as an
+    # (exchange, exchange_type) tuple
+    sub_from = None
+
     # QOS
     prefetch_count = None
 
+    # Threads to run the consumer callback, so the ioloop is not blocked by
+    # slow consumers (e.g. HTTP requests). 0 to run it in the ioloop.
+    threads = 0
+
+    # Retries, a message that fails waits in a retry queue before going back to
+    # the queue; there is one retry queue per delay, in seconds
+    retry_delays = [5, 30, 120, 600, 3600]
+    max_retries = 10 # Then the message goes to the dead letter exchange
+
+    # Ingest queue, for messages published from other threads
+    ingest_size = 1000 # Max number of messages waiting
+    ingest_batch = 50 # Max number of messages published per ioloop callback
+    ingest_timeout = 5 # Seconds a thread waits when the queue is full
+
+    # Publisher confirms, enabled when there is an outbox
+    outbox_name = None # Messages not yet confirmed are kept here
+    confirm_batch = 20 # Confirmed messages removed from the outbox at once
+    confirm_timeout = 10 # Seconds publish_threadsafe waits for the confirmation
+
+    # Envelopes, several frames sent in a single message. Set envelope_size in
+    # the configuration to enable.
+    envelope_size = 0 # Max number of frames per message, 0 to disable
+    envelope_age = 1 # Max number of seconds a frame waits to be sent
+
+    # Reconnection, with exponential backoff
+    reconnect_delay = 1 # Seconds before the first attempt
+    reconnect_max_delay = 60 # Max number of seconds between attempts
+
+    # Encoding of the messages published, json or cbor. Consumers support
+    # both, JSON for compatibility and CBOR to send bytes as they are.
+    encoding = 'json'
+
+    # Persistent state, written at most every state_flush seconds (0 to write
+    # every change)
+    state_flush = 1
+
     def __init__(self):
+        if self.broker is None:
+            self.broker = get_broker()
+
+        # The same ioloop is used accross reconnections
+        self.ioloop = IOLoop() if self.broker is None else self.broker.ioloop
         self.connection = None
         self.channel = None
         self.logger = logging.getLogger(self.name)
         self.started = False
+        self.stopping = False
         self.todo = set() # Used to know when the setup process is done
+        self.consumers = [] # Started once the setup is done
         self.state = self.load_state(self.db_name) # Persistent state
+        self.state_timer = None
         self.config = utils.get_config(self.name) # Configuration
 
+        # Ingest queue
+        self.ingest = queue.Queue(maxsize=self.ingest_size)
+        self.ingest_lock = threading.Lock() # For ingest_scheduled and ingest_stats
+        self.ingest_scheduled = False
+        self.ingest_stats = {
+            'published': 0, # Messages published from the queue
+            'batches': 0, # Number of times the queue has been drained
+            'blocked': 0, # Times a thread had to wait because the queue was full
+            'dropped': 0, # Messages dropped because the queue was still full
+            'high_water': 0, # Max number of messages seen in the queue
+        }
+
+        # Publisher confirms
+        self.outbox = Outbox(self.outbox_name) if self.outbox_name else None
+        self.ready = False # True once the setup is done
+        self.delivery_tag = 0
+        self.unconfirmed = collections.OrderedDict() # delivery tag -> message id
+        self.callbacks = {} # message id -> called once the message is confirmed
+        self.confirmed = [] # message ids to be removed from the outbox
+        self.confirmed_timer = None
+
+        # Thread pool, the messages in flight are bounded by prefetch_count
+        self.threads = int(self.config.get('threads', self.threads))
+        self.pool = None
+        self.local = threading.local() # local.pool is True in the pool threads
+        if self.threads:
+            self.pool = ThreadPoolExecutor(
+                self.threads,
+                thread_name_prefix=self.name,
+                initializer=self.init_thread,
+            )
+            if self.prefetch_count is None:
+                self.prefetch_count = 2 * self.threads
+
+        # Encoding
+        self.content_type = CONTENT_TYPES[self.config.get('encoding', self.encoding)]
+
+        # Envelopes
+        self.envelope_size = int(self.config.get('envelope_size', self.envelope_size))
+        self.envelope_age = float(self.config.get('envelope_age', self.envelope_age))
+        self.envelope = [] # Messages waiting to be sent
+        self.envelope_timer = None
+
+        # Reconnection
+        self.reconnect_timer = None
+        self.reconnect_attempts = 0 # Attempts since the connection was lost
+        self.reconnect_stats = {
+            'attempts': 0, # Total number of attempts
+            'reconnects': 0, # Number of times the connection was restored
+            'down_since': None, # When the connection was lost, if it is down
+            'last_downtime': None, # Seconds it took to reconnect, the last time
+        }
+        self.bg_task_started = False
+
+        # State
+        self.state_flush = float(self.config.get('state_flush', self.state_flush))
+
+    def init_thread(self):
+        self.local.pool = True
+
     def start(self):
         signal.signal(signal.SIGTERM, self.stop)
         self.info('Start. To exit press CTRL+C')
         self.started = True
         try:
-            self.connection.ioloop.start()
+            self.ioloop.start()
         except KeyboardInterrupt:
             pass
 
     def stop(self, signum=None, frame=None):
+        self.stopping = True
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+        self.flush_envelope()
+        if self.outbox is not None:
+            self.flush_confirmed()
+
+        if self.reconnect_timer is not None:
+            self.ioloop.remove_timeout(self.reconnect_timer)
+            self.reconnect_timer = None
+
         if self.channel is not None:
-            self.channel.close()
+            if self.channel.is_open:
+                self.channel.close()
             self.channel = None
 
         if self.connection is not None:
-            self.connection.close()
-            if self.started:
-                self.connection.ioloop.stop() # Graceful stop
-                self.started = False
-
+            if not (self.connection.is_closing or self.connection.is_closed):
+                self.connection.close()
             self.connection = None
 
+        if self.started:
+            self.ioloop.stop() # Graceful stop
+            self.started = False
+
     def connect(self):
-        parameters = pika.ConnectionParameters(host=self.host)
-        self.connection = pika.SelectConnection(
-            parameters,
-            self.on_connect_open,
-            self.on_connect_error,
-            self.on_connect_close,
-        )
+        if self.broker is not None:
+            self.connection = self.broker.connect(
+                self.on_connect_open,
+                self.on_connect_error,
+                self.on_connect_close,
+            )
+        else:
+            parameters = pika.ConnectionParameters(host=self.host)
+            self.connection = pika.SelectConnection(
+                parameters,
+                self.on_connect_open,
+                self.on_connect_error,
+                self.on_connect_close,
+                custom_ioloop=self.ioloop,
+            )
         # Update todo
-        self.todo.add('open_connection')
+        self.todo = {'open_connection'}
 
     def on_connect_open(self, connection):
         self.info('Connection open')
@@ -164,28 +504,69 @@ class MQ(object):
         self.todo.remove('open_connection')
 
     def on_connect_error(self, connection, exc):
-        self.exception('Connection error')
+        self.error('Connection error: %r', exc)
         self.connection = None
-        sys.exit(1)
+        self.reconnect()
 
     def on_connect_close(self, connection, exception):
         self.info('Connection closed')
+        self.connection = None
+        self.channel = None
+        self.ready = False
+        if not self.stopping:
+            self.warning('Connection lost: %s', exception)
+            self.reconnect()
+
+    def reconnect(self):
+        """
+        Connect again, later, with exponential backoff and jitter. The setup
+        is done again once connected, see done(). The radios and other
+        handlers in the ioloop keep running meanwhile.
+        """
+        stats = self.reconnect_stats
+        if stats['down_since'] is None:
+            stats['down_since'] = time.time()
+
+        delay = self.reconnect_delay * 2 ** self.reconnect_attempts
+        delay = min(delay, self.reconnect_max_delay)
+        delay = random.uniform(delay / 2, delay)
+        self.reconnect_attempts += 1
+        stats['attempts'] += 1
+        self.info('Reconnect in %.1fs (attempt %d)', delay, self.reconnect_attempts)
+        self.reconnect_timer = self.ioloop.call_later(delay, self.on_reconnect_timer)
+
+    def on_reconnect_timer(self):
+        self.reconnect_timer = None
+        self.connect()
 
     def on_channel_open(self, channel):
         self.info('Channel open')
         self.channel = channel
+        self.consumers = []
+        channel.add_on_close_callback(self.on_channel_close)
 
         # QOS
         prefetch_count = self.prefetch_count
         if prefetch_count is not None:
             channel.basic_qos(prefetch_count=prefetch_count, callback=self.on_basic_qos_ok)
 
+        # Publisher confirms
+        if self.outbox is not None:
+            self.delivery_tag = 0
+            self.unconfirmed.clear()
+            channel.confirm_delivery(self.on_delivery_confirmation, callback=self.on_confirm_select_ok)
+            self.todo.add('confirm_delivery')
+
         # Subscription
         if self.sub_to:
-            exchange, exchange_type, queue, consumer = self.sub_to()
-            cb = self.on_exchange_declare(exchange, queue, consumer)
+            exchange, exchange_type, queue, consumer, *bindings = self.sub_to()
+            bindings = self.get_bindings(exchange_type, bindings[0] if bindings else ['#'])
+            cb = self.on_exchange_declare(exchange, queue, consumer, bindings)
             channel.exchange_declare(exchange, exchange_type, durable=True, callback=cb)
             self.todo.add('declare_exchange_%s' % exchange)
+            if self.sub_from:
+                self.declare_source(exchange)
+            self.declare_failed(queue)
 
         # Publication
         if self.pub_to:
@@ -197,14 +578,47 @@ class MQ(object):
         # Update todo
         self.todo.remove('open_channel')
 
+    def on_channel_close(self, channel, reason):
+        self.info('Channel closed')
+        self.channel = None
+        self.ready = False
+        # Close the connection as well, to connect and setup again
+        connection = self.connection
+        if not self.stopping and connection is not None and connection.is_open:
+            self.warning('Channel lost: %s', reason)
+            connection.close()
+
     def on_basic_qos_ok(self, method):
         self.info('QOS OK')
 
-    def on_exchange_declare(self, exchange, queue, consumer=None):
+    def on_confirm_select_ok(self, frame):
+        self.info('Publisher confirms enabled')
+        # Update todo
+        self.todo.remove('confirm_delivery')
+        if not self.todo:
+            self.done()
+
+    def get_bindings(self, exchange_type, bindings):
+        """
+        Return the binding patterns of the queue, those in the configuration
+        if any, separated by commas or spaces. Otherwise the given ones.
+
+        Consistent hash exchanges are bound with the weight of the queue, not
+        patterns, the configuration is ignored.
+        """
+        value = self.config.get('bindings')
+        if value and exchange_type == 'x-consistent-hash':
+            self.warning('Option bindings ignored, %s is a consistent hash exchange', self.name)
+        elif value:
+            return value.replace(',', ' ').split()
+
+        return bindings
+
+    def on_exchange_declare(self, exchange, queue, consumer=None, bindings=(None,)):
         def callback(frame):
             self.info('Exchange declared name=%s', exchange)
             if queue or consumer:
-                cb = self.on_queue_declare(exchange, queue, consumer)
+                cb = self.on_queue_declare(exchange, queue, consumer, bindings)
                 self.channel.queue_declare(queue, durable=True, callback=cb)
                 self.todo.add('declare_queue_%s' % queue)
 
@@ -215,57 +629,388 @@ class MQ(object):
 
         return callback
 
-    def on_queue_declare(self, exchange, queue, consumer):
+    def on_queue_declare(self, exchange, queue, consumer, bindings):
         def callback(frame):
             self.info('Queue declared name=%s', queue)
-            cb = self.on_queue_bind(exchange, queue, consumer)
-            self.channel.queue_bind(queue, exchange, callback=cb)
+            for routing_key in bindings:
+                cb = self.on_queue_bind(exchange, queue, routing_key)
+                self.channel.queue_bind(queue, exchange, routing_key=routing_key, callback=cb)
+                self.todo.add('bind_queue_%s_%s' % (queue, routing_key))
+
+            if consumer:
+                self.consumers.append(Consumer(self, queue, consumer))
+
             # Update todo
-            self.todo.add('bind_queue_%s' % queue)
             self.todo.remove('declare_queue_%s' % queue)
 
         return callback
 
-    def on_queue_bind(self, exchange, queue, consumer):
+    def on_queue_bind(self, exchange, queue, routing_key):
         def callback(frame):
-            self.info('Bound exchange=%s queue=%s', exchange, queue)
-            if consumer:
-                Consumer(self, queue, consumer).start()
+            self.info('Bound exchange=%s queue=%s routing_key=%s', exchange, queue, routing_key)
+            # Update todo
+            self.todo.remove('bind_queue_%s_%s' % (queue, routing_key))
+            if not self.todo:
+                self.done()
+
+        return callback
+
+    def declare_source(self, exchange):
+        """
+        Declare the exchange given by sub_from, and bind the exchange given by
+        sub_to to it.
+        """
+        channel = self.channel
+        source, source_type = self.sub_from
+
+        def on_exchange(frame):
+            cb = self.on_declared('bind_exchange_%s' % exchange)
+            channel.exchange_bind(exchange, source, routing_key='#', callback=cb)
+
+        cb = self.on_declared('declare_exchange_%s' % source, on_exchange)
+        channel.exchange_declare(source, source_type, durable=True, callback=cb)
+
+    def declare_failed(self, queue):
+        """
+        Declare where the messages that fail go: the retry queues, where they
+        wait before going back to the queue, and the dead letter queue, bound
+        to the dead letter exchange.
+        """
+        channel = self.channel
+        for delay in self.retry_delays:
+            name = retry_queue(queue, delay)
+            arguments = {
+                'x-message-ttl': delay * 1000,
+                'x-dead-letter-exchange': '', # Once expired, back to the queue
+                'x-dead-letter-routing-key': queue,
+            }
+            cb = self.on_declared('declare_queue_%s' % name)
+            channel.queue_declare(name, durable=True, arguments=arguments, callback=cb)
+
+        dead = f'{queue}.dead'
+        def on_exchange(frame):
+            cb = self.on_declared('declare_queue_%s' % dead, on_queue)
+            channel.queue_declare(dead, durable=True, callback=cb)
+
+        def on_queue(frame):
+            cb = self.on_declared('bind_queue_%s' % dead)
+            channel.queue_bind(dead, DEAD_LETTERS, routing_key=queue, callback=cb)
+
+        cb = self.on_declared('declare_exchange_%s' % DEAD_LETTERS, on_exchange)
+        channel.exchange_declare(DEAD_LETTERS, 'direct', durable=True, callback=cb)
+
+    def on_declared(self, name, then=None):
+        """
+        Return the callback for the given setup step, it calls then if given.
+        """
+        def callback(frame):
+            self.info('Done %s', name)
+            if then is not None:
+                then(frame)
 
             # Update todo
-            self.todo.remove('bind_queue_%s' % queue)
+            self.todo.remove(name)
             if not self.todo:
                 self.done()
 
+        self.todo.add(name)
         return callback
 
     def done(self):
         self.info('Setup done.')
-        # Background task
-        if self.bg_task:
-            self.connection.ioloop.call_later(1, self.bg_task_wrapper)
+        self.ready = True
+
+        # Start consuming, the queues for failed messages are ready
+        for consumer in self.consumers:
+            consumer.start()
+
+        # Reconnected
+        stats = self.reconnect_stats
+        if stats['down_since'] is not None:
+            stats['last_downtime'] = time.time() - stats['down_since']
+            stats['down_since'] = None
+            stats['reconnects'] += 1
+            self.info(
+                'Reconnected after %.1fs and %d attempts %s',
+                stats['last_downtime'], self.reconnect_attempts, stats,
+            )
+        self.reconnect_attempts = 0
+
+        # Send the messages left in the outbox, from a previous run or published
+        # before the setup was done
+        if self.outbox is not None:
+            self.replay_outbox()
+
+        # Messages published while disconnected, when there is no outbox
+        self.flush_envelope()
+
+        # Background task, it keeps running while reconnecting
+        if self.bg_task and not self.bg_task_started:
+            self.bg_task_started = True
+            self.ioloop.call_later(1, self.bg_task_wrapper)
 
     def bg_task_wrapper(self):
         delay = self.bg_task() or 1
-        self.connection.ioloop.call_later(delay, self.bg_task_wrapper)
+        self.ioloop.call_later(delay, self.bg_task_wrapper)
+
+    def ack(self, channel, delivery_tag):
+        """
+        Acknowledge a message once handled. Consumers that keep the messages
+        in memory may acknowledge them later, once safe (see archive.py).
+        """
+        channel.basic_ack(delivery_tag=delivery_tag)
 
     #
     # Publisher
     #
-    def publish(self, body):
+    def publish(self, body, callback=None, transport=None):
+        """
+        Publish the message. The callback, if given, is called once the
+        message is safe: confirmed by the broker if there is an outbox, right
+        away otherwise. The transport, if given, replaces self.transport in
+        the routing key.
+
+        From the threads of the pool (see threads), the message is published
+        from the ioloop, and the thread waits until it is safe.
+        """
+        if getattr(self.local, 'pool', False):
+            if not self.publish_threadsafe(body, wait=True, transport=transport):
+                raise Retry('Message not published')
+            if callback is not None:
+                callback()
+            return
+
         exchange, exchange_type, queue = self.pub_to()
-        body = json.dumps(body)
-        properties = pika.BasicProperties(
-            delivery_mode=2, # persistent message
-            content_type='application/json',
-        )
-        self.channel.basic_publish(
-            exchange=exchange,
-            routing_key=queue,
-            properties=properties,
-            body=body,
-        )
-        self.info('Message published')
+        routing_key = self.get_routing_key(body, transport)
+        content_type = self.content_type
+        body = encode(body, content_type)
+
+        message_id = None
+        if self.outbox is not None:
+            message_id = self.outbox.put(exchange, routing_key, content_type, body)
+            if callback is not None:
+                self.callbacks[message_id] = callback
+        elif callback is not None:
+            callback()
+
+        message = (message_id, exchange, routing_key, content_type, body)
+        if self.envelope_size:
+            self.envelope.append(message)
+            if len(self.envelope) >= self.envelope_size:
+                self.flush_envelope()
+            elif self.envelope_timer is None:
+                self.envelope_timer = self.ioloop.call_later(self.envelope_age, self.flush_envelope)
+        elif self.ready:
+            self.send([message])
+        elif self.outbox is None:
+            # Not connected, sent once the setup is done. Otherwise it will be
+            # sent from the outbox.
+            self.envelope.append(message)
+
+    def get_routing_key(self, body, transport=None):
+        """
+        Return the routing key of the message: <transport>.<source_addr>.<type>
+        where type is the frame type, or the message id for raw messages.
+        """
+        if transport is None:
+            transport = self.transport
+
+        frame_type = body.get('type', body.get('id'))
+        return routing_key(transport, body.get('source_addr'), frame_type)
+
+    def flush_envelope(self):
+        if self.envelope_timer is not None:
+            self.ioloop.remove_timeout(self.envelope_timer)
+            self.envelope_timer = None
+
+        # Not connected: the messages will be sent from the outbox if any, or
+        # once the setup is done
+        if not self.ready:
+            if self.outbox is not None:
+                self.envelope = []
+            return
+
+        messages = self.envelope
+        self.envelope = []
+        size = self.envelope_size or 1
+        for i in range(0, len(messages), size):
+            self.send(messages[i:i+size])
+
+    def send(self, messages, headers=None):
+        """
+        Send the given messages, (id, exchange, routing_key, content_type,
+        body) tuples. The messages for the same exchange and routing key are
+        sent in a single envelope.
+        """
+        groups = {}
+        for message in messages:
+            groups.setdefault(message[1:4], []).append(message)
+
+        for (exchange, routing_key, content_type), group in groups.items():
+            if len(group) == 1:
+                message_type = None
+                body = group[0][4]
+            else:
+                message_type = ENVELOPE
+                body = pack([message[4] for message in group], content_type)
+
+            properties = pika.BasicProperties(
+                delivery_mode=2, # persistent message
+                content_type=content_type,
+                type=message_type,
+                headers=headers,
+            )
+            self.channel.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                properties=properties,
+                body=body,
+            )
+
+            # In confirm mode every message published gets a delivery tag
+            if self.outbox is not None:
+                self.delivery_tag += 1
+                self.unconfirmed[self.delivery_tag] = [
+                    message[0] for message in group if message[0] is not None
+                ]
+
+            self.info('Message published (%d frames)', len(group))
+
+    def replay_outbox(self):
+        # The messages confirmed, but not removed yet, are not sent again
+        self.flush_confirmed()
+
+        unconfirmed = {x for message_ids in self.unconfirmed.values() for x in message_ids}
+        messages = [x for x in self.outbox if x[0] not in unconfirmed]
+        if messages:
+            self.info('Send %d messages from the outbox', len(messages))
+            size = self.envelope_size or 1
+            for i in range(0, len(messages), size):
+                self.send(messages[i:i+size])
+
+    def on_delivery_confirmation(self, frame):
+        method = frame.method
+        tag = method.delivery_tag
+        if method.multiple:
+            tags = list(itertools.takewhile(lambda x: x <= tag, self.unconfirmed))
+        else:
+            tags = [tag] if tag in self.unconfirmed else []
+        message_ids = [x for tag in tags for x in self.unconfirmed.pop(tag)]
+
+        # Rejected by the broker (e.g. the queue is full), send again later
+        if isinstance(method, pika.spec.Basic.Nack):
+            self.warning('%d messages rejected by the broker, send again', len(message_ids))
+            self.ioloop.call_later(1, functools.partial(self.resend, message_ids))
+            return
+
+        self.debug('%d messages confirmed', len(message_ids))
+        for message_id in message_ids:
+            callback = self.callbacks.pop(message_id, None)
+            if callback is not None:
+                callback()
+
+        # Remove from the outbox, in batches
+        self.confirmed.extend(message_ids)
+        if len(self.confirmed) >= self.confirm_batch:
+            self.flush_confirmed()
+        elif self.confirmed_timer is None:
+            self.confirmed_timer = self.ioloop.call_later(1, self.flush_confirmed)
+
+    def resend(self, message_ids):
+        # Otherwise they will be sent from the outbox once the setup is done
+        if self.ready:
+            messages = [self.outbox.get(x) for x in message_ids]
+            self.send([x for x in messages if x is not None])
+
+    def flush_confirmed(self):
+        if self.confirmed_timer is not None:
+            self.ioloop.remove_timeout(self.confirmed_timer)
+            self.confirmed_timer = None
+
+        if self.confirmed:
+            self.outbox.remove(self.confirmed)
+            self.confirmed = []
+
+    def publish_threadsafe(self, body, wait=False, transport=None):
+        """
+        Publish from a thread other than the ioloop's, for instance a radio
+        reader thread. The message is put in the ingest queue, and published
+        later from the ioloop, in batches.
+
+        If the queue is full the thread waits, up to ingest_timeout seconds.
+        Return False if the message has been dropped, then the sender should
+        not be acknowledged.
+
+        With wait=True, wait as well until the message is safe (see publish),
+        up to confirm_timeout seconds, return False if it is not.
+        """
+        safe = threading.Event() if wait else None
+        item = (body, transport, safe.set if wait else None)
+        try:
+            self.ingest.put_nowait(item)
+        except queue.Full:
+            self.count_ingest(blocked=1)
+            try:
+                self.ingest.put(item, timeout=self.ingest_timeout)
+            except queue.Full:
+                stats = self.count_ingest(dropped=1)
+                self.error('Ingest queue full, message dropped (%s)', stats)
+                return False
+
+        size = self.ingest.qsize()
+        with self.ingest_lock:
+            stats = self.ingest_stats
+            stats['high_water'] = max(stats['high_water'], size)
+
+            # Wake up the ioloop, unless it has been done already
+            if not self.ingest_scheduled:
+                self.ingest_scheduled = True
+                self.ioloop.add_callback_threadsafe(self.drain_ingest)
+
+        if wait:
+            return safe.wait(self.confirm_timeout)
+
+        return True
+
+    def count_ingest(self, **counts):
+        """
+        Add to the ingest counters, from any thread. Return a copy of them.
+        """
+        with self.ingest_lock:
+            stats = self.ingest_stats
+            for name, n in counts.items():
+                stats[name] += n
+            return dict(stats)
+
+    def drain_ingest(self):
+        # Wait for the setup to be done, meanwhile the threads will block once
+        # the queue is full
+        if not self.ready:
+            self.ioloop.call_later(1, self.drain_ingest)
+            return
+
+        # Messages put from now on will schedule a new call
+        with self.ingest_lock:
+            self.ingest_scheduled = False
+
+        published = 0
+        for i in range(self.ingest_batch):
+            try:
+                body, transport, callback = self.ingest.get_nowait()
+            except queue.Empty:
+                break
+            self.publish(body, callback=callback, transport=transport)
+            published += 1
+
+        stats = self.count_ingest(published=published, batches=1)
+        self.debug('Ingest queue drained %s', stats)
+
+        # Let other events run before the next batch
+        if not self.ingest.empty():
+            with self.ingest_lock:
+                if not self.ingest_scheduled:
+                    self.ingest_scheduled = True
+                    self.ioloop.add_callback(self.drain_ingest)
 
     #
     # Logging helpers
@@ -299,36 +1044,41 @@ class MQ(object):
     # State API
     #
     def load_state(self, name):
-        if not name:
-            return {}
-
-        try:
-            with open(name) as db_file:
-                return json.load(db_file)
-        except FileNotFoundError:
-            return {}
+        """
+        Return the state stored in the given database, see state.State. In
+        memory only if no name is given.
+        """
+        return State(name or None)
 
     def get_state(self, addr, key, default=None):
         """
         Return a value from the local db.
         """
-        return self.state.get(addr, {}).get(key, default)
+        return self.state.get(addr, key, default)
 
     def set_state(self, source_addr, **kw):
+        """
+        Update the values of the given source address. They are written once
+        state_flush seconds have passed. May be called from any thread.
+        """
         assert type(source_addr) is str
 
-        db_new = copy.deepcopy(self.state)
-        db_new.setdefault(source_addr, {}).update(kw)
-        if self.state != db_new:
-            self.state = db_new
-            self.save_state()
+        if self.state.set(source_addr, **kw):
+            if self.state_flush:
+                self.ioloop.add_callback_threadsafe(self.schedule_save_state)
+            else:
+                self.save_state()
+
+    def schedule_save_state(self):
+        if self.state_timer is None:
+            self.state_timer = self.ioloop.call_later(self.state_flush, self.save_state)
 
     def save_state(self):
-        if not self.db_name:
-            return
+        if self.state_timer is not None:
+            self.ioloop.remove_timeout(self.state_timer)
+            self.state_timer = None
 
-        with open(self.db_name, 'w') as db_file:
-            json.dump(self.state, db_file, indent=2)
+        self.state.flush()
 
     #
     # Context manager
@@ -340,4 +1090,8 @@ class MQ(object):
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.stop()
+        if self.outbox is not None:
+            self.outbox.close()
+        self.save_state()
+        self.state.close()
         logging.shutdown()
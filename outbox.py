@@ -0,0 +1,69 @@
+"""
+Persistent outbox for the messages published but not yet confirmed by the
+broker, see MQ.outbox_name.
+"""
+
+# Standard Library
+import sqlite3
+
+
+class Outbox:
+    """
+    The messages are stored in a SQLite database, in WAL mode, in the order
+    they are published. Once confirmed by the broker they are removed.
+
+    With synchronous=NORMAL a committed message survives a crash of the
+    program, though the last commits may be lost on a power failure.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' exchange TEXT,'
+            ' routing_key TEXT,'
+            ' content_type TEXT,'
+            ' body BLOB)'
+        )
+        self.db.commit()
+
+    def put(self, exchange, routing_key, content_type, body):
+        """
+        Store the message, return its id.
+        """
+        cursor = self.db.execute(
+            'INSERT INTO outbox (exchange, routing_key, content_type, body) VALUES (?, ?, ?, ?)',
+            (exchange, routing_key, content_type, body),
+        )
+        self.db.commit()
+        return cursor.lastrowid
+
+    def get(self, message_id):
+        """
+        Return the message as an (id, exchange, routing_key, content_type,
+        body) tuple, or None if not found.
+        """
+        cursor = self.db.execute('SELECT * FROM outbox WHERE id = ?', (message_id,))
+        return cursor.fetchone()
+
+    def remove(self, message_ids):
+        """
+        Remove the given messages, with a single commit.
+        """
+        self.db.executemany('DELETE FROM outbox WHERE id = ?', [(x,) for x in message_ids])
+        self.db.commit()
+
+    def __iter__(self):
+        """
+        Iterate over the messages, in the order they were published.
+        """
+        return iter(self.db.execute('SELECT * FROM outbox ORDER BY id').fetchall())
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    def close(self):
+        self.db.close()
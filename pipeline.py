@@ -0,0 +1,99 @@
+"""
+Run several programs in a single process, connected by the in-process broker
+(see broker.py) instead of RabbitMQ. Meant for small gateways, where there is
+not enough memory for a process per program plus RabbitMQ:
+
+    python pipeline.py wsn_xbee wsn_raw_cook wsn_raw_archive wsn_data_archive
+
+Without arguments the programs are read from the configuration:
+
+    [pipeline]
+    programs = wsn_xbee, wsn_raw_cook, wsn_raw_archive, wsn_data_archive
+    maxsize = 1000
+
+The programs are the same, with their own configuration section. The messages
+in the queues (at most maxsize per queue) are lost if the process exits, those
+not confirmed yet are kept in the outboxes. Unless the SQLite broker is
+configured (see sqlite_broker.py), then it is used instead, and the queues are
+persistent.
+"""
+
+# Standard Library
+import argparse
+import asyncio
+import contextlib
+import importlib
+import signal
+
+# Project
+from broker import Broker
+import mq
+import utils
+
+
+# Program name -> class name. The consumers are started first, so their queues
+# are ready before the publishers start.
+PROGRAMS = {
+    'wsn_data_django': 'Consumer',
+    'wsn_data_series': 'Consumer',
+    'wsn_data_archive': 'Consumer',
+    'wsn_raw_archive': 'Consumer',
+    'wsn_raw_cook': 'Consumer',
+    'wsn_usb': 'Publisher',
+    'wsn_xbee': 'Publisher',
+    'wsn_lora': 'Publisher',
+}
+
+
+def wait_ready(loop, programs):
+    async def wait():
+        while not all(program.ready for program in programs):
+            await asyncio.sleep(0.01)
+
+    loop.run_until_complete(wait())
+
+
+def run(names, maxsize):
+    # The SQLite broker if configured, otherwise the in-process one
+    broker = mq.get_broker() or Broker(maxsize=maxsize)
+    mq.MQ.broker = broker
+    loop = broker.loop
+
+    names = [name for name in PROGRAMS if name in names]
+    with contextlib.ExitStack() as stack:
+        started = []
+        for name in names:
+            # Wait for the consumers before starting the first publisher
+            if PROGRAMS[name] == 'Publisher':
+                wait_ready(loop, started)
+
+            module = importlib.import_module(name)
+            program = getattr(module, PROGRAMS[name])()
+            stack.enter_context(program)
+            setup = getattr(module, 'setup', None)
+            if setup is not None:
+                stack.enter_context(setup(program))
+            started.append(program)
+
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('programs', nargs='*', help=', '.join(PROGRAMS))
+    parser.add_argument('--maxsize', type=int, help='max number of messages per queue')
+    args = parser.parse_args()
+
+    config = utils.get_config('pipeline') or {}
+    programs = args.programs or config.get('programs', '').replace(',', ' ').split()
+    if not programs:
+        parser.error('no programs given')
+    unknown = set(programs) - set(PROGRAMS)
+    if unknown:
+        parser.error(f'unknown programs: {", ".join(sorted(unknown))}')
+    maxsize = args.maxsize or int(config.get('maxsize', 1000))
+    run(programs, maxsize)
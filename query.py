@@ -0,0 +1,43 @@
+"""
+Print the archived messages of a mote received in a time range, using the
+index of every day (see archive.py) to read only those:
+
+    python query.py data/raw/0013A200416A0723 --start 2025-01-01T10:00 --end 2025-01-01T12:00
+
+Times are local, like the days of the archive. The indexes are written by
+wsn_raw_archive and wsn_data_archive. For the days archived before, build
+them once (without an index every line is read):
+
+    python query.py --build data/raw/*/* data/cooked/*/*
+"""
+
+# Standard Library
+import argparse
+import os
+import sys
+
+# Project
+import archive
+import utils
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help='directories of motes, or days with --build')
+    parser.add_argument('--start', type=utils.parse_time, help='e.g. 2025-01-01T10:00')
+    parser.add_argument('--end', type=utils.parse_time, help='not included')
+    parser.add_argument('--build', action='store_true', help='build the indexes of the given days')
+    args = parser.parse_args()
+
+    if args.build:
+        # A day may be given by its files, build it once
+        days = dict.fromkeys(archive.get_day(path) for path in args.paths if not path.endswith(archive.INDEX))
+        for day in days:
+            print(day)
+            archive.build_index(day)
+    else:
+        for path in args.paths:
+            if not os.path.isdir(path):
+                parser.error(f'{path} is not a directory')
+            for line in archive.search(path, args.start, args.end):
+                sys.stdout.write(line)
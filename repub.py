@@ -1,21 +1,41 @@
 """
 Sometimes there may be a bug, for instance in parse_frame. This script will
 re-publish the raw frames stored in the given file, to the wsn_raw_cook
-channel.
+queue:
 
-TODO Declare the exchanges as direct (or topic or headers), not fanouts, to
-have more control. Because right now the messages will be sent to every queue
-subscribed, doesn't matter the routing key used.
+    python repub.py data/raw/<source_addr>/<day> ...
+
+By default the frames are sent straight to the wsn_raw_cook queue, so no other
+consumer gets them. With several wsn_raw_cook workers send them to the
+wsn_raw_cook exchange instead, it distributes them by source address:
+
+    python repub.py --exchange wsn_raw_cook data/raw/<source_addr>/<day> ...
+
+The days compressed (<day>.gz) are read as they are, without unpacking them.
+To send only the frames received in a time range (local time), read through
+the index of the day:
+
+    python repub.py --start 2025-01-01T10:00 --end 2025-01-01T12:00 data/raw/<source_addr>/<day> ...
 """
 
+import argparse
 import json
-import sys
 
 import pika
 
+import archive
+from mq import routing_key
+import utils
+
 
 if __name__ == '__main__':
-    exchange, queue = 'wsn_raw', 'wsn_raw_cook'
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queue', default='wsn_raw_cook')
+    parser.add_argument('--exchange', help='publish to the exchange, not to the queue')
+    parser.add_argument('--start', type=utils.parse_time, help='e.g. 2025-01-01T10:00')
+    parser.add_argument('--end', type=utils.parse_time, help='not included')
+    parser.add_argument('filenames', nargs='+')
+    args = parser.parse_args()
 
     parameters = pika.ConnectionParameters(host='localhost')
     connection = pika.BlockingConnection(parameters)
@@ -26,12 +46,24 @@ if __name__ == '__main__':
     )
 
     try:
-        for filename in sys.argv[1:]:
-            print(filename)
-            lines = open(filename).readlines()
-            for line in lines:
+        # A day may be given by its files, compressed or not, read it once
+        days = dict.fromkeys(
+            archive.get_day(filename) for filename in args.filenames
+            if not filename.endswith(archive.INDEX)
+        )
+        for day in days:
+            print(day)
+            for line in archive.query(day, args.start, args.end):
                 data = json.loads(line)
+                if args.exchange:
+                    # <transport>.<source_addr>.<type>, see MQ.get_routing_key
+                    exchange = args.exchange
+                    key = routing_key(data.get('transport'), data['source_addr'], data['id'])
+                else:
+                    # Default exchange, the routing key is the queue
+                    exchange = ''
+                    key = args.queue
                 data = json.dumps(data)
-                channel.basic_publish(exchange, queue, data, properties)
+                channel.basic_publish(exchange, key, data, properties)
     finally:
         connection.close()
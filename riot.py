@@ -1,5 +1,8 @@
 # Standard library
+import base64
 import collections
+import io
+import logging
 import pprint
 import sys
 
@@ -7,6 +10,8 @@ import sys
 import cbor2
 
 
+logger = logging.getLogger(__name__)
+
 Field = collections.namedtuple('Field', ['name', 'scale', 'n'], defaults=[0, 1])
 
 SENSORS = {
@@ -34,7 +39,32 @@ SENSORS = {
 }
 
 
+"""
+The SENSORS table is compiled once into PLANS, for every key a tuple of
+(name, divisor, n) fields; divisor is None when the value is not scaled.
+"""
+
+def compile_fields(fields):
+    plan = []
+    for field in fields:
+        field = Field(*field)
+        if field.n not in (0, 1):
+            raise NotImplementedError()
+
+        divisor = 10 ** -field.scale if field.scale else None
+        plan.append((field.name, divisor, field.n))
+
+    return tuple(plan)
+
+PLANS = {key: compile_fields(fields) for key, fields in SENSORS.items()}
+
+
 class Parser:
+    """
+    Decodes RIOT frames, every frame is a CBOR array. The data may hold
+    several frames, one after the other, they are pulled one at a time from
+    a streaming CBOR decoder.
+    """
 
     def __init__(self, data):
         if type(data) is str:
@@ -42,43 +72,89 @@ class Parser:
 
         self.data = data
         self.size = len(self.data)
-        self.__idx = 0
+        self.__stream = io.BytesIO(data)
+        self.__decoder = cbor2.CBORDecoder(self.__stream)
 
-    def get_frame(self):
-        data = cbor2.loads(self.data)
-        #pprint.pprint(data)
-        data = iter(data)
+    def read_frame(self):
+        try:
+            data = self.__decoder.decode()
+        except cbor2.CBORDecodeError as exc:
+            raise ValueError(str(exc)) from exc
 
-        get_value = lambda value, scale: value / (10 ** -scale) if scale else value
+        if type(data) is not list:
+            raise ValueError('Expected a CBOR array, got %s' % type(data))
 
+        data = iter(data)
         frame = {}
-        while True:
-            try:
-                key = next(data)
-            except StopIteration:
-                break
-
-            for field in SENSORS[key]:
-                field = Field(*field)
-                if field.n == 1:
-                    value = next(data)
-                    frame[field.name] = get_value(value, field.scale)
-                elif field.n == 0:  # Variable number of values
-                    n = next(data)
-                    values = [next(data)]
-                    for j in range(1, n):
-                        values.append(values[-1] + next(data))
-                    frame[field.name] = [get_value(x, field.scale) for x in values]
-                else:
-                    raise NotImplementedError()
+        try:
+            for key in data:
+                for name, divisor, n in PLANS[key]:
+                    if n == 1:
+                        value = next(data)
+                        frame[name] = value / divisor if divisor else value
+                    else: # Variable number of values
+                        # The first value is absolute, the next ones are deltas
+                        import numpy # Only for arrays, it takes time to import
+
+                        n = max(next(data), 1)
+                        values = numpy.fromiter(data, numpy.int64, count=n)
+                        values = numpy.cumsum(values, out=values)
+                        if divisor:
+                            values = values / divisor
+                        frame[name] = values.tolist()
+        except StopIteration:
+            raise ValueError('Unexpected end of frame')
 
         return frame
 
+    def get_frame(self):
+        return self.read_frame()
+
+    def iter_frames(self):
+        """
+        Yield the frames found in the data, one after the other.
+        """
+        while self.__stream.tell() < self.size:
+            yield self.read_frame()
+
 
 def parse_frame(data):
     return Parser(data).get_frame()
 
 
+def iter_frames(data):
+    return Parser(data).iter_frames()
+
+
+def parse_frames(payloads):
+    """
+    Parse many payloads in one go, for instance to reprocess the raw archive.
+    Every payload is a dict like the messages in the wsn_raw exchange, with
+    the keys 'source_addr', 'received' and 'data' (bytes, or base64 encoded).
+
+    Return a dict with one NumPy array per field (see columnar.Columns), and
+    one row per frame. The received and source_addr columns come from the
+    payload. Payloads that fail to parse are logged and skipped.
+    """
+    import columnar # Only for batches, it imports NumPy
+
+    columns = columnar.Columns()
+    for payload in payloads:
+        data = payload['data']
+        if type(data) is str:
+            data = base64.b64decode(data)
+
+        try:
+            for frame in iter_frames(data):
+                frame['received'] = payload['received']
+                frame['source_addr'] = payload['source_addr']
+                columns.add_row(frame)
+        except Exception:
+            logger.exception('Failed to parse payload %s', payload)
+
+    return columns.to_arrays()
+
+
 if __name__ == '__main__':
     if len(sys.argv) > 1:
         data = sys.argv[1]
@@ -0,0 +1,298 @@
+"""
+Time series of the cooked frames, by mote and field, written by
+wsn_data_series:
+
+    data/series/<source_addr>/<field>/<YYYYMMDD>
+
+A file holds chunks, each one with the times and the values of a field, as
+NumPy arrays compressed with zlib. The times (tst, or received if missing)
+are delta encoded. The day is written in <YYYYMMDD>.part, a chunk per flush,
+then it is rolled to <YYYYMMDD>, a single chunk sorted by time.
+
+To read a field over a time range, only its files are opened, and only the
+chunks in the range are decompressed:
+
+    python series.py read 0013A200416A0723 bme_tc --start 2025-01-01 --end 2025-02-01
+
+To fill the store from the cooked archive:
+
+    python series.py import data/cooked/0013A200416A0723/*
+"""
+
+# Standard Library
+import argparse
+from datetime import date, datetime
+import json
+import os
+import struct
+import sys
+import threading
+import zlib
+
+# Requirements
+import numpy
+
+# Project
+import archive
+
+
+# Not stored as series: tags and times
+SKIP = {'type', 'serial', 'frame', 'name', 'source_addr', 'received', 'tst'}
+
+# magic, dtype, number of values, min time, max time, size of the compressed
+# times, size of the compressed values
+HEADER = struct.Struct('<2scIqqII')
+MAGIC = b'WS'
+DTYPES = {b'q': numpy.int64, b'd': numpy.float64}
+
+PART = '.part' # Suffix of the day being written
+
+
+def get_time(frame):
+    time = frame.get('tst')
+    return frame['received'] if time is None else time
+
+
+def get_day(time):
+    return date.fromtimestamp(time).strftime('%Y%m%d')
+
+
+def encode(times, values):
+    """
+    Return the chunk of the given times and values, both arrays.
+    """
+    code = b'q' if values.dtype.kind in 'iu' else b'd'
+    values = values.astype(DTYPES[code])
+    times = times.astype(numpy.int64)
+    deltas = numpy.diff(times, prepend=numpy.int64(0)) # The first is the time
+    times_data = zlib.compress(deltas.tobytes())
+    values_data = zlib.compress(values.tobytes())
+    header = HEADER.pack(
+        MAGIC, code, len(times), times.min(), times.max(),
+        len(times_data), len(values_data),
+    )
+    return header + times_data + values_data
+
+
+def iter_chunks(file, start=None, end=None):
+    """
+    Yield the (times, values) of the chunks in the file, those in the given
+    time range. The other chunks are skipped, without decompressing them. A
+    chunk left half written is ignored.
+    """
+    while True:
+        header = file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+
+        magic, code, n, tmin, tmax, times_size, values_size = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f'{file.name}: not a series file')
+
+        if (start is not None and tmax < start) or (end is not None and tmin >= end):
+            file.seek(times_size + values_size, os.SEEK_CUR)
+            continue
+
+        data = file.read(times_size + values_size)
+        if len(data) < times_size + values_size:
+            return
+
+        times = numpy.frombuffer(zlib.decompress(data[:times_size]), dtype=numpy.int64).cumsum()
+        values = numpy.frombuffer(zlib.decompress(data[times_size:]), dtype=DTYPES[code])
+        yield times, values
+
+
+def repair(path):
+    """
+    Truncate the chunk left half written at the end of the file, if any, so
+    chunks can be appended again.
+    """
+    with open(path, 'r+b') as file:
+        size = os.fstat(file.fileno()).st_size
+        end = 0
+        while end + HEADER.size <= size:
+            header = HEADER.unpack(file.read(HEADER.size))
+            chunk_end = end + HEADER.size + header[5] + header[6]
+            if chunk_end > size:
+                break
+            end = chunk_end
+            file.seek(end)
+
+        if end < size:
+            file.truncate(end)
+
+
+def concat(chunks):
+    if not chunks:
+        return numpy.empty(0, dtype=numpy.int64), numpy.empty(0)
+
+    times = numpy.concatenate([times for times, values in chunks])
+    values = numpy.concatenate([values for times, values in chunks])
+    return times, values
+
+
+def read_file(path, start=None, end=None):
+    with open(path, 'rb') as file:
+        return concat(list(iter_chunks(file, start, end)))
+
+
+def read(datadir, source_addr, field, start=None, end=None):
+    """
+    Return the times and the values of the field, in the time range [start,
+    end) given in seconds since the epoch, sorted by time.
+    """
+    dirpath = os.path.join(datadir, source_addr, field)
+    if not os.path.isdir(dirpath):
+        return concat([])
+
+    # The files of the days in the range
+    first = None if start is None else get_day(start)
+    last = None if end is None else get_day(end)
+    paths = []
+    for filename in sorted(os.listdir(dirpath)):
+        if filename.endswith('.tmp'):
+            continue
+
+        day = filename.split('.')[0]
+        if (first is None or day >= first) and (last is None or day <= last):
+            paths.append(os.path.join(dirpath, filename))
+
+    times, values = concat([read_file(path, start, end) for path in paths])
+    mask = numpy.ones(len(times), dtype=bool)
+    if start is not None:
+        mask &= times >= start
+    if end is not None:
+        mask &= times < end
+
+    times, values = times[mask], values[mask]
+    order = numpy.argsort(times, kind='stable')
+    return times[order], values[order]
+
+
+def roll(path):
+    """
+    Merge <path>.closed into <path>, the day rolled, as a single chunk sorted
+    by time. The file is replaced at once.
+    """
+    closed = path + archive.CLOSED
+    paths = [p for p in (path, closed) if os.path.exists(p)]
+    times, values = concat([read_file(p) for p in paths])
+
+    # Nothing to roll, e.g. a .part file left empty when the program was killed
+    if len(times) == 0:
+        for p in paths:
+            os.remove(p)
+        return
+
+    order = numpy.argsort(times, kind='stable')
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(encode(times[order], values[order]))
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(tmp, path)
+    os.remove(closed)
+
+
+class Writer:
+    """
+    Collects the values of the frames, by mote, field and day, and appends
+    them to the .part files on flush, a chunk per file.
+
+    Frames may be added from other threads (see MQ.threads).
+    """
+
+    def __init__(self, datadir, fsync=True):
+        self.datadir = datadir
+        self.fsync = fsync
+        self.pending = {} # (source_addr, field, day) -> ([time, ...], [value, ...])
+        self.checked = set() # Files appended to by this writer
+        self.lock = threading.Lock()
+
+    def add(self, frame):
+        source_addr = frame.get('source_addr') or 'null'
+        time = get_time(frame)
+        day = get_day(time)
+        with self.lock:
+            for field, value in frame.items():
+                # Numbers only, the rest is in the cooked archive
+                if field in SKIP or type(value) not in (int, float):
+                    continue
+
+                times, values = self.pending.setdefault((source_addr, field, day), ([], []))
+                times.append(time)
+                values.append(value)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            for (source_addr, field, day), (times, values) in pending.items():
+                dirpath = os.path.join(self.datadir, source_addr, field)
+                os.makedirs(dirpath, exist_ok=True)
+                path = os.path.join(dirpath, day + PART)
+                if path not in self.checked:
+                    if os.path.exists(path):
+                        repair(path) # The program may have been killed while writing
+                    self.checked.add(path)
+
+                with open(path, 'ab') as file:
+                    file.write(encode(numpy.array(times), numpy.array(values)))
+                    file.flush()
+                    if self.fsync:
+                        os.fsync(file.fileno())
+
+    def detach(self, source_addr, field, day):
+        """
+        Rename the .part file of the day to .closed, to be rolled, unless
+        there are values waiting to be written to it, or the .closed file is
+        not rolled yet. Return True if the file has been renamed.
+        """
+        with self.lock:
+            if (source_addr, field, day) in self.pending:
+                return False
+
+            path = os.path.join(self.datadir, source_addr, field, day)
+            if os.path.exists(path + archive.CLOSED):
+                return False
+
+            os.rename(path + PART, path + archive.CLOSED)
+            self.checked.discard(path + PART)
+            return True
+
+    def close(self):
+        self.flush()
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').timestamp()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datadir', default=os.path.join('data', 'series'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparser = subparsers.add_parser('read', help='print the values of a field, as CSV')
+    subparser.add_argument('source_addr')
+    subparser.add_argument('field')
+    subparser.add_argument('--start', type=parse_date, help='YYYY-MM-DD')
+    subparser.add_argument('--end', type=parse_date, help='YYYY-MM-DD, not included')
+
+    subparser = subparsers.add_parser('import', help='import days of the cooked archive')
+    subparser.add_argument('filenames', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'read':
+        times, values = read(args.datadir, args.source_addr, args.field, args.start, args.end)
+        for time, value in zip(times.tolist(), values.tolist()):
+            sys.stdout.write(f'{time},{value}\n')
+    elif args.command == 'import':
+        # A day may be given by its files, compressed or not, read it once
+        writer = Writer(args.datadir, fsync=False)
+        for day in dict.fromkeys(archive.get_day(filename) for filename in args.filenames):
+            print(day)
+            for line in archive.read_lines(day):
+                writer.add(json.loads(line))
+            writer.flush()
@@ -0,0 +1,464 @@
+"""
+Persistent message broker on SQLite, a stand-in for RabbitMQ on gateways
+without it. Enabled in the configuration (see mq.get_broker):
+
+    [broker]
+    backend = sqlite
+    path = var/broker.db
+
+It has the same interface as the in-process broker (broker.py), but the
+exchanges, bindings, queues and messages are stored in a SQLite database in
+WAL mode. So they survive restarts, and are shared by the programs, whether
+they run in their own processes or in a single one (pipeline.py). The
+consumers poll the database.
+
+Delivery is at least once: a message delivered to a consumer is leased to it,
+and removed only once acknowledged. If the consumer dies before, for instance
+in the middle of an envelope, the lease expires and the message is delivered
+again, to it or to another consumer of the queue.
+
+A message published to a queue with a TTL (the retry queues) goes straight to
+the queue given by its dead letter arguments, where it is not delivered
+before the TTL expires (not_before).
+"""
+
+# Standard Library
+import asyncio
+import contextlib
+import json
+import os
+import sqlite3
+import time
+import types
+
+# Requirements
+import pika
+
+# Project
+import broker
+
+
+class Broker:
+    """
+    Publishes, acks and nacks are buffered, and committed at once on the next
+    iteration of the event loop; then the publishers get their confirms.
+    """
+
+    lease = 60 # Seconds a consumer has to ack a message, then it is redelivered
+    poll_interval = 0.2 # Seconds between polls, when there is nothing to deliver
+    batch = 50 # Max number of messages delivered per poll and queue
+
+    def __init__(self, path, lease=None, poll_interval=None, loop=None):
+        self.loop = loop or asyncio.new_event_loop()
+        self.ioloop = broker.IOLoop(self.loop)
+        if lease is not None:
+            self.lease = lease
+        if poll_interval is not None:
+            self.poll_interval = poll_interval
+
+        # Autocommit, transactions are explicit (see transaction)
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS exchanges (name TEXT PRIMARY KEY, type TEXT)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS bindings ('
+                ' source TEXT,'
+                ' destination TEXT,'
+                ' routing_key TEXT,'
+                ' is_exchange INTEGER,'
+                ' PRIMARY KEY (source, destination, routing_key, is_exchange))'
+            )
+            db.execute('CREATE TABLE IF NOT EXISTS queues (name TEXT PRIMARY KEY, arguments TEXT)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                ' queue TEXT,'
+                ' exchange TEXT,'
+                ' routing_key TEXT,'
+                ' properties TEXT,'
+                ' body BLOB,'
+                ' not_before REAL,' # Not delivered before (TTL)
+                ' lease_until REAL DEFAULT 0,' # Delivered, not acked yet
+                ' owner TEXT,' # The channel it is leased to
+                ' delivered INTEGER DEFAULT 0)' # Times it has been delivered
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS messages_queue ON messages (queue, id)')
+
+        # Unique accross processes, and restarts of the process
+        self.prefix = f'{os.getpid()}.{os.urandom(4).hex()}'
+        self.channels = 0
+
+        self.pending = [] # (channel, publish tag, message) to be committed
+        self.acks = [] # (message id, owner)
+        self.nacks = [] # (message id, owner, requeue)
+        self.flush_scheduled = False
+
+        self.consumers = {} # queue -> (channel, callback, consumer_tag)
+        self.poll_timer = None
+        self.renewed = time.time() # Last time the leases were renewed
+        self.stats = {
+            'published': 0, # Messages put in a queue
+            'delivered': 0,
+            'redelivered': 0, # Delivered again, e.g. after a consumer crash
+            'acked': 0,
+        }
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # IMMEDIATE so the other processes wait (up to timeout) instead of
+        # failing when they try to write as well
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.db
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        else:
+            self.db.execute('COMMIT')
+
+    def connect(self, on_open_callback, on_open_error_callback, on_close_callback):
+        """
+        Same as pika.SelectConnection
+        """
+        connection = broker.Connection(self, on_close_callback)
+        self.loop.call_soon(on_open_callback, connection)
+        return connection
+
+    def open_channel(self, connection):
+        self.channels += 1
+        return Channel(connection, f'{self.prefix}.{self.channels}')
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    #
+    # Setup
+    #
+    def declare_exchange(self, name, exchange_type):
+        self.db.execute('INSERT OR IGNORE INTO exchanges VALUES (?, ?)', (name, exchange_type))
+
+    def declare_queue(self, name, arguments):
+        arguments = json.dumps(arguments or {})
+        self.db.execute('INSERT OR IGNORE INTO queues VALUES (?, ?)', (name, arguments))
+
+    def bind(self, source, destination, routing_key, is_exchange):
+        self.db.execute(
+            'INSERT OR IGNORE INTO bindings VALUES (?, ?, ?, ?)',
+            (source, destination, routing_key, int(is_exchange)),
+        )
+
+    def load_topology(self):
+        """
+        Return the exchanges (name -> broker.Exchange) and the queues (name ->
+        arguments). They may have been declared by other processes.
+        """
+        exchanges = {}
+        for name, exchange_type in self.db.execute('SELECT * FROM exchanges'):
+            exchanges[name] = broker.Exchange(exchange_type)
+        for source, destination, routing_key, is_exchange in self.db.execute('SELECT * FROM bindings'):
+            if source in exchanges:
+                exchanges[source].bindings.append((destination, routing_key, bool(is_exchange)))
+
+        queues = {name: json.loads(arguments) for name, arguments in self.db.execute('SELECT * FROM queues')}
+        return exchanges, queues
+
+    #
+    # Publish, ack and nack, committed by flush
+    #
+    def publish(self, channel, tag, message):
+        self.pending.append((channel, tag, message))
+        self.schedule_flush()
+
+    def ack(self, message_ids, owner):
+        self.acks.extend((x, owner) for x in message_ids)
+        self.schedule_flush()
+
+    def nack(self, message_ids, owner, requeue):
+        self.nacks.extend((x, owner, requeue) for x in message_ids)
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def put(self, db, exchanges, queues, message, now, delay=0, depth=0):
+        """
+        Route the message and insert it in its queues. Return the number of
+        queues.
+        """
+        n = 0
+        for name in broker.route(exchanges, queues, message.exchange, message.routing_key):
+            arguments = queues[name]
+            ttl = arguments.get('x-message-ttl')
+            if ttl is not None:
+                # Goes to the dead letter exchange once the TTL expires
+                exchange = arguments.get('x-dead-letter-exchange')
+                if exchange is not None and depth < 10:
+                    routing_key = arguments.get('x-dead-letter-routing-key', message.routing_key)
+                    dead = message._replace(exchange=exchange, routing_key=routing_key)
+                    n += self.put(db, exchanges, queues, dead, now, delay + ttl / 1000, depth + 1)
+                continue
+
+            db.execute(
+                'INSERT INTO messages (queue, exchange, routing_key, properties, body, not_before)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (name, message.exchange, message.routing_key, message.properties, message.body, now + delay),
+            )
+            n += 1
+
+        return n
+
+    def dead_letter(self, db, exchanges, queues, message_id, now):
+        """
+        Send the message to the dead letter exchange of its queue, if any.
+        """
+        row = db.execute(
+            'SELECT queue, routing_key, properties, body FROM messages WHERE id = ?',
+            (message_id,),
+        ).fetchone()
+        if row is None:
+            return
+
+        name, routing_key, properties, body = row
+        arguments = queues.get(name, {})
+        exchange = arguments.get('x-dead-letter-exchange')
+        if exchange is not None:
+            routing_key = arguments.get('x-dead-letter-routing-key', routing_key)
+            message = broker.Message(exchange, routing_key, properties, body)
+            self.put(db, exchanges, queues, message, now)
+
+    def flush(self):
+        self.flush_scheduled = False
+        pending, self.pending = self.pending, []
+        acks, self.acks = self.acks, []
+        nacks, self.nacks = self.nacks, []
+        if not (pending or acks or nacks):
+            return
+
+        now = time.time()
+        with self.transaction() as db:
+            # The owner has changed if the lease expired, then the message has
+            # been delivered to another consumer
+            db.executemany('DELETE FROM messages WHERE id = ? AND owner = ?', acks)
+            self.stats['acked'] += len(acks)
+
+            exchanges, queues = self.load_topology()
+            for message_id, owner, requeue in nacks:
+                if not requeue:
+                    self.dead_letter(db, exchanges, queues, message_id, now)
+                    db.execute('DELETE FROM messages WHERE id = ? AND owner = ?', (message_id, owner))
+                else:
+                    db.execute(
+                        'UPDATE messages SET lease_until = 0, owner = NULL WHERE id = ? AND owner = ?',
+                        (message_id, owner),
+                    )
+
+            for channel, tag, message in pending:
+                self.stats['published'] += self.put(db, exchanges, queues, message, now)
+
+        # Confirm once committed
+        for channel, tag, message in pending:
+            if tag is not None:
+                channel.confirm(tag)
+
+        # More messages may be delivered now: published to or released from a
+        # queue consumed by this process, or acked
+        self.schedule_poll(0)
+
+    #
+    # Delivery
+    #
+    def consume(self, queue, channel, callback, consumer_tag):
+        self.consumers[queue] = (channel, callback, consumer_tag)
+        self.schedule_poll(0)
+
+    def cancel(self, channel, consumer_tag=None):
+        for queue, consumer in list(self.consumers.items()):
+            if consumer[0] is channel and (consumer_tag is None or consumer[2] == consumer_tag):
+                del self.consumers[queue]
+
+    def schedule_poll(self, delay):
+        if self.poll_timer is not None:
+            if delay:
+                return
+            self.poll_timer.cancel()
+
+        self.poll_timer = self.loop.call_later(delay, self.poll)
+
+    def poll(self):
+        self.poll_timer = None
+        if not self.consumers:
+            return
+
+        # Renew the leases of the messages being handled
+        now = time.time()
+        if now - self.renewed > self.lease / 3:
+            self.renew(now)
+
+        more = False
+        for queue, (channel, callback, consumer_tag) in list(self.consumers.items()):
+            limit = min(channel.available(), self.batch)
+            if limit <= 0:
+                continue
+
+            rows = self.claim(queue, channel.owner, limit, now)
+            more = more or len(rows) == limit
+            for message_id, exchange, routing_key, properties, body, delivered in rows:
+                # The consumer may have been cancelled, or the channel closed
+                if self.consumers.get(queue, (None,))[0] is not channel:
+                    self.nack([message_id], channel.owner, True)
+                    continue
+
+                redelivered = delivered > 0
+                self.stats['delivered'] += 1
+                self.stats['redelivered'] += redelivered
+                message = broker.Message(exchange, routing_key, properties, body)
+                method, properties, body = channel.track(queue, message_id, message, consumer_tag, redelivered)
+                callback(channel, method, properties, body)
+
+        self.schedule_poll(0 if more else self.poll_interval)
+
+    def claim(self, queue, owner, limit, now):
+        """
+        Lease up to limit messages of the queue, and return them.
+        """
+        with self.transaction() as db:
+            rows = db.execute(
+                'SELECT id, exchange, routing_key, properties, body, delivered FROM messages'
+                ' WHERE queue = ? AND not_before <= ? AND lease_until <= ?'
+                ' ORDER BY id LIMIT ?',
+                (queue, now, now, limit),
+            ).fetchall()
+            db.executemany(
+                'UPDATE messages SET lease_until = ?, owner = ?, delivered = delivered + 1 WHERE id = ?',
+                [(now + self.lease, owner, row[0]) for row in rows],
+            )
+
+        return rows
+
+    def renew(self, now):
+        self.renewed = now
+        owners = {channel.owner for channel, callback, tag in self.consumers.values() if channel.unacked}
+        with self.transaction() as db:
+            db.executemany(
+                'UPDATE messages SET lease_until = ? WHERE owner = ?',
+                [(now + self.lease, owner) for owner in owners],
+            )
+
+
+class Channel(broker.Channel):
+    """
+    Same interface as pika's channels, the part used by MQ.
+    """
+
+    def __init__(self, connection, owner):
+        super().__init__(connection)
+        self.owner = owner # Of the leases
+
+    # Setup
+    def exchange_declare(self, exchange, exchange_type='direct', durable=False, callback=None):
+        self.broker.declare_exchange(exchange, exchange_type)
+        self.ok(callback)
+
+    def exchange_bind(self, destination, source, routing_key='', callback=None):
+        self.broker.bind(source, destination, routing_key, True)
+        self.ok(callback)
+
+    def queue_declare(self, queue, durable=False, arguments=None, callback=None):
+        self.broker.declare_queue(queue, arguments)
+        self.ok(callback)
+
+    def queue_bind(self, queue, exchange, routing_key=None, callback=None):
+        self.broker.bind(exchange, queue, routing_key or queue, False)
+        self.ok(callback)
+
+    # Publish
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        if isinstance(body, str):
+            body = body.encode()
+
+        # The properties used by MQ
+        properties = properties or pika.BasicProperties()
+        properties = json.dumps({
+            'content_type': properties.content_type,
+            'type': properties.type,
+            'headers': properties.headers,
+        })
+
+        tag = None
+        if self.confirm_callback is not None:
+            self.publish_tag += 1
+            tag = self.publish_tag
+
+        message = broker.Message(exchange, routing_key, properties, body)
+        self.broker.publish(self, tag, message)
+
+    def confirm(self, tag):
+        if self.is_open:
+            self.ok(self.confirm_callback, pika.spec.Basic.Ack(delivery_tag=tag))
+
+    # Consume
+    def basic_consume(self, queue, on_message_callback, consumer_tag=None):
+        self.broker.consume(queue, self, on_message_callback, consumer_tag)
+
+    def basic_cancel(self, consumer_tag=None, callback=None):
+        self.broker.cancel(self, consumer_tag)
+        self.ok(callback)
+
+    def available(self):
+        """
+        Number of messages that may be delivered now.
+        """
+        if not self.is_open:
+            return 0
+
+        if not self.prefetch_count:
+            return self.broker.batch
+
+        return self.prefetch_count - len(self.unacked)
+
+    def track(self, queue, message_id, message, consumer_tag, redelivered):
+        self.delivery_tag += 1
+        self.unacked[self.delivery_tag] = message_id
+        method = types.SimpleNamespace(
+            delivery_tag=self.delivery_tag,
+            consumer_tag=consumer_tag,
+            exchange=message.exchange,
+            routing_key=message.routing_key,
+            redelivered=redelivered,
+        )
+        properties = pika.BasicProperties(delivery_mode=2, **json.loads(message.properties))
+        return method, properties, message.body
+
+    def settle(self, delivery_tag, multiple):
+        if multiple:
+            tags = [tag for tag in self.unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+
+        return [self.unacked.pop(tag) for tag in tags if tag in self.unacked]
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        message_ids = self.settle(delivery_tag, multiple)
+        self.broker.ack(message_ids, self.owner)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        message_ids = self.settle(delivery_tag, multiple)
+        self.broker.nack(message_ids, self.owner, requeue)
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        self.is_open = False
+
+        # Cancel the consumers, and release the messages not acknowledged now,
+        # the event loop may be stopping
+        self.broker.cancel(self)
+        self.broker.nack(list(self.unacked.values()), self.owner, True)
+        self.unacked.clear()
+        self.broker.flush()
+
+        for callback in self.close_callbacks:
+            self.broker.loop.call_soon(callback, self, reply_text)
@@ -0,0 +1,103 @@
+"""
+Persistent state of the programs, see MQ.db_name and MQ.set_state.
+"""
+
+# Standard Library
+import json
+import os
+import sqlite3
+import threading
+
+
+class State:
+    """
+    The values by source address and key, kept in memory and in a SQLite
+    database, in WAL mode, one row per value.
+
+    Updates only change the memory; flush writes the values changed since the
+    last flush, in a single transaction, so the database is never left half
+    written. The first time, the state is imported from the JSON file used
+    before (same name, .json extension), if any.
+
+    Values may be set from other threads (e.g. the XBee reader thread).
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {} # source_addr -> key -> value
+        self.dirty = {} # (source_addr, key) -> value, to be written by flush
+        self.lock = threading.Lock()
+        self.db = None
+        if path is None:
+            return
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS state ('
+            ' source_addr TEXT,'
+            ' key TEXT,'
+            ' value TEXT,' # JSON
+            ' PRIMARY KEY (source_addr, key))'
+        )
+        self.db.commit()
+
+        for source_addr, key, value in self.db.execute('SELECT * FROM state'):
+            self.data.setdefault(source_addr, {})[key] = json.loads(value)
+
+        # Import the JSON file
+        legacy = os.path.splitext(path)[0] + '.json'
+        if not self.data and os.path.exists(legacy):
+            with open(legacy) as file:
+                self.update(json.load(file))
+            self.flush()
+
+    def get(self, source_addr, key, default=None):
+        return self.data.get(source_addr, {}).get(key, default)
+
+    def set(self, source_addr, **kw):
+        """
+        Update the values of the given source address. Return True if the
+        state has changed and it was clean before, then a flush is due.
+        """
+        with self.lock:
+            was_clean = not self.dirty
+            values = self.data.setdefault(source_addr, {})
+            for key, value in kw.items():
+                if key not in values or values[key] != value:
+                    values[key] = value
+                    self.dirty[(source_addr, key)] = value
+
+            return was_clean and bool(self.dirty)
+
+    def update(self, data):
+        """
+        Update from a dict of dicts, like the one returned by to_dict.
+        """
+        for source_addr, values in data.items():
+            self.set(source_addr, **values)
+
+    def to_dict(self):
+        with self.lock:
+            return {addr: dict(values) for addr, values in self.data.items()}
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+            if not dirty or self.db is None:
+                return
+
+            self.db.executemany(
+                'INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                [(addr, key, json.dumps(value)) for (addr, key), value in dirty.items()],
+            )
+            self.db.commit()
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        self.flush()
+        if self.db is not None:
+            self.db.close()
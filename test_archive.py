@@ -0,0 +1,89 @@
+# Standard Library
+import json
+import os
+
+# Requirements
+import pytest
+
+# Project
+import archive
+
+
+T0 = 1735732800 # 2025-01-01 12:00 UTC
+
+
+def write(writer, day, lines):
+    for i in lines:
+        writer.write('A', day, json.dumps({'i': i, 'received': T0 + i}), T0 + i)
+    writer.flush()
+
+
+def test_pending_closed_and_late_lines(tmp_path):
+    """
+    Lines arrive late for a day whose .closed file is not compressed yet (e.g.
+    the compression was cancelled on stop): the .closed file is kept.
+    """
+    writer = archive.Writer(str(tmp_path))
+    day = archive.date.fromtimestamp(T0).strftime('%Y%m%d')
+    path = os.path.join(str(tmp_path), 'A', day)
+
+    write(writer, day, range(0, 2000))
+    assert writer.detach('A', day, day + archive.CLOSED)
+
+    # Late lines, while the .closed file waits
+    write(writer, day, range(2000, 2003))
+    assert not writer.detach('A', day, day + archive.CLOSED)
+    assert os.path.exists(path) and os.path.exists(path + archive.CLOSED)
+
+    # Compressed, then the late lines go next time
+    archive.compress(path)
+    assert writer.detach('A', day, day + archive.CLOSED)
+    archive.compress(path)
+    writer.close()
+
+    expected = list(range(2003))
+    assert [json.loads(line)['i'] for line in archive.read_lines(path)] == expected
+    assert [json.loads(line)['i'] for line in archive.query(path)] == expected
+    lines = archive.query(path, T0 + 1990, T0 + 2002)
+    assert [json.loads(line)['i'] for line in lines] == list(range(1990, 2002))
+
+
+def test_torn_line(tmp_path):
+    """
+    The program was killed while writing a line: the line left half written
+    is truncated when the day is opened again, and new lines are appended.
+    """
+    writer = archive.Writer(str(tmp_path))
+    day = archive.date.fromtimestamp(T0).strftime('%Y%m%d')
+    path = os.path.join(str(tmp_path), 'A', day)
+    write(writer, day, range(0, 10))
+    writer.close()
+
+    with open(path, 'a') as file:
+        file.write('{"i": 10, "rece')
+
+    writer = archive.Writer(str(tmp_path))
+    write(writer, day, range(11, 13))
+    writer.close()
+
+    expected = list(range(10)) + [11, 12]
+    assert [json.loads(line)['i'] for line in archive.read_lines(path)] == expected
+    assert [json.loads(line)['i'] for line in archive.query(path)] == expected
+
+
+def test_flush_day_fails(tmp_path):
+    """
+    A day that cannot be written does not keep the others from being
+    written, its lines are kept for the next flush.
+    """
+    writer = archive.Writer(str(tmp_path))
+    day = archive.date.fromtimestamp(T0).strftime('%Y%m%d')
+    open(os.path.join(str(tmp_path), 'B'), 'w').close() # Not a directory
+
+    writer.write('B', day, json.dumps({'i': 0, 'received': T0}), T0)
+    writer.write('A', day, json.dumps({'i': 0, 'received': T0}), T0)
+    with pytest.raises(OSError):
+        writer.flush()
+
+    assert list(writer.pending) == [('B', day)]
+    assert len(list(archive.read_lines(os.path.join(str(tmp_path), 'A', day)))) == 1
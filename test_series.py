@@ -0,0 +1,51 @@
+# Standard Library
+import os
+
+# Project
+import archive
+import series
+
+
+T0 = 1735732800 # 2025-01-01 12:00 UTC
+
+
+def test_roll_empty(tmp_path):
+    """
+    A .part file left empty (the program was killed) is removed, without
+    writing a chunk.
+    """
+    day = series.get_day(T0)
+    path = os.path.join(str(tmp_path), 'A', 'bme_tc', day)
+    os.makedirs(os.path.dirname(path))
+    open(path + archive.CLOSED, 'wb').close()
+
+    series.roll(path)
+    assert os.listdir(os.path.dirname(path)) == []
+    assert len(series.read(str(tmp_path), 'A', 'bme_tc')[0]) == 0
+
+
+def test_pending_closed_and_late_values(tmp_path):
+    """
+    Values arrive late for a day whose .closed file is not rolled yet: the
+    .closed file is kept, the .part file is detached once it is rolled.
+    """
+    writer = series.Writer(str(tmp_path), fsync=False)
+    day = series.get_day(T0)
+    path = os.path.join(str(tmp_path), 'A', 'bme_tc', day)
+
+    for i in range(10):
+        writer.add({'source_addr': 'A', 'received': T0 + i, 'bme_tc': i})
+    writer.flush()
+    assert writer.detach('A', 'bme_tc', day)
+
+    writer.add({'source_addr': 'A', 'received': T0 + 10, 'bme_tc': 10})
+    writer.flush()
+    assert not writer.detach('A', 'bme_tc', day)
+
+    series.roll(path)
+    assert writer.detach('A', 'bme_tc', day)
+    series.roll(path)
+
+    times, values = series.read(str(tmp_path), 'A', 'bme_tc')
+    assert times.tolist() == [T0 + i for i in range(11)]
+    assert values.tolist() == list(range(11))
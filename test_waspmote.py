@@ -0,0 +1,445 @@
+"""
+Differential tests of the waspmote parser: the output must be the same as the
+parser it replaced (old_parse_frame below, a copy of it).
+"""
+
+# Standard Library
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import random
+import struct
+import sys
+
+# Requirements
+from Crypto.Cipher import AES
+
+# Project
+import waspmote
+
+
+KEY = b'0123456789abcdef'
+
+
+#
+# The parser before the precompiled layouts, kept as reference
+#
+def old_parse_frame(src, cipher_key=None):
+    if cipher_key is not None and type(cipher_key) is not bytes:
+        raise TypeError('cipher_key must be None or bytes, got %s' % type(cipher_key))
+
+    # Skip garbage (search start delimiter)
+    n = src.find(b'<=>')
+    if n == -1:
+        raise waspmote.FrameNotFound()
+    elif n > 0:
+        src = src[n:]
+
+    line = src[3:] # Skip Start delimiter
+
+    # Frame type
+    frame_type = struct.unpack_from("B", line)[0]
+    line = line[1:]
+
+    if frame_type & 128: # b7
+        raise waspmote.ParseError("Text frames not supported (%d)" % frame_type)
+
+    if frame_type == 96:
+        encrypted = True
+        v15 = True
+    elif 96 < frame_type < 100:
+        encrypted = True
+        v15 = False
+    elif frame_type > 11:
+        raise waspmote.ParseError("Frame type %d not supported" % frame_type)
+    else:
+        encrypted = False
+        v15 = frame_type > 5
+        if v15:
+            frame_type -= 6
+
+        frame = {'type': frame_type}
+
+    # Number of bytes (Binary)
+    n = struct.unpack_from("B", line)[0]
+    line = line[1:]
+    rest = line[n:]
+    line = line[:n]
+
+    # Serial id
+    if v15:
+        serial_id = struct.unpack_from(">Q", line)[0]
+        line = line[8:]
+    else:
+        serial_id = struct.unpack_from(">I", line)[0]
+        line = line[4:]
+
+    # Encrypted
+    if encrypted:
+        if not v15:
+            name, line = line.split(b'#', 1)
+            name = name.decode()
+
+        if cipher_key is None:
+            raise waspmote.ParseError('Encrypted frames not supported because no key provided')
+
+        line = AES.new(cipher_key, AES.MODE_ECB).decrypt(line)
+        frame, _ = old_parse_frame(line) # _ may contain zeroes
+        if frame['serial'] != serial_id:
+            raise waspmote.ParseError("Serial numbers do not match %d != %d", serial_id, frame['serial'])
+
+        if not v15 and frame['name'] != name:
+            raise waspmote.ParseError("Names do not match %s != %s", name, frame['name'])
+
+        return frame, rest
+
+    # Name
+    name, line = line.split(b'#', 1)
+    name = name.decode() # bytes to str
+    # Sequence
+    sequence = struct.unpack_from("B", line)[0]
+    line = line[1:] # Payload
+
+    frame['serial'] = serial_id
+    frame['frame'] = sequence # Frame sequence
+    frame['name'] = name
+
+    while line:
+        sensor_id = struct.unpack_from("B", line)[0]
+        line = line[1:]
+        sensor = waspmote.SENSORS.get(sensor_id, ())
+        if not sensor:
+            break
+
+        form, names, post = itertools.islice(itertools.chain(sensor, itertools.repeat(None)), 3)
+        if post is None:
+            post = waspmote.post_noop
+
+        for c, name in zip(form, names):
+            name = name.lower()
+            if c == 'f':
+                value = struct.unpack_from("f", line)[0]
+                line = line[4:]
+            elif c == 'i':
+                value = struct.unpack_from("b", line)[0]
+                line = line[1:]
+            elif c == 'j':
+                value = struct.unpack_from("h", line)[0]
+                line = line[2:]
+            elif c == 'k':
+                value = struct.unpack_from("i", line)[0]
+                line = line[4:]
+            elif c == 'u':
+                value = struct.unpack_from("B", line)[0]
+                line = line[1:]
+            elif c == 'v':
+                value = struct.unpack_from("H", line)[0]
+                line = line[2:]
+            elif c == 'w':
+                value = struct.unpack_from("I", line)[0]
+                line = line[4:]
+            elif c == 'str':
+                length = struct.unpack_from("B", line)[0]
+                line = line[1:]
+                value = line[:length]
+                line = line[length:]
+            elif c == 'n':
+                values = []
+                n_values = struct.unpack_from("B", line)[0]
+                line = line[1:]
+                for j in range(n_values):
+                    if j > 0:
+                        value = struct.unpack_from("b", line)[0]
+                        line = line[1:]
+                        if value != -128:
+                            value = values[-1] + value
+                            values.append(value)
+                            continue
+
+                    value = struct.unpack_from("h", line)[0]
+                    line = line[2:]
+                    values.append(value)
+
+                value = frame.get(name, []) + values
+
+            frame[name] = post(name, value)
+
+    return frame, rest
+
+
+#
+# Frame generator
+#
+FORMATS = {'f': '<f', 'i': '<b', 'j': '<h', 'k': '<i', 'u': '<B', 'v': '<H', 'w': '<I'}
+# Strings are not read by the old parser, see test_parse_frame_strings
+SENSOR_IDS = [key for key in waspmote.SENSORS if key not in (55, 65)]
+
+
+def gen_value(rng, c):
+    if c == 'f':
+        return rng.uniform(-1000, 1000)
+
+    bits = struct.calcsize(FORMATS[c]) * 8
+    if c in 'ijk':
+        return rng.randint(-2 ** (bits - 1), 2 ** (bits - 1) - 1)
+    return rng.randint(0, 2 ** bits - 1)
+
+
+def gen_array(rng, maxsize=255):
+    """
+    Array of int16, delta encoded: -128 means the next value is absolute. The
+    length is around ARRAY_THRESHOLD as often as not, so both readers are
+    used, up to the values that fit in maxsize bytes.
+    """
+    threshold = waspmote.ARRAY_THRESHOLD
+    n = rng.choice([
+        rng.randint(0, threshold - 1),
+        rng.randint(threshold - 4, threshold + 4),
+        rng.randint(threshold, 255),
+    ])
+    escapes = rng.choice([0, 0.02, 0.15, 0.5]) # Absolute values
+
+    chunks = []
+    value = 0
+    size = 1
+    for j in range(n):
+        if j > 0 and rng.random() >= escapes:
+            delta = rng.randint(-127, 127)
+            if -32768 <= value + delta <= 32767:
+                chunk = struct.pack('<b', delta)
+                value += delta
+            else:
+                value = rng.randint(-32768, 32767)
+                chunk = struct.pack('<bh', -128, value)
+        else:
+            value = rng.randint(-32768, 32767)
+            chunk = struct.pack('<bh', -128, value) if j > 0 else struct.pack('<h', value)
+
+        if size + len(chunk) > maxsize:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+
+    return bytes([len(chunks)]) + b''.join(chunks)
+
+
+def gen_string(rng, maxsize=255):
+    n = rng.randint(0, min(20, maxsize - 1))
+    value = ''.join(rng.choice('0123456789ABCDEF:') for i in range(n))
+    return bytes([n]) + value.encode()
+
+
+def get_min_size(form):
+    if form in ('n', 's'):
+        return 1 # The length
+
+    return sum(struct.calcsize(FORMATS[c]) for c in form)
+
+
+def gen_frame(rng, v15=True, serial=None, ids=None, key=None):
+    serial = rng.randint(0, 2 ** 32 - 1) if serial is None else serial
+    if ids is None:
+        ids = [rng.choice(SENSOR_IDS) for i in range(rng.randint(0, 8))]
+
+    # The frame length is a byte: serial, name, sequence and payload. The
+    # arrays and strings take the room left by the sensors after them.
+    room = 255 - (8 if v15 else 4) - len(b'mote1#') - 1
+    sizes = [1 + get_min_size(waspmote.SENSORS[sensor_id][0]) for sensor_id in ids]
+    payload = b''
+    for k, sensor_id in enumerate(ids):
+        form = waspmote.SENSORS[sensor_id][0]
+        payload += bytes([sensor_id])
+        maxsize = max(room - len(payload) - sum(sizes[k + 1:]), 1)
+        if form == 'n':
+            payload += gen_array(rng, maxsize)
+        elif form == 's':
+            payload += gen_string(rng, maxsize)
+        else:
+            payload += b''.join(struct.pack(FORMATS[c], gen_value(rng, c)) for c in form)
+
+    frame_type = rng.choice([0, 2]) + (6 if v15 else 0)
+    serial = struct.pack('>Q' if v15 else '>I', serial)
+    inner = serial + b'mote1#' + bytes([rng.randint(0, 255)]) + payload
+    frame = b'<=>' + bytes([frame_type, len(inner) % 256]) + inner
+    if key is None:
+        return frame
+
+    # Encrypted
+    frame += b'\x00' * (-len(frame) % 16)
+    encrypted = AES.new(key, AES.MODE_ECB).encrypt(frame)
+    if v15:
+        outer, frame_type = serial + encrypted, 96
+    else:
+        outer, frame_type = serial + b'mote1#' + encrypted, 97
+    return b'<=>' + bytes([frame_type, len(outer) % 256]) + outer
+
+
+def call(function, data):
+    try:
+        return function(data, cipher_key=KEY)
+    except Exception as exc:
+        return type(exc)
+
+
+def test_parse_frame_differential(monkeypatch):
+    # Count the arrays read with NumPy
+    calls = []
+    read_array_numpy = waspmote.read_array_numpy
+    def counted(*args):
+        calls.append(args)
+        return read_array_numpy(*args)
+    monkeypatch.setattr(waspmote, 'read_array_numpy', counted)
+
+    rng = random.Random(1)
+    for i in range(5000):
+        v15 = rng.random() < 0.7
+        kind = rng.random()
+        if kind < 0.15:
+            # Arrays, long or not
+            ids = [rng.choice([203, 213, 214])]
+            if rng.random() < 0.5:
+                ids = [210] + ids + [123]
+            data = gen_frame(rng, v15=v15, ids=ids)
+        elif kind < 0.2:
+            # Encrypted
+            data = gen_frame(rng, v15=v15, ids=[210, 123], key=KEY)
+        elif kind < 0.3:
+            # Garbage
+            data = bytes(rng.randint(0, 255) for i in range(rng.randint(0, 60)))
+            if rng.random() < 0.5:
+                data = b'<=>' + data
+        else:
+            data = rng.choice([b'', b'garbage']) + gen_frame(rng, v15=v15) + rng.choice([b'', b'\n', b'<=>'])
+
+        # Truncated
+        if rng.random() < 0.2:
+            data = data[:rng.randint(0, len(data))]
+
+        expected = call(old_parse_frame, data)
+        result = call(waspmote.parse_frame, data)
+        if type(expected) is type:
+            # Both fail, the exception may differ
+            assert type(result) is type, data
+        else:
+            assert result == expected, data
+
+    assert len(calls) > 200
+
+
+def test_parse_frame_strings():
+    """
+    The strings ('s') are read as a length and UTF-8 bytes. The old parser
+    did not read them (it tested for 'str'), the value was the one of the
+    previous sensor and the string bytes were read as sensors. The other
+    values are the same.
+    """
+    rng = random.Random(5)
+    for i in range(200):
+        sensor_id = rng.choice([55, 65])
+        ids = [210, sensor_id, 123]
+        data = gen_frame(rng, ids=ids)
+        expected, rest = old_parse_frame(remove_sensor(data, sensor_id))
+        frame, rest = waspmote.parse_frame(data)
+
+        name = waspmote.SENSORS[sensor_id][1][0]
+        value = frame.pop(name)
+        assert type(value) is str
+        assert frame == expected
+
+
+def remove_sensor(data, sensor_id):
+    """
+    Return the (plain v15) frame without the given string sensor.
+    """
+    offset = 5 + 8 + len(b'mote1#') + 1 + 13 # After the header and bme (210)
+    assert data[offset] == sensor_id
+    length = data[offset + 1]
+    data = data[:offset] + data[offset + 2 + length:]
+    return data[:4] + bytes([len(data) - 5]) + data[5:]
+
+
+def old_parse_frames(payloads):
+    """
+    The rows expected from parse_frames, parsed one by one.
+    """
+    rows = []
+    for payload in payloads:
+        data = base64.b64decode(payload['data'])
+        while data:
+            try:
+                frame, data = old_parse_frame(data, cipher_key=KEY)
+            except Exception:
+                break
+            frame.update(received=payload['received'], source_addr=payload['source_addr'])
+            rows.append(frame)
+    return rows
+
+
+def assert_columns(columns, rows):
+    assert all(len(column) == len(rows) for column in columns.values())
+    for i, row in enumerate(rows):
+        for name, column in columns.items():
+            value = column[i]
+            if name not in row:
+                assert value is None or value != value # NaN
+            elif type(row[name]) is list:
+                assert list(value) == row[name]
+            else:
+                assert value == row[name], (name, value, row[name])
+
+
+def test_parse_frames_twice():
+    """
+    The second time the layouts are cached, every frame is grouped.
+    """
+    rng = random.Random(2)
+    layouts = [[52, 54, 210], [123, 63, 216, 219], [203, 123]]
+    payloads = []
+    for i in range(200):
+        data = b''.join(gen_frame(rng, serial=i % 3, ids=rng.choice(layouts)) for j in range(rng.randint(1, 3)))
+        payloads.append({'source_addr': 'A', 'received': 1600000000 + i, 'data': base64.b64encode(data).decode()})
+
+    waspmote.layout_cache.cache_clear()
+    rows = old_parse_frames(payloads)
+    assert_columns(waspmote.parse_frames(payloads, cipher_key=KEY), rows)
+    assert_columns(waspmote.parse_frames(payloads, cipher_key=KEY), rows)
+
+
+def test_parse_frame_truncated():
+    """
+    Frames that cannot be decoded raise ParseError, so they are rejected and
+    not retried (see wsn_raw_cook).
+    """
+    rng = random.Random(3)
+    for i in range(2000):
+        data = gen_frame(rng, v15=rng.random() < 0.7, ids=[203, 210, 123])
+        data = data[:rng.randint(0, len(data) - 1)]
+        try:
+            waspmote.parse_frame(data, cipher_key=KEY)
+        except waspmote.ParseError:
+            pass
+
+
+def test_layout_cache_threads(monkeypatch):
+    """
+    The layout cache is shared by the threads of the pool (see MQ.threads), a
+    valid frame never fails because of another thread.
+    """
+    rng = random.Random(4)
+    layouts = [[52, 54, 210], [123, 63, 216, 219], [203, 123], [210], [52]]
+    frames = [gen_frame(rng, serial=i % 4, ids=rng.choice(layouts)) for i in range(400)]
+    expected = [old_parse_frame(data, cipher_key=KEY)[0] for data in frames]
+    monkeypatch.setattr(waspmote.layout_cache, 'maxsize', 4) # Evict often
+
+    def parse(frames):
+        return [waspmote.parse_frame(data, cipher_key=KEY)[0] for data in frames]
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(4) as pool:
+            futures = [pool.submit(parse, frames) for i in range(8)]
+            for future in futures:
+                assert future.result() == expected
+    finally:
+        sys.setswitchinterval(interval)
@@ -1,5 +1,7 @@
 from configparser import RawConfigParser as ConfigParser
-from digi.xbee import devices
+from datetime import datetime
+
+# digi.xbee is imported only when used, most programs do not need it
 
 
 def get_section(config_parser, name, default=None):
@@ -15,7 +17,29 @@ def get_config(name):
     return get_section(config_parser, name)
 
 
+def get_bool(config, name, default=False):
+    """
+    Return the boolean value of the given option: yes/no, true/false, on/off
+    or 1/0.
+    """
+    value = config.get(name)
+    if value is None:
+        return default
+
+    return ConfigParser.BOOLEAN_STATES[value.lower()]
+
+
+def parse_time(value):
+    """
+    Return the seconds since the epoch of the given local time, in ISO format
+    (e.g. 2025-01-01 or 2025-01-01T12:00). To be used as argparse type.
+    """
+    return datetime.fromisoformat(value).timestamp()
+
+
 def get_device(config):
+    from digi.xbee import devices
+
     port = config.get('port', '/dev/serial0')
     bauds = int(config.get('bauds', 9600))
 
@@ -41,6 +65,8 @@ def get_address(remote):
 
 
 def send_data_async(device, remote, data):
+    from digi.xbee import devices
+
     # 802.15.4
     if isinstance(device, devices.Raw802Device):
         address = get_address(remote)
@@ -4,14 +4,14 @@ Script to parse frames from waspmote
 Simon Filhol, J. David Ibáñez
 '''
 
+import base64
+import collections
 import itertools
 import logging
 import math
+import operator
 import struct
-
-# Requirements
-from Crypto.Cipher import AES
-
+import threading
 
 
 logger = logging.getLogger(__name__)
@@ -34,7 +34,10 @@ def post_acc(name, value):
 def post_ds1820(name, value):
     #f = lambda x: x if (-100 < x < 100) else None # None if out of range
     #values = [f(value / 16) for value in values]
-    return [value / 16 for value in value]
+    if type(value) is list:
+        return [value / 16 for value in value]
+
+    return value / 16 # NumPy array
 
 def post_ctd_old(name, value):
     if name == 'ctd_temp':
@@ -104,6 +107,9 @@ def post_atmos41(name, value):
 
     return value / scale if scale != 1 else value
 
+# These work as well with NumPy arrays
+VECTORIZED = {post_ctd, post_ds2, post_atmos22, post_atmos41}
+
 
 """
 f - float
@@ -190,6 +196,58 @@ def unpack(n, iterable):
     return itertools.islice(infinite, n)
 
 
+"""
+Every entry in SENSORS is compiled once, at import time. Sensors with a fixed
+size get a struct.Struct to read all their values with a single call, the
+variable size formats ('n' and 's') have their own reader functions.
+"""
+
+STRUCT_FORMATS = {
+    'f': 'f',
+    'i': 'b',
+    'j': 'h',
+    'k': 'i',
+    'u': 'B',
+    'v': 'H',
+    'w': 'I',
+}
+
+# Arrays ('n') this long or longer are read with NumPy
+ARRAY_THRESHOLD = 48
+
+NUMPY_FORMATS = {
+    'f': '<f4',
+    'i': 'i1',
+    'j': '<i2',
+    'k': '<i4',
+    'u': 'u1',
+    'v': '<u2',
+    'w': '<u4',
+}
+
+UINT8 = struct.Struct('B')
+INT8 = struct.Struct('b')
+INT16 = struct.Struct('<h')
+UINT32_BE = struct.Struct('>I')
+UINT64_BE = struct.Struct('>Q')
+
+Sensor = collections.namedtuple('Sensor', ['form', 'names', 'post', 'struct'])
+
+def compile_sensor(sensor):
+    form, names, post = unpack(3, sensor)
+    if post is None:
+        post = post_noop
+
+    names = tuple(name.lower() for name in names)
+    if form in ('n', 's'):
+        return Sensor(form, names, post, None)
+
+    fmt = '<' + ''.join(STRUCT_FORMATS[c] for c in form)
+    return Sensor(form, names, post, struct.Struct(fmt))
+
+COMPILED = {sensor_id: compile_sensor(sensor) for sensor_id, sensor in SENSORS.items()}
+
+
 def search_frame(data):
     """
     Search the frame starting with the delimiter <=>, return a tuple with:
@@ -220,33 +278,458 @@ def get_cipher(key):
 
     cipher = ciphers.get(key)
     if cipher is None:
+        # Imported only for encrypted deployments
+        from Crypto.Cipher import AES
         cipher = AES.new(key, AES.MODE_ECB)
         ciphers[key] = cipher
 
     return cipher
 
 
-def parse_frame(src, cipher_key=None):
+def read_array(buf, offset):
     """
-    Parse the frame starting at the given byte string. We consider that the
-    frame start delimeter has already been read.
+    Read a variable list of int16 values (done for the DS18B20 string). The
+    first value is absolute, the next ones are int8 deltas, a delta of -128
+    means an absolute int16 value follows.
+
+    Return the values and the offset past the array. Long arrays are read with
+    NumPy and returned as an array, short ones as a list (for these the NumPy
+    overhead is higher than the gain).
+    """
+    n_values = UINT8.unpack_from(buf, offset)[0]
+    offset += 1
+
+    if n_values >= ARRAY_THRESHOLD:
+        return read_array_numpy(buf, offset, n_values)
+
+    values = []
+    for j in range(n_values):
+        if j > 0:
+            value = INT8.unpack_from(buf, offset)[0]
+            offset += 1
+            if value != -128:
+                values.append(values[-1] + value)
+                continue
+
+        value = INT16.unpack_from(buf, offset)[0]
+        offset += 2
+        values.append(value)
+
+    return values, offset
+
+
+def read_array_numpy(buf, offset, n_values):
+    """
+    Vectorized version of read_array. The deltas are read in bulk, up to the
+    next absolute value (if any), and every run is restored with a cumulative
+    sum.
+    """
+    import numpy # Only for long arrays, it takes time to import
+
+    start = INT16.unpack_from(buf, offset)[0]
+    offset += 2
+    remaining = n_values - 1
+
+    runs = []
+    while True:
+        # If there are absolute values the data is longer than remaining bytes
+        deltas = numpy.frombuffer(buf, numpy.int8, count=remaining, offset=offset)
+        absolute = numpy.flatnonzero(deltas == -128)
+        size = absolute[0] if absolute.size else remaining
+        run = numpy.empty(size + 1, numpy.int64)
+        run[0] = start
+        run[1:] = deltas[:size]
+        runs.append(numpy.cumsum(run, out=run))
+        offset += size
+        remaining -= size
+        if not remaining:
+            break
+
+        start = INT16.unpack_from(buf, offset + 1)[0]
+        offset += 3
+        remaining -= 1
+
+    values = numpy.concatenate(runs) if len(runs) > 1 else runs[0]
+    return values, offset
+
+
+def read_string(buf, offset):
+    """
+    Read a string prefixed by its length (uint8).
+
+    Return the string and the offset past it.
+    """
+    length = UINT8.unpack_from(buf, offset)[0]
+    offset += 1
+    value = bytes(buf[offset:offset+length]).decode()
+    return value, offset + length
+
+
+def read_name(src, offset, end):
+    """
+    Read the mote name, terminated by '#'.
+
+    Return the name and the offset past the delimiter.
+    """
+    index = src.find(b'#', offset, end)
+    if index == -1:
+        raise ValueError('Name delimiter not found')
+
+    return src[offset:index].decode(), index + 1
+
+
+def tolist(values):
+    if type(values) is list:
+        return values
+
+    return values.tolist() # NumPy array
+
+
+def read_variable(sensor, buf, offset, frame):
+    """
+    Read the value of a variable size sensor ('n' or 's') into the frame.
+
+    Return the offset past the value.
+    """
+    name = sensor.names[0]
+    if sensor.form == 'n':
+        values, offset = read_array(buf, offset)
+        if name in frame:
+            values = frame[name] + tolist(values)
+
+        frame[name] = tolist(sensor.post(name, values))
+    else: # 's'
+        value, offset = read_string(buf, offset)
+        frame[name] = sensor.post(name, value)
+
+    return offset
+
+
+def parse_sensors(buf, offset, end, frame):
+    """
+    Parse the payload one sensor at a time, the values are stored in the
+    frame.
+
+    Return the sequence of sensor ids found, or None if the payload could not
+    be parsed to the end (unsupported sensor). Raise ParseError if it could
+    not be decoded (e.g. truncated).
+    """
+    try:
+        return read_sensors(buf, offset, end, frame)
+    except (struct.error, ValueError, IndexError) as exc:
+        raise ParseError(f'Failed to decode payload: {exc}') from exc
+
+
+def read_sensors(buf, offset, end, frame):
+    sensor_ids = []
+    while offset < end:
+        sensor_id = buf[offset]
+        offset += 1
+        sensor = COMPILED.get(sensor_id)
+        if sensor is None:
+            logger.error("Sensor type %d not supported" % sensor_id)
+            return None
+
+        sensor_ids.append(sensor_id)
+        if sensor.struct is None:
+            offset = read_variable(sensor, buf, offset, frame)
+            continue
+
+        values = sensor.struct.unpack_from(buf, offset)
+        offset += sensor.struct.size
+        post = sensor.post
+        if post is post_noop:
+            frame.update(zip(sensor.names, values))
+        else:
+            for name, value in zip(sensor.names, values):
+                frame[name] = post(name, value)
+
+    return tuple(sensor_ids)
+
+
+def itemgetter(indexes):
+    """
+    Like operator.itemgetter, but always returns a tuple.
+    """
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda values: (values[index],)
+
+    return operator.itemgetter(*indexes)
+
+
+Segment = collections.namedtuple('Segment', [
+    'struct',       # struct.Struct for the sensor ids and values, or None
+    'get_ids',      # Returns the sensor ids from the unpacked values
+    'ids',          # The expected sensor ids
+    'get_values',   # Returns the sensor values from the unpacked values
+    'fields',       # Sequence of (name, post) pairs, post is None for noop
+    'sensor',       # The Sensor, for variable size segments
+])
+
+
+class Layout:
+    """
+    The layout of the payload for a given sequence of sensor ids. Runs of
+    fixed size sensors are merged into a single struct.Struct, sensor ids
+    included, so they are read with a single call. Variable size sensors
+    ('n' and 's') make their own segment.
+    """
+
+    def __init__(self, sensor_ids):
+        self.segments = []
+        run = []
+        for sensor_id in sensor_ids:
+            sensor = COMPILED[sensor_id]
+            if sensor.struct is not None:
+                run.append((sensor_id, sensor))
+                continue
+
+            if run:
+                self.segments.append(self.compile_run(run))
+                run = []
+            self.segments.append(Segment(None, None, (sensor_id,), None, None, sensor))
+
+        if run:
+            self.segments.append(self.compile_run(run))
+
+        # Payloads made only of fixed size sensors can be read in bulk with
+        # NumPy, see parse_many
+        self.fields = None # Of the NumPy dtype
+        self.size = None
+        self.id_offsets = None
+        if len(self.segments) == 1 and self.segments[0].struct is not None:
+            self.compile_dtype(sensor_ids)
+
+    def compile_dtype(self, sensor_ids):
+        fields = []
+        id_offsets = []
+        offset = 0
+        for sensor_id in sensor_ids:
+            sensor = COMPILED[sensor_id]
+            fields.append((f'id{len(id_offsets)}', 'u1'))
+            id_offsets.append((offset, sensor_id))
+            offset += 1 + sensor.struct.size
+            for c in sensor.form:
+                fields.append((f'v{len(fields) - len(id_offsets)}', NUMPY_FORMATS[c]))
+
+        self.fields = fields
+        self.size = offset
+        self.id_offsets = id_offsets
+
+    @staticmethod
+    def compile_run(run):
+        fmt = []
+        ids = []
+        id_indexes = []
+        value_indexes = []
+        fields = []
+        index = 0
+        for sensor_id, sensor in run:
+            fmt.append('B' + sensor.struct.format[1:])
+            ids.append(sensor_id)
+            id_indexes.append(index)
+            size = len(sensor.names)
+            value_indexes.extend(range(index + 1, index + 1 + size))
+            post = None if sensor.post is post_noop else sensor.post
+            fields.extend((name, post) for name in sensor.names)
+            index += 1 + size
+
+        return Segment(
+            struct.Struct('<' + ''.join(fmt)),
+            itemgetter(id_indexes),
+            tuple(ids),
+            itemgetter(value_indexes),
+            tuple(fields),
+            None,
+        )
+
+    def parse(self, buf, offset, end):
+        """
+        Return a dict with the values, or None if the payload does not match
+        this layout.
+        """
+        values = {}
+        try:
+            for segment in self.segments:
+                if segment.struct is None:
+                    if buf[offset] != segment.ids[0]:
+                        return None
+                    offset = read_variable(segment.sensor, buf, offset + 1, values)
+                    continue
+
+                unpacked = segment.struct.unpack_from(buf, offset)
+                if segment.get_ids(unpacked) != segment.ids:
+                    return None
+                offset += segment.struct.size
+
+                for (name, post), value in zip(segment.fields, segment.get_values(unpacked)):
+                    values[name] = value if post is None else post(name, value)
+        except (IndexError, ValueError, struct.error):
+            return None
+
+        if offset != end:
+            return None
+
+        return values
+
+    def match(self, buf, offset, end):
+        """
+        Return whether the payload matches this layout, only for fixed size
+        layouts (size is not None).
+        """
+        if end - offset != self.size:
+            return False
+
+        return all(buf[offset + i] == sensor_id for i, sensor_id in self.id_offsets)
+
+    def parse_many(self, data):
+        """
+        Parse in one go many payloads matching this layout, data is their
+        concatenation. Yield (name, values) pairs, values are float64 arrays
+        with one item per payload.
+        """
+        import numpy
+
+        records = numpy.frombuffer(data, dtype=numpy.dtype(self.fields))
+        for i, (name, post) in enumerate(self.segments[0].fields):
+            values = records[f'v{i}'].astype(numpy.float64)
+            if post in VECTORIZED:
+                values = post(name, values)
+            elif post is not None:
+                values = [post(name, value) for value in values.tolist()]
+                values = numpy.array(values, dtype=numpy.float64)
+
+            yield name, values
+
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LayoutCache:
+    """
+    LRU cache of the layouts seen, keyed by serial and sequence of sensor
+    ids. For every frame the most recent layouts of the mote are tried first,
+    if none matches the payload is parsed one sensor at a time, and the new
+    layout is remembered.
+
+    It is shared by the threads (see MQ.threads): the cache is only read and
+    updated with the lock held, the payloads are parsed without it.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.layouts = collections.OrderedDict() # (serial, sensor_ids) -> Layout
+        self.by_serial = {} # serial -> [sensor_ids, ...], most recent first
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_recent(self, serial):
+        """
+        Return the (sensor_ids, layout) pairs of the mote, most recent first.
+        """
+        with self.lock:
+            return [
+                (sensor_ids, self.layouts[serial, sensor_ids])
+                for sensor_ids in self.by_serial.get(serial, ())
+            ]
+
+    def parse(self, serial, buf, offset, end, frame):
+        for sensor_ids, layout in self.get_recent(serial):
+            values = layout.parse(buf, offset, end)
+            if values is not None:
+                self.touch(serial, sensor_ids, hit=True)
+                frame.update(values)
+                return
+
+        with self.lock:
+            self.misses += 1
+
+        sensor_ids = parse_sensors(buf, offset, end, frame)
+        if sensor_ids is not None:
+            self.touch(serial, sensor_ids)
+
+    def lookup(self, serial, buf, offset, end):
+        """
+        Return the cached layout of the payload, if it has a fixed size. Used
+        by parse_frames, to group payloads by layout.
+        """
+        for sensor_ids, layout in self.get_recent(serial):
+            if layout.size is not None and layout.match(buf, offset, end):
+                self.touch(serial, sensor_ids, hit=True)
+                return layout
+
+        return None
+
+    def touch(self, serial, sensor_ids, hit=False):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            self.insert(serial, sensor_ids)
+
+    def insert(self, serial, sensor_ids):
+        key = (serial, sensor_ids)
+        recent = self.by_serial.setdefault(serial, [])
+        if key in self.layouts:
+            self.layouts.move_to_end(key)
+            recent.remove(sensor_ids)
+            recent.insert(0, sensor_ids)
+        else:
+            self.layouts[key] = Layout(sensor_ids)
+            recent.insert(0, sensor_ids)
+            if len(self.layouts) > self.maxsize:
+                self.evict()
+
+    def evict(self):
+        (serial, sensor_ids), layout = self.layouts.popitem(last=False)
+        recent = self.by_serial[serial]
+        recent.remove(sensor_ids)
+        if not recent:
+            del self.by_serial[serial]
+
+    def cache_info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.layouts))
+
+    def cache_clear(self):
+        with self.lock:
+            self.layouts.clear()
+            self.by_serial.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+layout_cache = LayoutCache()
+
+
+def parse_header(src, cipher_key=None):
+    """
+    Parse the header of the frame starting at the given byte string, and
+    decrypt the frame if encrypted.
+
+    Return a tuple with:
+
+    - the frame, a dict with the header fields (type, serial, frame, name)
+    - a memoryview with the frame, and the offsets where its payload starts
+      and ends
+    - the data after the frame
     """
 
     if cipher_key is not None and type(cipher_key) is not bytes:
         raise TypeError('cipher_key must be None or bytes, got %s' % type(cipher_key))
 
     # Skip garbage (search start delimiter)
-    n = src.find(b'<=>')
-    if n == -1:
+    offset = src.find(b'<=>')
+    if offset == -1:
         raise FrameNotFound()
-    elif n > 0:
-        src = src[n:]
 
-    line = src[3:] # Skip Start delimiter
+    buf = memoryview(src)
+    offset += 3 # Skip Start delimiter
 
     # Frame type
-    frame_type = struct.unpack_from("B", line)[0]
-    line = line[1:]
+    frame_type = UINT8.unpack_from(buf, offset)[0]
+    offset += 1
 
     if frame_type & 128: # b7
         # TODO Discard text frames
@@ -276,115 +759,245 @@ def parse_frame(src, cipher_key=None):
         frame = {'type': frame_type}
 
     # Number of bytes (Binary)
-    n = struct.unpack_from("B", line)[0]
-    line = line[1:]
-    rest = line[n:]
-    line = line[:n]
+    n = UINT8.unpack_from(buf, offset)[0]
+    offset += 1
+    rest = src[offset+n:]
+    buf = buf[:offset+n] # The view ends with the frame, no copy
+    end = len(buf)
 
     # Serial id
     if v15:
-        serial_id = struct.unpack_from(">Q", line)[0]
-        line = line[8:]
+        serial_id = UINT64_BE.unpack_from(buf, offset)[0]
+        offset += 8
     else:
-        serial_id = struct.unpack_from(">I", line)[0]
-        line = line[4:]
+        serial_id = UINT32_BE.unpack_from(buf, offset)[0]
+        offset += 4
 
     # Encrypted
     if encrypted:
         if not v15:
-            name, line = line.split(b'#', 1)
-            name = name.decode()
+            name, offset = read_name(src, offset, end)
 
         cipher = get_cipher(cipher_key)
         if cipher is None:
             raise ParseError('Encrypted frames not supported because no key provided')
 
-        line = cipher.decrypt(line)
-        frame, _ = parse_frame(line) # _ may contain zeroes
+        line = cipher.decrypt(buf[offset:])
+        frame, buf, offset, end, _ = parse_header(line) # _ may contain zeroes
         if frame['serial'] != serial_id:
             raise ParseError("Serial numbers do not match %d != %d", serial_id, frame['serial'])
 
         if not v15 and frame['name'] != name:
             raise ParseError("Names do not match %s != %s", name, frame['name'])
 
-        return frame, rest
+        return frame, buf, offset, end, rest
 
     # Name
-    name, line = line.split(b'#', 1)
-    name = name.decode() # bytes to str
+    name, offset = read_name(src, offset, end)
     # Sequence
-    sequence = struct.unpack_from("B", line)[0]
-    line = line[1:] # Payload
+    sequence = UINT8.unpack_from(buf, offset)[0]
+    offset += 1 # Payload
 
     frame['serial'] = serial_id
     frame['frame'] = sequence # Frame sequence
     frame['name'] = name
 
-    while line:
-        sensor_id = struct.unpack_from("B", line)[0]
-        line = line[1:]
-        sensor = SENSORS.get(sensor_id, ())
-        if not sensor:
-            logger.error("Sensor type %d not supported" % sensor_id)
-            break
+    return frame, buf, offset, end, rest
 
-        form, names, post = unpack(3, sensor)
-        if post is None:
-            post = post_noop
-
-        for c, name in zip(form, names):
-            name = name.lower()
-            if c == 'f':
-                value = struct.unpack_from("f", line)[0]
-                line = line[4:]
-            elif c == 'i':
-                value = struct.unpack_from("b", line)[0]
-                line = line[1:]
-            elif c == 'j':
-                value = struct.unpack_from("h", line)[0]
-                line = line[2:]
-            elif c == 'k':
-                value = struct.unpack_from("i", line)[0]
-                line = line[4:]
-            elif c == 'u':
-                value = struct.unpack_from("B", line)[0]
-                line = line[1:]
-            elif c == 'v':
-                value = struct.unpack_from("H", line)[0]
-                line = line[2:]
-            elif c == 'w':
-                value = struct.unpack_from("I", line)[0]
-                line = line[4:]
-            elif c == 'str':
-                length = struct.unpack_from("B", line)[0]
-                line = line[1:]
-                value = line[:length]
-                line = line[length:]
-            elif c == 'n':
-                # Variable list of values (done for the DS18B20 string)
-                values = []
-                n_values = struct.unpack_from("B", line)[0]
-                line = line[1:]
-                for j in range(n_values):
-                    if j > 0:
-                        value = struct.unpack_from("b", line)[0]
-                        line = line[1:]
-                        if value != -128:
-                            value = values[-1] + value
-                            values.append(value)
-                            continue
-
-                    value = struct.unpack_from("h", line)[0]
-                    line = line[2:]
-                    values.append(value)
-
-                value = frame.get(name, []) + values
-
-            frame[name] = post(name, value)
 
+def parse_frame(src, cipher_key=None):
+    """
+    Parse the frame starting at the given byte string. We consider that the
+    frame start delimeter has already been read.
+
+    A frame that cannot be decoded (e.g. truncated) raises ParseError.
+    """
+    try:
+        frame, buf, offset, end, rest = parse_header(src, cipher_key)
+    except ParseError:
+        raise
+    except (struct.error, ValueError) as exc:
+        # Retrying will not help, the message is to be rejected
+        raise ParseError(f'Failed to decode frame header: {exc}') from exc
+
+    layout_cache.parse(frame['serial'], buf, offset, end, frame)
     return frame, rest
 
 
+def parse_frames(payloads, cipher_key=None):
+    """
+    Parse many payloads in one go, for instance to reprocess the raw archive.
+    Every payload is a dict like the messages in the wsn_raw exchange, with
+    the keys 'source_addr', 'received' and 'data' (bytes, or base64 encoded).
+
+    Return a dict with one NumPy array per field (see columnar.Columns), and
+    one row per frame. The received and source_addr columns come from the
+    payload.
+
+    Frames with the same fixed size layout are grouped and read with a single
+    numpy.frombuffer call per layout. Payloads that fail to parse are logged
+    and skipped.
+    """
+    # Only for batches, NumPy takes time to import
+    import numpy
+    import columnar
+
+    columns = columnar.Columns()
+    groups = {} # Layout -> ([row, ...], [payload, ...])
+    for payload in payloads:
+        data = payload['data']
+        if type(data) is str:
+            data = base64.b64decode(data)
+
+        extra = {'received': payload['received'], 'source_addr': payload['source_addr']}
+        while data:
+            try:
+                frame, buf, offset, end, data = parse_header(data, cipher_key)
+                serial = frame['serial']
+                layout = layout_cache.lookup(serial, buf, offset, end)
+                if layout is None:
+                    layout_cache.parse(serial, buf, offset, end, frame)
+            except FrameNotFound:
+                break
+            except Exception:
+                logger.exception('Failed to parse payload %s', payload)
+                break
+
+            frame.update(extra)
+            row = columns.add_row(frame)
+            if layout is not None:
+                rows, chunks = groups.setdefault(layout, ([], []))
+                rows.append(row)
+                chunks.append(buf[offset:end])
+
+    for layout, (rows, chunks) in groups.items():
+        rows = numpy.array(rows)
+        for name, values in layout.parse_many(b''.join(chunks)):
+            columns.add_column(name, rows, values)
+
+    return columns.to_arrays()
+
+
+# Start delimiter, type and number of bytes, then up to 255 bytes
+MAX_FRAME_SIZE = 5 + 255
+
+
+class StreamingFrameDecoder:
+    """
+    Decodes the frames from a stream of bytes, for instance read from a
+    serial port. Chunks of data are passed to feed() as they come, it
+    returns the frames that are complete.
+
+    The data is kept in a ring buffer of fixed size. The frame length is read
+    from its header, so a frame is parsed only once, when complete. The data
+    found between frames is garbage, it is discarded and counted.
+    """
+
+    def __init__(self, size=1024, cipher_key=None):
+        if size < MAX_FRAME_SIZE:
+            raise ValueError(f'size must be at least {MAX_FRAME_SIZE}')
+
+        self.ring = bytearray(size)
+        self.view = memoryview(self.ring)
+        self.size = size
+        self.head = 0 # Position of the first byte in the buffer
+        self.count = 0 # Number of bytes in the buffer
+        self.scanned = 0 # Number of bytes known not to start a delimiter
+        self.cipher_key = cipher_key
+
+        # Counters
+        self.frames = 0
+        self.resyncs = 0
+        self.garbage_bytes = 0
+
+    def feed(self, data):
+        """
+        Add the data to the buffer, return the list of complete frames.
+        """
+        frames = []
+        data = memoryview(data)
+        while data:
+            n = min(len(data), self.size - self.count)
+            self.write(data[:n])
+            data = data[n:]
+            frames.extend(self.decode())
+
+        return frames
+
+    def write(self, data):
+        tail = (self.head + self.count) % self.size
+        n = min(len(data), self.size - tail)
+        self.view[tail:tail+n] = data[:n]
+        self.view[:len(data)-n] = data[n:]
+        self.count += len(data)
+
+    def peek(self, offset, n):
+        start = (self.head + offset) % self.size
+        end = start + n
+        if end <= self.size:
+            return bytes(self.view[start:end])
+
+        return bytes(self.view[start:]) + bytes(self.view[:end - self.size])
+
+    def consume(self, n):
+        self.head = (self.head + n) % self.size
+        self.count -= n
+        self.scanned = max(self.scanned - n, 0)
+
+    def discard(self, n):
+        garbage = self.peek(0, n)
+        self.consume(n)
+        # Line breaks between frames are not garbage
+        if garbage.strip():
+            self.garbage_bytes += n
+            self.resyncs += 1
+            logger.warning('%d bytes of garbage found and discarded', n)
+
+    def find(self, sub):
+        """
+        Search the buffer, from the first byte not yet scanned.
+        """
+        index = self.peek(self.scanned, self.count - self.scanned).find(sub)
+        if index == -1:
+            # The last bytes may be the beginning of sub
+            self.scanned = max(self.count - len(sub) + 1, 0)
+            return -1
+
+        return self.scanned + index
+
+    def decode(self):
+        while self.count:
+            # Search the start delimiter
+            index = self.find(b'<=>')
+            if index == -1:
+                self.discard(self.scanned)
+                break
+            elif index > 0:
+                self.discard(index)
+
+            # Wait for the header, then for the whole frame
+            if self.count < 5:
+                break
+
+            size = 5 + self.view[(self.head + 4) % self.size]
+            if self.count < size:
+                break
+
+            try:
+                frame, rest = parse_frame(self.peek(0, size), cipher_key=self.cipher_key)
+            except Exception:
+                # Skip the delimiter, and search the next one
+                # (the bytes up to the next one will be counted as garbage)
+                logger.exception('Failed to parse frame')
+                self.consume(1)
+                self.garbage_bytes += 1
+                continue
+
+            self.consume(size)
+            self.frames += 1
+            yield frame
+
+
 def read_wasp_data(f):
     src = f.read()
 
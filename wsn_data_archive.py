@@ -1,17 +1,18 @@
 # Standard Library
-from datetime import date
+import contextlib
 import json
 import os
 
-from mq import MQ
+# Project
+import archive
 
 
-class Consumer(MQ):
+class Consumer(archive.Consumer):
 
     name = 'wsn_data_archive'
 
     def sub_to(self):
-        return ('wsn_data', 'fanout', self.name, self.handle_message)
+        return ('wsn_data', 'topic', self.name, self.handle_message)
 
     def get_dirname(self, body):
         source_addr = body.get('source_addr')
@@ -21,21 +22,22 @@ class Consumer(MQ):
         return source_addr
 
     def handle_message(self, body):
-        # Create parent directory
-        dirname = self.get_dirname(body)
-        dirpath = os.path.join(datadir, dirname)
-        os.makedirs(dirpath, exist_ok=True)
+        self.write(body, json.dumps(body))
 
-        # Append
-        received = body['received']
-        received = date.fromtimestamp(received).strftime('%Y%m%d')
-        filepath = os.path.join(dirpath, received)
-        with open(filepath, 'a+') as f:
-            body = json.dumps(body)
-            f.write(body + '\n')
+
+@contextlib.contextmanager
+def setup(consumer):
+    """
+    Set the directory where the data is archived. Also used by pipeline.py
+    """
+    datadir = os.path.join(os.getcwd(), 'data', 'cooked')
+    consumer.writer = archive.Writer(datadir, consumer.max_open, consumer.fsync)
+    try:
+        yield
+    finally:
+        consumer.writer.close()
 
 
 if __name__ == '__main__':
-    datadir = os.path.join(os.getcwd(), 'data', 'cooked')
-    with Consumer() as consumer:
+    with Consumer() as consumer, setup(consumer):
         consumer.start()
@@ -1,6 +1,11 @@
+# Standard Library
+import threading
+
+# Requirements
 import requests
 from requests import exceptions
 
+# Project
 from mq import MQ, Pause
 import waspmote
 
@@ -9,23 +14,29 @@ class Consumer(MQ):
 
     name = 'wsn_data_django'
     prefetch_count = 20
+    threads = 4 # The requests run in a thread pool, not in the ioloop
 
     def __init__(self):
         super().__init__()
         self.url = self.config['url']
         self.headers = {'Authorization': 'Token %s' % self.config['token']}
-        self.session = requests.Session()
+        self.sessions = threading.local() # One session per thread
+
+    @property
+    def session(self):
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            session = self.sessions.session = requests.Session()
+        return session
 
     def sub_to(self):
-        return ('wsn_data', 'fanout', self.name, self.handle_message)
+        return ('wsn_data', 'topic', self.name, self.handle_message)
 
     def handle_message(self, data):
-        # RabbitMQ timeouts after 60s, so we must finish in less than 60s or
-        # the connection to RabbitMQ will be broken.
+        # This runs in a thread (see MQ.threads), so a slow server does not
+        # block the ioloop, and the connection to RabbitMQ stays alive.
         json = waspmote.data_to_json(data)
-        # 5s to connect. And 30s between reception of bytes; XXX this does not
-        # guarantees that we'll finish below 60s, so there's room for
-        # improvement.
+        # 5s to connect. And 30s between reception of bytes
         timeout = (5, 30)
         try:
             response = self.session.post(
@@ -0,0 +1,74 @@
+"""
+Archive the numeric fields of the cooked frames as time series, by mote and
+field, see series.py.
+"""
+
+# Standard Library
+import contextlib
+from datetime import date
+import os
+
+# Project
+import archive
+import series
+
+
+class Consumer(archive.Consumer):
+
+    name = 'wsn_data_series'
+
+    # Every flush appends a chunk per field, not too often
+    flush_interval = 30
+    flush_size = 1000
+
+    def sub_to(self):
+        return ('wsn_data', 'topic', self.name, self.handle_message)
+
+    def handle_message(self, body):
+        self.writer.add(body)
+
+    def compress_days(self):
+        """
+        Roll the days before today, in the process pool.
+        """
+        datadir = self.writer.datadir
+        if not os.path.isdir(datadir):
+            return
+
+        today = date.today().strftime('%Y%m%d')
+        for source_addr in sorted(os.listdir(datadir)):
+            for field in sorted(os.listdir(os.path.join(datadir, source_addr))):
+                dirpath = os.path.join(datadir, source_addr, field)
+                for filename in sorted(os.listdir(dirpath)):
+                    day, ext = os.path.splitext(filename)
+                    path = os.path.join(dirpath, day)
+                    if path in self.compressing:
+                        continue
+
+                    # Files renamed before, not rolled yet (the program exited)
+                    if ext == archive.CLOSED:
+                        pass
+                    elif not (ext == series.PART and day < today):
+                        continue
+                    elif not self.writer.detach(source_addr, field, day):
+                        continue
+
+                    self.submit(series.roll, path)
+
+
+@contextlib.contextmanager
+def setup(consumer):
+    """
+    Set the directory where the series are stored. Also used by pipeline.py
+    """
+    datadir = os.path.join(os.getcwd(), 'data', 'series')
+    consumer.writer = series.Writer(datadir, consumer.fsync)
+    try:
+        yield
+    finally:
+        consumer.writer.close()
+
+
+if __name__ == '__main__':
+    with Consumer() as consumer, setup(consumer):
+        consumer.start()
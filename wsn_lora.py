@@ -1,5 +1,6 @@
 import base64
 import collections
+import contextlib
 import threading
 import time
 
@@ -12,6 +13,7 @@ except RuntimeError:
 
 # Project
 from mq import MQ
+import utils
 
 
 class Package(collections.namedtuple('Package', ['dst', 'src', 'packnum', 'length', 'payload', 'retry'])):
@@ -35,6 +37,8 @@ class LoRa:
         self.__lora = None
         self.__address = int(publisher.config.get('address', 1))
         self.__format = publisher.config.get('format', 'waspmote')
+        # ACK the mote only once the message is confirmed by the broker
+        self.__ack_after_confirm = utils.get_bool(publisher.config, 'ack_after_confirm')
         self.__packnum = 0
 
     def __enter__(self):
@@ -168,8 +172,9 @@ class LoRa:
 
             yield {
                 'id': 'rx',
+                'transport': publisher.transport,
                 'source_addr': str(pkg.src),
-                'data': data_str,
+                'data': data, # Base64 encoded if the encoding is JSON
                 'received': received,
             }
 
@@ -184,9 +189,10 @@ class LoRa:
                 lora.set_config('lorap2p:transfer_mode:1') # Receive mode
                 lora.receive_p2p(wait_time)
                 for msg in self.recv():
-                    publisher.publish(msg)
-                    dst = int(msg['source_addr'])
-                    self.send(dst, b'ack')
+                    # This runs in its own thread, not in the ioloop's
+                    if publisher.publish_threadsafe(msg, wait=self.__ack_after_confirm):
+                        dst = int(msg['source_addr'])
+                        self.send(dst, b'ack')
 
             except Exception as exc:
                 publisher.warning(str(exc))
@@ -195,18 +201,29 @@ class LoRa:
 class Publisher(MQ):
 
     name = 'wsn_lora'
-    db_name = 'var/lora.json'
+    db_name = 'var/lora.db'
+    transport = 'lora'
+    outbox_name = 'var/lora.outbox'
 
     def pub_to(self):
-        return ('wsn_raw', 'fanout', '')
+        return ('wsn_raw', 'topic', '')
 
     def lora_cb(self, message):
         pass
 
 
+@contextlib.contextmanager
+def setup(publisher):
+    """
+    Start the LoRa thread, the frames received are published. Also used by
+    pipeline.py
+    """
+    with LoRa(publisher) as lora:
+        thread = threading.Thread(target=lora.loop, args=(), daemon=True)
+        thread.start()
+        yield
+
+
 if __name__ == '__main__':
-    with Publisher() as publisher:
-        with LoRa(publisher) as lora:
-            thread = threading.Thread(target=lora.loop, args=())
-            thread.start()
-            publisher.start()
+    with Publisher() as publisher, setup(publisher):
+        publisher.start()
@@ -1,36 +1,37 @@
 # Standard Library
-from datetime import date
+import contextlib
 import json
 import os
 
-from mq import MQ
+# Project
+import archive
+from mq import json_default
 
 
-class Consumer(MQ):
+class Consumer(archive.Consumer):
 
     name = 'wsn_raw_archive'
 
     def sub_to(self):
-        return ('wsn_raw', 'fanout', self.name, self.handle_message)
-
-    def get_dirname(self, body):
-        return body['source_addr']
+        return ('wsn_raw', 'topic', self.name, self.handle_message)
 
     def handle_message(self, body):
-        # Create parent directory
-        dirname = self.get_dirname(body)
-        dirpath = os.path.join(datadir, dirname)
-        os.makedirs(dirpath, exist_ok=True)
+        self.write(body, json.dumps(body, default=json_default)) # bytes to base64
+
 
-        # Append
-        filename = date.fromtimestamp(body['received']).strftime('%Y%m%d')
-        filepath = os.path.join(dirpath, filename)
-        with open(filepath, 'a+') as f:
-            body = json.dumps(body)
-            f.write(body + '\n')
+@contextlib.contextmanager
+def setup(consumer):
+    """
+    Set the directory where the data is archived. Also used by pipeline.py
+    """
+    datadir = os.path.join(os.getcwd(), 'data', 'raw')
+    consumer.writer = archive.Writer(datadir, consumer.max_open, consumer.fsync)
+    try:
+        yield
+    finally:
+        consumer.writer.close()
 
 
 if __name__ == '__main__':
-    datadir = os.path.join(os.getcwd(), 'data', 'raw')
-    with Consumer() as consumer:
+    with Consumer() as consumer, setup(consumer):
         consumer.start()
@@ -1,10 +1,12 @@
 # Standard Library
 import base64
 #import struct
+import sys
 
 # Project
 import mq
 import riot
+import utils
 import waspmote
 
 
@@ -14,15 +16,42 @@ EVENT_FRAME = 2 # Used to signal boot
 class Consumer(mq.MQ):
 
     name = 'wsn_raw_cook'
-    db_name = 'var/raw_cook.json'
+    db_name = 'var/raw_cook.db'
+    outbox_name = 'var/raw_cook.outbox'
+
+    def __init__(self, worker=0):
+        # With several workers, the messages are distributed between them by
+        # a consistent hash of the routing key (source_addr), so the frames
+        # from a mote are always handled by the same worker, in order.
+        config = utils.get_config(self.name)
+        self.workers = int(config.get('workers', 1))
+        self.worker = worker
+        if self.workers > 1:
+            self.db_name = f'var/raw_cook.{worker}.db'
+            self.outbox_name = f'var/raw_cook.{worker}.outbox'
+            self.sub_from = ('wsn_raw', 'topic')
+
+        super().__init__()
+
+        # Start from the state of the single worker setup, if any
+        if not self.state and self.workers > 1:
+            state = self.load_state(type(self).db_name)
+            self.state.update(state.to_dict())
+            state.close()
+            self.save_state()
 
     def sub_to(self):
-        return ('wsn_raw', 'fanout', self.name, self.handle_message)
+        if self.workers > 1:
+            # The binding key is the weight of the worker queue
+            queue = f'{self.name}.{self.worker}'
+            return ('wsn_raw_cook', 'x-consistent-hash', queue, self.handle_message, ['1'])
+
+        return ('wsn_raw', 'topic', self.name, self.handle_message)
 
     def pub_to(self):
-        return ('wsn_data', 'fanout', '')
+        return ('wsn_data', 'topic', '')
 
-    def rx(self, body):
+    def rx(self, body, transport):
         """"
         {'source_addr': '\x00\x13\xa2\x00Aj\x07#',
          'data': "<=>\x06\x1eb'g\x05|\x10T\x13#\xc3{\xa8\n\xf3Y4b\xc8\x00\x00PA33\xabA\x00\x00\x00\x00",
@@ -41,17 +70,17 @@ class Consumer(mq.MQ):
         fmt = self.config.get('format', 'waspmote')
         self.info('rx %s %s', fmt, data)
         if fmt == 'riot':
+            # A payload may hold several frames
             try:
-                frame = riot.parse_frame(data)
+                for frame in riot.iter_frames(data):
+                    self.info('CBOR %s', frame)
+                    frame.update({
+                        'received': body['received'],
+                        'source_addr': source_addr,
+                    })
+                    self.publish(frame, transport=transport)
             except ValueError:
                 self.error('Failed to load CBOR data')
-            else:
-                self.info('CBOR %s', frame)
-                frame.update({
-                    'received': body['received'],
-                    'source_addr': source_addr,
-                })
-                self.publish(frame)
 
             return
 
@@ -61,18 +90,18 @@ class Consumer(mq.MQ):
                 frame, data = waspmote.parse_frame(data, cipher_key=cipher_key)
             except waspmote.FrameNotFound:
                 break
-            except waspmote.ParseError:
+            except waspmote.ParseError as exc:
                 # FIXME A package may contain several frames, if at least 1
                 # frame has been processed, drop this event from the queue and
                 # publish a new event with the remaining part.
                 print(body)
-                raise
+                raise mq.Reject('Failed to parse frame') from exc
 
             if not frame['name'] and frame['type'] != EVENT_FRAME:
                 frame['name'] = self.get_state(source_addr, 'name', '')
             frame['received'] = body['received']
             frame['source_addr'] = source_addr
-            self.publish(frame)
+            self.publish(frame, transport=transport)
             self.set_state(source_addr, serial=frame['serial'], name=frame['name'])
 
 #   def remote_at_response(self, body):
@@ -106,11 +135,15 @@ class Consumer(mq.MQ):
 #       self.set_state(source_addr, rssi_tst=received)
 
     def handle_message(self, body):
-        # Decode
+        # Decode, bytes are base64 encoded when the message is JSON
         for k in body.keys():
-            if k not in ('id', 'received', 'source_addr'):
+            if k not in ('id', 'transport', 'received', 'source_addr') and type(body[k]) is str:
                 body[k] = base64.b64decode(body[k])
 
+        # The cooked frames are published with the same transport, it is part
+        # of the routing key. Not kept in self, there may be threads.
+        transport = body.get('transport')
+
         # Handle
         frame_type = body['id']
         handler = {
@@ -122,9 +155,11 @@ class Consumer(mq.MQ):
             self.warning('UNEXPECTED ID %s', frame_type)
             return
 
-        handler(body)
+        handler(body, transport)
 
 
 if __name__ == '__main__':
-    with Consumer() as consumer:
+    # The worker number is given by supervisor, see etc.py
+    worker = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    with Consumer(worker) as consumer:
         consumer.start()
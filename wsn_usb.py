@@ -1,77 +1,140 @@
 # Standard Library
+import contextlib
 import time
 
 # Requirements
+from pika.adapters.select_connection import IOLoop
 from serial import Serial, SerialException
 
 # Project
 from mq import MQ
+import utils
 import waspmote
 
 
+class Port:
+    """
+    A serial port with its own frame decoder. The port is registered in the
+    ioloop, and read only when there is data ready.
+    """
+
+    def __init__(self, publisher, name, bauds):
+        self.publisher = publisher
+        self.serial = Serial()
+        self.serial.port = name
+        self.serial.baudrate = bauds
+        self.serial.timeout = 0 # Non blocking
+        self.decoder = None
+
+    @property
+    def name(self):
+        return self.serial.port
+
+    @property
+    def is_open(self):
+        return self.serial.is_open
+
+    def open(self):
+        publisher = self.publisher
+        try:
+            self.serial.open()
+        except SerialException:
+            return False
+
+        publisher.info('Serial port open %s', self.name)
+        self.decoder = waspmote.StreamingFrameDecoder(cipher_key=publisher.cipher_key)
+        publisher.ioloop.add_handler(self.serial.fileno(), self.on_readable, IOLoop.READ)
+        return True
+
+    def close(self):
+        if not self.serial.is_open:
+            return
+
+        self.publisher.ioloop.remove_handler(self.serial.fileno())
+        self.serial.close()
+        self.publisher.info('Serial port close %s', self.name)
+
+    def ack(self):
+        if self.serial.is_open:
+            cmd = f'ack;time {int(time.time())}'
+            self.serial.write(cmd.encode())
+
+    def on_readable(self, fileno, events):
+        publisher = self.publisher
+        serial = self.serial
+        decoder = self.decoder
+        try:
+            read = serial.read(serial.in_waiting or 1)
+            for frame in decoder.feed(read):
+                print(frame) # XXX
+                frame['received'] = int(time.time())
+
+                # TODO handle dups
+
+                if publisher.ack_after_confirm:
+                    publisher.publish(frame, callback=self.ack)
+                else:
+                    publisher.publish(frame)
+                    self.ack()
+                publisher.debug(
+                    'Decoder port=%s frames=%d resyncs=%d garbage_bytes=%d',
+                    self.name, decoder.frames, decoder.resyncs, decoder.garbage_bytes,
+                )
+        except SerialException:
+            # The device is gone, bg_task will try to open it again
+            self.close()
+
+
 class Publisher(MQ):
 
     name = 'wsn_usb'
-    db_name = 'var/usb.json'
+    db_name = 'var/usb.db'
+    transport = 'usb'
+    outbox_name = 'var/usb.outbox'
+
+    def __init__(self):
+        super().__init__()
+        cipher_key = self.config.get('key')
+        if cipher_key is not None:
+            cipher_key = cipher_key.encode()
+        self.cipher_key = cipher_key
+        # ACK the mote only once the message is confirmed by the broker
+        self.ack_after_confirm = utils.get_bool(self.config, 'ack_after_confirm')
+
+        # One or more ports, separated by commas or spaces
+        ports = self.config.get('port', '/dev/serial0')
+        bauds = int(self.config.get('bauds', 9600))
+        self.ports = [Port(self, name, bauds) for name in ports.replace(',', ' ').split()]
 
     def pub_to(self):
-        return ('wsn_data', 'fanout', '')
+        return ('wsn_data', 'topic', '')
 
     def bg_task(self):
-        #self.info('Background task: read from USB')
-        if not serial.is_open:
-            try:
-                serial.open()
-            except SerialException:
-                return 30 # Try again 30s later
-            else:
-                self.info('Serial port open')
+        # Open the ports that are closed (not plugged yet, or unplugged). Data
+        # is read as soon as it is ready, see Port.on_readable
+        for port in self.ports:
+            if not port.is_open:
+                port.open()
 
-        try:
-            timeout = 20 # Seconds waiting for a frame before giving up
-            start = time.time()
-
-            data = b''
-            while time.time() < start + timeout:
-                read = serial.read(1000)
-                if not read:
-                    time.sleep(0.01)
-                    continue
-
-                data += read
-                try:
-                    frame, data = waspmote.parse_frame(data)
-                except waspmote.FrameNotFound:
-                    continue
-                except waspmote.ParseError:
-                    # This should never happen
-                    self.exception()
-                except Exception:
-                    # This will happen when the frame is not yet fully read from USB
-                    continue
-                else:
-                    print(frame) # XXX
-                    frame['received'] = int(time.time())
+        return 30 # Try again 30s later
 
-                    # TODO handle dups
+    def close_ports(self):
+        for port in self.ports:
+            port.close()
 
-                    self.publish(frame)
-                    cmd = f'ack;time {int(time.time())}'
-                    serial.write(cmd.encode())
-                    start = time.time()
-        except SerialException:
-            serial.close()
-            self.info('Serial port close')
-            return 30 # Try again 30s later
+
+@contextlib.contextmanager
+def setup(publisher):
+    """
+    The ports are opened by the background task, close them on exit. Also
+    used by pipeline.py
+    """
+    try:
+        yield
+    finally:
+        publisher.close_ports()
 
 
 if __name__ == '__main__':
-    with Publisher() as publisher:
-        config = publisher.config
-        port = config.get('port', '/dev/serial0')
-        bauds = int(config.get('bauds', 9600))
-        with Serial() as serial:
-            serial.port = port
-            serial.baudrate = bauds
-            serial.timeout = 0
-            publisher.start()
+    with Publisher() as publisher, setup(publisher):
+        publisher.start()
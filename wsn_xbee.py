@@ -1,5 +1,6 @@
 # Standard Library
 import base64
+import contextlib
 #from datetime import datetime
 import time
 
@@ -11,10 +12,17 @@ from mq import MQ
 class Publisher(MQ):
 
     name = 'wsn_xbee'
-    db_name = 'var/xbee.json'
+    db_name = 'var/xbee.db'
+    transport = 'xbee'
+    outbox_name = 'var/xbee.outbox'
+
+    def __init__(self):
+        super().__init__()
+        # ACK the mote only once the message is confirmed by the broker
+        self.ack_after_confirm = utils.get_bool(self.config, 'ack_after_confirm')
 
     def pub_to(self):
-        return ('wsn_raw', 'fanout', '')
+        return ('wsn_raw', 'topic', '')
 
     def xbee_cb(self, message):
         remote = message.remote_device
@@ -35,21 +43,25 @@ class Publisher(MQ):
         address = address.address.hex().upper()
 
         # Skip duplicates
-        data = base64.b64encode(data).decode()
-        if data == self.get_state(address, 'data'):
+        data = bytes(data)
+        data_b64 = base64.b64encode(data).decode()
+        if data_b64 == self.get_state(address, 'data'):
             self.info('Dup frame detected and skipped')
             control.tx(device, remote, 'ack')
             return
-        self.set_state(address, data=data)
 
-        # Publish
+        # Publish (this runs in the XBee reader thread, not in the ioloop's)
         frame = {
             'id': 'rx', # XXX remote_at_response, tx_status
+            'transport': self.transport,
             'source_addr': address,
-            'data': data,
+            'data': data, # Base64 encoded if the encoding is JSON
             'received': int(message.timestamp),
         }
-        self.publish(frame)
+        if not self.publish_threadsafe(frame, wait=self.ack_after_confirm):
+            return # No ACK, the mote will send the frame again
+
+        self.set_state(address, data=data_b64)
 
         # Send ACK to mote
         control.tx(device, remote, 'ack')
@@ -66,13 +78,23 @@ class Publisher(MQ):
             self.set_state(address, **{name: t0})
 
 
+@contextlib.contextmanager
+def setup(publisher):
+    """
+    Open the XBee device, the frames received are published. Also used by
+    pipeline.py
+    """
+    global device
+    device = utils.get_device(publisher.config)
+    try:
+        device.open()
+        device.add_data_received_callback(publisher.xbee_cb)
+        yield
+    finally:
+        if device.is_open():
+            device.close()
+
+
 if __name__ == '__main__':
-    with Publisher() as publisher:
-        device = utils.get_device(publisher.config)
-        try:
-            device.open()
-            device.add_data_received_callback(publisher.xbee_cb)
-            publisher.start()
-        finally:
-            if device.is_open():
-                device.close()
+    with Publisher() as publisher, setup(publisher):
+        publisher.start()